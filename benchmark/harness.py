@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+
+#
+# Analyse files with Musly, Essentia, and Bliss, and provide an API to retrieve similar tracks
+#
+# Copyright (c) 2021-2022 Craig Drummond <craig.p.drummond@gmail.com>
+# GPLv3 license.
+#
+
+import argparse, json, logging, os, platform, random, subprocess, sys, threading, time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from lib import memory, tracks_db, version
+from benchmark import synthetic_db
+
+_LOGGER = logging.getLogger(__name__)
+
+
+DEFAULT_SIZES    = [10000, 100000, 1000000]
+DEFAULT_REQUESTS = 200
+LMS_ROOT         = '/music/'
+APIS             = ['similar', 'dump', 'attrmix']
+PERCENTILES      = [50, 95, 99]
+SIMILAR_COUNT    = 10
+ATTRMIX_ATTRIBS  = ['danceable', 'aggressive', 'electronic', 'acoustic', 'happy', 'party', 'relaxed', 'sad', 'dark']
+
+
+def write_config(db_dir, algo):
+    path = os.path.join(db_dir, 'config.json')
+    with open(path, 'w') as f:
+        json.dump({'paths':{'db':db_dir, 'lms':LMS_ROOT}, 'simalgo':algo, 'musly':{'enabled':False},
+                   'essentia':{'enabled':True, 'highlevel':True}, 'bliss':{'enabled':True},
+                   'genres':synthetic_db.GENRE_GROUPS, 'sessions':{'max':0}}, f)
+    return path
+
+
+def make_request(api, paths, rng):
+    '''
+    URL of a random request for api, similar to those LMS sends, and the minimum number of tracks its response should
+    contain. Similar requests should return all tracks asked for, the others at least one.
+    '''
+    if 'similar'==api:
+        seeds = [LMS_ROOT+paths[rng.randrange(len(paths))] for _ in range(rng.randint(1, 5))]
+        params = [('track', seed) for seed in seeds] + [('count', str(SIMILAR_COUNT)), ('norepart', '15'), ('norepalb', '25'),
+                  ('filterxmas', '1'), ('min', '30'), ('max', '600')]
+        if rng.random()<0.5:
+            params.append(('filtergenre', '1'))
+        # Shuffling is on by default, so only some requests turn it off
+        if rng.random()<0.25:
+            params.append(('shuffle', '0'))
+        return '/api/%s' % api, params, SIMILAR_COUNT
+    elif 'dump'==api:
+        params = [('track', LMS_ROOT+paths[rng.randrange(len(paths))]), ('count', '50')]
+    else:
+        params = [(attrib, rng.choice(['y', 'n'])) for attrib in rng.sample(ATTRMIX_ATTRIBS, rng.randint(1, 3))]
+        params += [('minbpm', str(rng.randint(60, 120))), ('count', '50')]
+        params.append(('maxbpm', str(int(params[-2][1])+40)))
+    return '/api/%s' % api, params, 1
+
+
+def percentile(vals, pc):
+    vals = sorted(vals)
+    return vals[min(len(vals)-1, int(len(vals)*pc/100.0))]
+
+
+def run_api(client_factory, api, paths, num_requests, concurrency, seed):
+    ''' Send num_requests requests to api, from concurrency threads, and return latency statistics '''
+    rng = random.Random(seed)
+    requests = [make_request(api, paths, rng) for _ in range(num_requests)]
+    latencies = []
+    errors = {'errors':0, 'short':0}
+    lock = threading.Lock()
+
+    def worker(chunk):
+        client = client_factory()
+        for url, params, min_tracks in chunk:
+            start = time.perf_counter()
+            resp = client.get(url, query_string=params)
+            taken = time.perf_counter()-start
+            # A quick response with too few tracks is not a success
+            tracks = resp.get_json(force=True, silent=True) if resp.status_code==200 else None
+            with lock:
+                latencies.append(taken*1000.0)
+                if resp.status_code!=200:
+                    errors['errors'] += 1
+                elif not isinstance(tracks, list) or len(tracks)<min_tracks:
+                    errors['short'] += 1
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=worker, args=(requests[i::concurrency], )) for i in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter()-start
+    result = {'requests':num_requests, 'errors':errors['errors'], 'short':errors['short'], 'throughput':round(num_requests/elapsed, 2),
+              'mean_ms':round(sum(latencies)/len(latencies), 3)}
+    for pc in PERCENTILES:
+        result['p%d_ms' % pc] = round(percentile(latencies, pc), 3)
+    return result
+
+
+def run_worker(db_dir, algo, apis, num_requests, concurrency, seed):
+    ''' Benchmark an in-process server using the DB in db_dir, and print the results as JSON '''
+    from lib import app, config
+    cfg = config.read_config(write_config(db_dir, algo), False)
+    cfg['queue']['workers'] = max(cfg['queue']['workers'], concurrency)
+    start = time.time()
+    app.similarity_app.init(argparse.Namespace(log_level='WARNING'), cfg, os.path.join(db_dir, 'music-similarity.jukebox'))
+    while app.similarity_app.generation.loading():
+        time.sleep(0.05)
+    result = {'tracks':len(app.similarity_app.generation.paths), 'load_seconds':round(time.time()-start, 2), 'apis':{}}
+    paths = app.similarity_app.generation.paths
+    for api in apis:
+        # A few requests first, so that lazily built caches and partitions are not counted
+        run_api(app.similarity_app.test_client, api, paths, min(10, num_requests), 1, seed+1)
+        result['apis'][api] = run_api(app.similarity_app.test_client, api, paths, num_requests, concurrency, seed)
+        _LOGGER.info('%s: %s' % (api, json.dumps(result['apis'][api])))
+        if result['apis'][api]['errors']>0 or result['apis'][api]['short']>0:
+            _LOGGER.warning('%s: %d request(s) failed, and %d returned too few tracks' % (api, result['apis'][api]['errors'], result['apis'][api]['short']))
+    result['peak_rss'] = memory.get_process_memory()['peak']
+    print(json.dumps(result))
+
+
+def run_size(work_dir, size, args):
+    db_dir = os.path.join(work_dir, str(size))+os.sep
+    generate_seconds = None
+    if args.regenerate or not os.path.exists(os.path.join(db_dir, tracks_db.DB_FILE)):
+        _LOGGER.info('Generating %d tracks' % size)
+        start = time.time()
+        synthetic_db.generate(db_dir, size, args.seed)
+        generate_seconds = round(time.time()-start, 2)
+    _LOGGER.info('Benchmarking %d tracks' % size)
+    # Each size is run in its own process, so that its peak RSS is not affected by the others
+    cmd = [sys.executable, os.path.abspath(__file__), '--worker', db_dir, '--algo', args.algo, '--apis', ','.join(args.apis),
+           '--requests', str(args.requests), '--concurrency', str(args.concurrency), '--seed', str(args.seed)]
+    proc = subprocess.run(cmd, stdout=subprocess.PIPE, universal_newlines=True)
+    if proc.returncode!=0:
+        _LOGGER.error('Benchmark of %d tracks failed' % size)
+        return None
+    result = json.loads(proc.stdout.strip().split('\n')[-1])
+    result['generate_seconds'] = generate_seconds
+    return result
+
+
+def compare(previous, current):
+    ''' Log the change in p95 latency, and throughput, of each API from previous results '''
+    for size, result in current['results'].items():
+        if result is None or previous['results'].get(size) is None:
+            continue
+        for api, stats in result['apis'].items():
+            prev = previous['results'][size]['apis'].get(api)
+            if prev is not None:
+                _LOGGER.info('%8s %-8s p95: %8.2f -> %8.2f ms (%+.1f%%)  throughput: %8.2f -> %8.2f/s' %
+                             (size, api, prev['p95_ms'], stats['p95_ms'], (stats['p95_ms']-prev['p95_ms'])*100.0/prev['p95_ms'],
+                              prev['throughput'], stats['throughput']))
+
+
+if __name__=='__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the Music Similarity API against synthetic libraries')
+    parser.add_argument('-d', '--dir', type=str, help='Folder for generated DBs (default: %(default)s)', default='benchmark-dbs')
+    parser.add_argument('-s', '--sizes', type=str, help='Comma separated library sizes (default: %(default)s)', default=','.join(str(s) for s in DEFAULT_SIZES))
+    parser.add_argument('-a', '--algo', type=str, choices=['bliss', 'essentia', 'mixed', 'simplemixed'], help='Similarity algorithm (default: %(default)s)', default='bliss')
+    parser.add_argument('--apis', type=str, help='Comma separated APIs to benchmark (default: %(default)s)', default=','.join(APIS))
+    parser.add_argument('-r', '--requests', type=int, help='Requests per API (default: %(default)s)', default=DEFAULT_REQUESTS)
+    parser.add_argument('-c', '--concurrency', type=int, help='Number of concurrent clients (default: %(default)s)', default=1)
+    parser.add_argument('--seed', type=int, help='Random seed, for the DBs and requests (default: %(default)s)', default=1)
+    parser.add_argument('-g', '--regenerate', action='store_true', default=False, help='Regenerate DBs, even if these exist')
+    parser.add_argument('-o', '--output', type=str, help='Write results, as JSON, to this file', default='benchmark.json')
+    parser.add_argument('--compare', type=str, help='Previous results file, to compare against', default=None)
+    parser.add_argument('--worker', type=str, help=argparse.SUPPRESS, default=None)
+    args = parser.parse_args()
+    args.apis = [api for api in args.apis.split(',') if api]
+    logging.basicConfig(format='%(asctime)s %(levelname).1s %(message)s', level=logging.INFO, datefmt='%Y-%m-%d %H:%M:%S', stream=sys.stderr)
+
+    if args.worker is not None:
+        run_worker(args.worker, args.algo, args.apis, args.requests, max(1, args.concurrency), args.seed)
+        sys.exit(0)
+
+    results = {'version':version.MUSIC_SIMILARITY_VERSION, 'python':platform.python_version(), 'machine':platform.machine(),
+               'algo':args.algo, 'requests':args.requests, 'concurrency':args.concurrency, 'results':{}}
+    for size in [int(s) for s in args.sizes.split(',') if s]:
+        results['results'][str(size)] = run_size(os.path.abspath(args.dir), size, args)
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=1)
+    _LOGGER.info('Results written to %s' % args.output)
+    if args.compare is not None:
+        with open(args.compare, 'r') as f:
+            compare(json.load(f), results)
@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+
+#
+# Analyse files with Musly, Essentia, and Bliss, and provide an API to retrieve similar tracks
+#
+# Copyright (c) 2021-2022 Craig Drummond <craig.p.drummond@gmail.com>
+# GPLv3 license.
+#
+
+import argparse, logging, numpy, os, pickle, sys, time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from lib import bliss_analysis, tracks_db
+
+_LOGGER = logging.getLogger(__name__)
+
+
+GENRES              = ['Rock', 'Pop', 'Alternative', 'Indie', 'Electronic', 'Dance', 'Hip-Hop', 'R&B', 'Soul', 'Jazz',
+                       'Blues', 'Metal', 'Hard Rock', 'Punk', 'Folk', 'Country', 'Classical', 'Reggae', 'Soundtrack',
+                       'Ambient', 'Singer-Songwriter', 'Funk', 'Latin', 'World', 'Christmas']
+GENRE_GROUPS        = [['Rock', 'Hard Rock', 'Metal', 'Punk'], ['Pop', 'Dance', 'Electronic', 'R&B'], ['Jazz', 'Blues', 'Soul', 'Funk']]
+TITLE_SUFFIXES      = ['', '', '', '', '', '', ' (Live)', ' (Remastered)', ' (Radio Edit)', ' (Demo)']
+TRACKS_PER_ARTIST   = 25   # Average, artist popularity follows a Zipf distribution
+ZIPF_EXPONENT       = 1.1
+COMPILATION_ALBUMS  = 0.05 # Fraction of albums that are by 'Various Artists'
+IGNORED_TRACKS      = 0.005
+BATCH_SIZE          = 10000
+DB_CONFIG           = {'bliss':{'enabled':True}, 'essentia':{'enabled':True, 'highlevel':True}}
+
+
+def zipf_weights(count, rng):
+    ''' Cumulative weights, so that the first few items are much more likely to be chosen than the rest '''
+    weights = 1.0/numpy.power(numpy.arange(1, count+1), ZIPF_EXPONENT)
+    rng.shuffle(weights)
+    return numpy.cumsum(weights)/weights.sum()
+
+
+def make_albums(num_tracks, rng):
+    ''' Yield (artist, album number, genres, compilation, number of tracks) until there are enough tracks '''
+    num_artists = max(1, num_tracks//TRACKS_PER_ARTIST)
+    artist_weights = zipf_weights(num_artists, rng)
+    genre_weights = zipf_weights(len(GENRES), rng)
+    artist_albums = {}
+    # Each artist mostly sticks to one genre
+    artist_genres = numpy.searchsorted(genre_weights, rng.random(num_artists))
+    total = 0
+    while total<num_tracks:
+        artist = int(numpy.searchsorted(artist_weights, rng.random()))
+        album = artist_albums[artist] = artist_albums.get(artist, 0)+1
+        genres = [GENRES[artist_genres[artist]]]
+        if rng.random()<0.3:
+            genres.append(GENRES[numpy.searchsorted(genre_weights, rng.random())])
+        count = min(int(rng.integers(8, 15)), num_tracks-total)
+        yield artist, album, list(set(genres)), rng.random()<COMPILATION_ALBUMS, count
+        total += count
+
+
+def make_vectors(centres, count, num_vals, spread, rng):
+    return numpy.clip(centres+rng.normal(0.0, spread, (count, num_vals)), -1.0, 1.0)
+
+
+def generate(db_dir, num_tracks, seed=1):
+    '''
+    Write a music-similarity.db of num_tracks tracks to db_dir. Artists, and genres, follow Zipf distributions -
+    and the Bliss vectors, and Essentia attributes, of tracks cluster around those of their genre and artist.
+    '''
+    os.makedirs(db_dir, exist_ok=True)
+    path = os.path.join(db_dir, tracks_db.DB_FILE)
+    if os.path.exists(path):
+        os.remove(path)
+    rng = numpy.random.default_rng(seed)
+    tdb = tracks_db.TracksDb(dict(DB_CONFIG, paths={'db':db_dir}), True)
+    cursor = tdb.get_cursor()
+    cols = ['file', 'title', 'artist', 'album', 'albumartist', 'genre', 'duration', 'ignore'] + \
+           tracks_db.ESSENTIA_HIGHLEVEL_ATTRIBS + ['bpm', 'key', 'bliss'] + tracks_db.NORMALIZED_COLS
+    insert = 'INSERT INTO tracks (%s) VALUES (%s)' % (', '.join(cols), ', '.join(['?']*len(cols)))
+    genre_bliss = rng.uniform(-0.6, 0.6, (len(GENRES), bliss_analysis.NUM_BLISS_VALS))
+    genre_attribs = rng.uniform(0.1, 0.9, (len(GENRES), len(tracks_db.ESSENTIA_HIGHLEVEL_ATTRIBS)))
+    genre_bpm = rng.integers(70, 160, len(GENRES))
+    keys = [key+scale for key in ['A', 'Bb', 'B', 'C', 'C#', 'D', 'Eb', 'E', 'F', 'F#', 'G', 'Ab'] for scale in ['M', 'm']]
+    rows = []
+    added = 0
+    start = time.time()
+    for artist, album, genres, compilation, count in make_albums(num_tracks, rng):
+        genre = GENRES.index(genres[0])
+        # Tracks of an album are close to each other, and to the album's genre
+        album_bliss = make_vectors(genre_bliss[genre], 1, bliss_analysis.NUM_BLISS_VALS, 0.15, rng)[0]
+        bliss = make_vectors(album_bliss, count, bliss_analysis.NUM_BLISS_VALS, 0.1, rng)
+        attribs = numpy.clip(genre_attribs[genre]+rng.normal(0.0, 0.15, (count, len(tracks_db.ESSENTIA_HIGHLEVEL_ATTRIBS))), 0.0, 1.0)
+        bpms = numpy.clip(genre_bpm[genre]+rng.normal(0.0, 15.0, count), 40, 220).astype(int)
+        durations = numpy.clip(rng.normal(240.0, 70.0, count), 30, 1200).astype(int)
+        artist_name = 'Artist %d' % artist
+        album_name = 'Album %d' % album
+        album_artist = 'Various Artists' if compilation else artist_name
+        for i in range(count):
+            track_artist = 'Artist %d' % int(rng.integers(0, max(1, num_tracks//TRACKS_PER_ARTIST))) if compilation else artist_name
+            title = 'Track %d%s' % (added+i, TITLE_SUFFIXES[int(rng.integers(0, len(TITLE_SUFFIXES)))])
+            file_path = '%s/%s/%02d %s.mp3' % (album_artist, album_name, i+1, title)
+            rows.append((file_path, title, track_artist, album_name, album_artist, tracks_db.GENRE_SEPARATOR.join(genres),
+                         int(durations[i]), 1 if rng.random()<IGNORED_TRACKS else 0) +
+                        tuple(float(v) for v in attribs[i]) +
+                        (int(bpms[i]), keys[int(rng.integers(0, len(keys)))], pickle.dumps(bliss[i].tolist(), protocol=4)) +
+                        tracks_db.normalize_names(title, track_artist, album_name, album_artist))
+        added += count
+        if len(rows)>=BATCH_SIZE:
+            cursor.executemany(insert, rows)
+            rows = []
+            _LOGGER.debug('%d/%d track(s)' % (added, num_tracks))
+    if len(rows)>0:
+        cursor.executemany(insert, rows)
+    cursor.execute('INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)', ('normalize', tracks_db.normalize_options()))
+    tdb.commit()
+    tdb.close()
+    _LOGGER.info('Generated %d track(s) in %.1fs' % (added, time.time()-start))
+    return path
+
+
+if __name__=='__main__':
+    parser = argparse.ArgumentParser(description='Generate a synthetic Music Similarity DB')
+    parser.add_argument('-d', '--db', type=str, help='Folder to write music-similarity.db to', required=True)
+    parser.add_argument('-n', '--tracks', type=int, help='Number of tracks', default=10000)
+    parser.add_argument('-s', '--seed', type=int, help='Random seed', default=1)
+    args = parser.parse_args()
+    logging.basicConfig(format='%(asctime)s %(levelname).1s %(message)s', level=logging.INFO, datefmt='%Y-%m-%d %H:%M:%S')
+    generate(args.db, args.tracks, args.seed)
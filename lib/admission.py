@@ -0,0 +1,63 @@
+#
+# Analyse files with Musly, Essentia, and Bliss, and provide an API to retrieve similar tracks
+#
+# Copyright (c) 2021-2022 Craig Drummond <craig.p.drummond@gmail.com>
+# GPLv3 license.
+#
+
+import threading, time
+
+
+class Admission(object):
+    '''
+    Limit the number of requests processed at once to workers. Up to depth more wait, in arrival order, for one of
+    these to finish - any others are rejected.
+    '''
+    def __init__(self, workers, depth):
+        self.workers = workers
+        self.depth = depth
+        self.cond = threading.Condition()
+        self.running = 0
+        self.waiting = 0
+        self.admitted = 0     # Number of requests admitted
+        self.rejected = 0     # Number of requests rejected, as the queue was full
+        self.wait_total = 0.0 # Total time admitted requests spent queued
+        self.wait_max = 0.0
+
+
+    def enter(self):
+        ''' Wait for a worker to be free, and return time spent waiting. None if the queue is full. '''
+        with self.cond:
+            if self.running>=self.workers and self.waiting>=self.depth:
+                self.rejected += 1
+                return None
+            start = time.time()
+            self.waiting += 1
+            try:
+                while self.running>=self.workers:
+                    self.cond.wait()
+            finally:
+                self.waiting -= 1
+            self.running += 1
+            waited = time.time()-start
+            self.admitted += 1
+            self.wait_total += waited
+            self.wait_max = max(self.wait_max, waited)
+            return waited
+
+
+    def leave(self):
+        with self.cond:
+            self.running -= 1
+            self.cond.notify()
+
+
+    def idle(self):
+        return 0==self.running and 0==self.waiting
+
+
+    def get_status(self):
+        with self.cond:
+            return {'workers':self.workers, 'depth':self.depth, 'running':self.running, 'waiting':self.waiting,
+                    'admitted':self.admitted, 'rejected':self.rejected, 'wait':{'total':round(self.wait_total, 3),
+                    'max':round(self.wait_max, 3)}}
@@ -251,6 +251,7 @@ def analyse_files(config, path, remove_tracks, meta_only, force, jukebox, max_tr
     _LOGGER.debug('Num tracks to update: %d' % len(files))
     if dry_run:
         return
+    trks_db.normalize_if_required()
     if max_tracks>0 and len(files)>max_tracks:
         _LOGGER.debug('Only analysing %d tracks' % max_tracks)
         files=files[:max_tracks]
@@ -275,6 +276,7 @@ def analyse_files(config, path, remove_tracks, meta_only, force, jukebox, max_tr
                 _LOGGER.info('Analysed: %d, Failed: %d, Filtered: %d' % (analysed, failed, filtered))
 
         trks_db.commit()
+        trks_db.analyze()
 
         if should_stop:
             trks_db.close()
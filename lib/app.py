@@ -5,11 +5,11 @@
 # GPLv3 license.
 #
 
-import argparse, json, logging, math, numpy, os, random, re, sqlite3, urllib
+import argparse, collections, json, logging, math, numpy, os, random, re, signal, sqlite3, threading, time, tracemalloc, urllib
 from datetime import datetime
-from flask import Flask, abort, request
+from flask import Flask, abort, g, make_response, request
 from scipy.spatial import cKDTree
-from . import bliss_sim, cue, essentia_sim, filters, tracks_db, musly
+from . import admission, cue, filters, generation, memory, metrics, prefetch, profiler, sessions, single_flight, slow_log, trace, track_meta, tracks_db, warmup
 
 _LOGGER = logging.getLogger(__name__)
 
@@ -22,16 +22,31 @@ DEFAULT_NUM_PREV_TRACKS_FILTER_ARTIST = 15   # Try to ensure artist is not in pr
 DEFAULT_NUM_PREV_TRACKS_FILTER_ALBUM  = 25   # Try to ensure album is not in previous N tracks
 SHUFFLE_FACTOR                        = 5    # How many (shuffle_factor*count) tracks to shuffle?
 MIN_NUM_SIM                           = 5000 # Min number of tracs to query for
+INITIAL_NUM_SIM                       = 500  # Initial number of tracks to query Bliss/Essentia for, doubled until enough found
+CENTROID_RECENCY_DECAY                = 0.8  # Weight of each seed track relative to the (more recent) one before it
+MAX_COLLECTION_SEEDS                  = 250  # Max number of tracks of an album or artist to use as seeds
 DEFAULT_NO_GENRE_MATCH_ADJUSTMENT     = 15
 DEFAULT_GENRE_GROUP_MATCH_ADJUSTMENT  = 7
+LOADING_RETRY_AFTER                   = 10   # Seconds to ask clients to wait, if no similarity index is ready yet
+WARMUP_POLL                           = 1    # Seconds between checks of whether the indexes have loaded, before warm-up
+META_BATCH_SIZE                       = 100  # Number of candidate tracks to read metadata for with each query
+TRUNCATED_HEADER                      = 'X-Truncated' # Set on responses that were cut short by their deadline
+UNSHARED_PARAMS                       = ['format', 'trace'] # Parameters that do not affect the results of a similarity search
+BUSY_RETRY_AFTER                      = 2    # Seconds to ask clients to wait, if too many requests are queued
+FAST_LANE_PATHS                       = ['/api/config', '/api/features', '/api/genres', '/api/status', '/api/metrics'] # Not queued
+DEFAULT_PROFILE_SECONDS               = 10
+DEFAULT_PROFILE_INTERVAL_MS           = 10
+MEMORY_CACHE_SECONDS                  = 5    # Seconds to reuse index, and process, memory sizes for
+PROFILE_TOP_FUNCTIONS                 = 50   # Number of functions to list in JSON profiles
 
 
 class SimilarityApp(Flask):
     def init(self, args, app_config, jukebox_path):
         _LOGGER.debug('Start server')
         self.app_config = app_config
-        self.mus = None
-        
+        if app_config['memory']['tracemalloc']:
+            tracemalloc.start()
+
         flask_logging = logging.getLogger('werkzeug')
         flask_logging.setLevel(args.log_level)
         flask_logging.disabled = 'DEBUG'!=args.log_level
@@ -58,54 +73,214 @@ class SimilarityApp(Flask):
         # Re-open DB now that essentia/bliss have been checked
         tdb.close()
         tdb = tracks_db.TracksDb(app_config)
+        if not tdb.use_normalized:
+            _LOGGER.warning("Stored normalised names are out of date, run with '--normalize' to update these")
+        tdb.close()
 
-        self.mus = None
-        self.mta = {'tracks':None, 'ids':None}
-
-        mixed = app_config['simalgo']=='mixed' or app_config['simalgo']=='simplemixed'
-        if app_config['simalgo']=='essentia' or (mixed and app_config['mixed']['essentia']>0):
-            self.paths = essentia_sim.init(tdb)
-            _LOGGER.debug('%d track(s) loaded from Essentia' % len(self.paths) if self.paths is not None else 0)
-
-        if app_config['simalgo']=='bliss' or (mixed and app_config['mixed']['bliss']>0):
-            self.paths = bliss_sim.init(tdb)
-            _LOGGER.debug('%d track(s) loaded from Bliss' % len(self.paths) if self.paths is not None else 0)
-
-        if app_config['simalgo']=='musly' or (mixed and app_config['mixed']['musly']>0):
-            self.mus = musly.Musly(app_config['musly']['lib'])
-            (self.paths, self.mta['tracks']) = self.mus.get_alltracks_db(tdb.get_cursor())
-            _LOGGER.debug('%d track(s) loaded from Musly' % len(self.paths) if self.paths is not None else 0)
-
-            # If we can, load musly from jukebox...
-            if os.path.exists(jukebox_path):
-                self.mta['ids'] = self.mus.get_jukebox_from_file(jukebox_path)
-
-            if self.mta['tracks'] is not None and self.paths is not None and (self.mta['ids']==None or len(self.mta['ids'])!=len(self.paths)):
-                _LOGGER.debug('Adding tracks from DB to musly')
-                self.mta['ids'] = self.mus.add_tracks(self.mta['tracks'], app_config['musly']['styletracks'], app_config['musly']['styletracksmethod'], tdb)
-                self.mus.write_jukebox(jukebox_path)
-
-        if self.paths is None or len(self.paths)==0 or (app_config['simalgo']=='musly' and self.mta['ids'] is None):
+        self.admission = admission.Admission(app_config['queue']['workers'], app_config['queue']['depth'])
+        self.sessions = sessions.Sessions(app_config['sessions']['max'], app_config['sessions']['ttl']) if app_config['sessions']['max']>0 else None
+        pcfg = app_config['prefetch']
+        self.prefetcher = prefetch.Prefetcher(pcfg['max'], pcfg['ttl'], pcfg['budget']/100.0, self.admission.idle) if pcfg['enabled'] else None
+        self.trace_log = trace.TraceLog(app_config['trace']['file'], app_config['trace']['sample'])
+        scfg = app_config['slowlog']
+        self.slow_log = slow_log.SlowLog(scfg['file'], scfg['threshold']/1000.0, scfg['maxsize']*1024*1024, scfg['backups']) if scfg['file'] else None
+        self.jukebox_path = jukebox_path
+        self.generation_lock = threading.Lock()
+        self.memory_lock = threading.Lock()
+        self.memory_cache = None # (time, generation number, index usage, process memory)
+        self.reloading = False
+        self.generation = generation.Generation(app_config, jukebox_path, 1)
+        if len(self.generation.paths)==0:
             _LOGGER.error('DB not initialised, have you analysed all tracks?')
-            tdb.close()
             exit(-1)
 
+        # Indexes are built in background threads, so that the HTTP server can start straight away
+        self.generation.load()
         _LOGGER.info('Similarity via: {}'.format(app_config['simalgo']))
+        self.warm_up(self.generation)
+
+        if app_config['reload']['poll']>0:
+            threading.Thread(target=self.poll_db, args=(app_config['reload']['poll'],), name='poll-db', daemon=True).start()
 
 
     def get_config(self):
         return self.app_config
 
 
-    def get_musly(self):
-        return self.mus, self.mta
+    def acquire(self):
+        ''' Get the current generation, release() must be called once finished with this '''
+        with self.generation_lock:
+            gen = self.generation
+            gen.users += 1
+        return gen
+
+
+    def release(self, gen):
+        with self.generation_lock:
+            gen.users -= 1
+            close = gen.retired and 0==gen.users
+        if close:
+            gen.close()
+
+
+    def reload(self):
+        '''
+        Start loading a new generation from the DB, in the background. Returns False if the current generation is
+        still loading, or a reload is already in progress.
+        '''
+        with self.generation_lock:
+            if self.reloading or self.generation.loading():
+                return False
+            self.reloading = True
+        _LOGGER.info('Reloading from DB')
+        threading.Thread(target=self.load_generation, name='reload', daemon=True).start()
+        return True
+
+
+    def replace_generation(self, gen):
+        ''' Make gen the current generation, the old one is closed once no request is using it '''
+        with self.generation_lock:
+            old = self.generation
+            self.generation = gen
+            old.retired = True
+            close = 0==old.users
+        if close:
+            old.close()
+
+
+    def load_generation(self):
+        ''' Load a new generation, and replace the current one with this - if all of its backends loaded '''
+        gen = None
+        try:
+            gen = generation.Generation(self.app_config, self.jukebox_path, self.generation.number+1)
+            if len(gen.paths)>0:
+                gen.load(wait=True)
+            if len(gen.paths)>0 and gen.get_ready_algo()==self.app_config['simalgo']:
+                self.replace_generation(gen)
+                _LOGGER.info('Reloaded %d track(s), generation %d' % (len(gen.paths), gen.number))
+                self.warm_up(gen)
+                gen = None
+            else:
+                _LOGGER.error('Reload failed, still using generation %d' % self.generation.number)
+        except Exception as e:
+            _LOGGER.error('Reload failed - %s' % str(e))
+        if gen is not None:
+            gen.close()
+        with self.generation_lock:
+            self.reloading = False
+
+
+    def ingest(self):
+        '''
+        Add tracks that have been appended to the DB since the current generation was loaded, without reloading the
+        existing tracks. Returns False if there were none, the DB has changed in other ways (so a reload is required),
+        or a (re)load is in progress.
+        '''
+        with self.generation_lock:
+            if self.reloading or self.generation.loading():
+                return False
+            self.reloading = True
+        ingested = False
+        try:
+            current = self.generation
+            gen = current.extend(current.number+1)
+            if gen is not None and len(gen.paths)>len(current.paths):
+                self.replace_generation(gen)
+                _LOGGER.info('Added %d track(s), generation %d' % (len(gen.paths)-len(current.paths), gen.number))
+                ingested = True
+                if gen.delta_size()>generation.MAX_DELTA_TRACKS:
+                    _LOGGER.debug('Merging delta indexes')
+                    merged = gen.extend(gen.number+1, merge=True)
+                    if merged is not None:
+                        self.replace_generation(merged)
+        except Exception as e:
+            _LOGGER.error('Failed to add new tracks - %s' % str(e))
+        with self.generation_lock:
+            self.reloading = False
+        return ingested
+
+
+    def poll_db(self, interval):
+        '''
+        Check whether the DB has been modified every interval seconds. Tracks appended to the DB are added straight
+        away, otherwise the server reloads once the DB has been left unmodified for interval seconds.
+        '''
+        path = os.path.join(self.app_config['paths']['db'], tracks_db.DB_FILE)
+        loaded = os.path.getmtime(path)
+        while True:
+            time.sleep(interval)
+            try:
+                mtime = os.path.getmtime(path)
+            except OSError:
+                continue
+            if mtime!=loaded and (self.ingest() or (time.time()-mtime>=interval and self.reload())):
+                loaded = mtime
+
+
+    def warm_up(self, gen):
+        ''' Start warming up the prefetch cache for gen, if configured '''
+        if self.app_config['warmup']['tracks']<=0 or not 'lmsdb' in self.app_config:
+            return
+        if self.prefetcher is None:
+            _LOGGER.warning('Warm-up requires prefetching to be enabled')
+            return
+        threading.Thread(target=warm_up, args=(gen, self.app_config['warmup']['tracks']), name='warm-up-%d' % gen.number, daemon=True).start()
 
 
-    def get_paths(self):
-        return self.paths
+    def get_status(self):
+        gen = self.acquire()
+        try:
+            status = gen.get_status()
+            status['memory'] = self.get_memory(gen)
+        finally:
+            self.release(gen)
+        status['reloading'] = self.reloading
+        status['queue'] = self.admission.get_status()
+        if self.sessions is not None:
+            status['sessions'] = self.sessions.num_sessions()
+        if self.prefetcher is not None:
+            status['prefetch'] = self.prefetcher.get_status()
+        return status
+
+
+    def get_memory(self, gen):
+        '''
+        Estimated memory used by the indexes of gen, the occupancy of caches, and the size of the process. Index and
+        process sizes are costly to calculate, so these are reused for MEMORY_CACHE_SECONDS.
+        '''
+        with self.memory_lock:
+            cached = self.memory_cache
+            if cached is None or cached[1]!=gen.number or time.time()-cached[0]>=MEMORY_CACHE_SECONDS:
+                cached = self.memory_cache = (time.time(), gen.number, gen.memory_usage(), memory.get_process_memory())
+        indexes = cached[2]
+        caches = {'coalesced':{'items':similar_requests.num_calls()}}
+        if self.sessions is not None:
+            caches['sessions'] = {'items':self.sessions.num_sessions(), 'max':self.sessions.max_sessions}
+        if self.prefetcher is not None:
+            pstatus = self.prefetcher.get_status()
+            caches['prefetch'] = {'items':pstatus['cached'], 'max':self.prefetcher.max_entries, 'kept':pstatus['kept']}
+        usage = {'total':sum(component['bytes'] for component in indexes.values()), 'indexes':indexes, 'caches':caches,
+                 'process':cached[3], 'dbconnections':tracks_db.get_open_connections()}
+        if tracemalloc.is_tracing():
+            current, peak = tracemalloc.get_traced_memory()
+            usage['tracemalloc'] = {'current':current, 'peak':peak}
+        return usage
 
 
 similarity_app = SimilarityApp(__name__)
+similar_requests = single_flight.SingleFlight()
+request_profiler = profiler.Profiler()
+request_metrics = metrics.Metrics('similarity_')
+request_metrics.describe('requests_total', 'Requests, by API')
+request_metrics.describe('errors_total', 'Requests that failed, by API and HTTP status')
+request_metrics.describe('request_seconds', 'Time to process requests, including time queued, by API')
+request_metrics.describe('queue_wait_seconds', 'Time requests spent waiting for a worker')
+request_metrics.describe('rejected_total', 'Requests rejected as the queue was full')
+request_metrics.describe('stage_seconds', 'Time spent in each stage of similarity requests')
+request_metrics.describe('query_seconds', 'Time spent searching for similar tracks, by algorithm')
+request_metrics.describe('cache_hits_total', 'Similar track searches that were not needed, by cache')
+request_metrics.describe('cache_misses_total', 'Similar track searches that were not cached, by cache')
+request_metrics.describe('filtered_total', 'Similar tracks filtered out, by reason')
 
 
 class SetEncoder(json.JSONEncoder):
@@ -115,11 +290,103 @@ class SetEncoder(json.JSONEncoder):
         return json.JSONEncoder.default(self, obj)
 
 
+def get_generation():
+    ''' Generation to use for the current request, the same one is used for the whole request '''
+    if 'generation' not in g:
+        g.generation = similarity_app.acquire()
+    return g.generation
+
+
+@similarity_app.teardown_request
+def release_generation(exc):
+    gen = g.pop('generation', None)
+    if gen is not None:
+        similarity_app.release(gen)
+
+
+@similarity_app.before_request
+def admit_request():
+    ''' Queue requests until a worker is free, rejecting them if the queue is full. Cheap requests are not queued. '''
+    g.arrived = time.time()
+    if request.path in FAST_LANE_PATHS:
+        return
+    waited = similarity_app.admission.enter()
+    if waited is None:
+        _LOGGER.warning('Too many requests queued, rejecting %s' % request.path)
+        request_metrics.inc('rejected_total')
+        abort(make_response('Too many requests queued', 503, {'Retry-After':str(BUSY_RETRY_AFTER)}))
+    g.admitted = True
+    request_metrics.observe('queue_wait_seconds', (), waited)
+    _LOGGER.debug('%s queued for %.3fs' % (request.path, waited))
+
+
+@similarity_app.after_request
+def count_request(response):
+    # Use the route, rather than the path, so that unknown paths do not each create new metrics
+    api = (('api', request.url_rule.rule if request.url_rule is not None else 'unknown'), )
+    request_metrics.inc('requests_total', api)
+    if response.status_code>=400:
+        request_metrics.inc('errors_total', api+(('code', str(response.status_code)), ))
+    if 'arrived' in g:
+        taken = time.time()-g.arrived
+        request_metrics.observe('request_seconds', api, taken)
+        if similarity_app.slow_log is not None and not request.path in FAST_LANE_PATHS:
+            params = request.args.to_dict(flat=False) if request.method=='GET' else request.get_json(silent=True)
+            similarity_app.slow_log.record(request.method, request.path, params, response.status_code, taken,
+                                           g.generation.number if 'generation' in g else None)
+    return response
+
+
+@similarity_app.teardown_request
+def release_worker(exc):
+    if g.pop('admitted', False):
+        similarity_app.admission.leave()
+
+
+def release_worker_early():
+    ''' Let another request use this request's worker, e.g. whilst it waits for an identical request's results '''
+    release_worker(None)
+
+
+def loading():
+    ''' Abort request, as no similarity index is ready yet '''
+    abort(make_response('Similarity indexes are loading', 503, {'Retry-After':str(LOADING_RETRY_AFTER)}))
+
+
 def get_value(params, key, defVal, isPost):
     val = (params[key] if key in params else defVal) if isPost else (params[key][0] if key in params else defVal)
     return defVal if val is None else val
 
 
+def get_request_key(params):
+    ''' Normalise request parameters, so that identical GET and POST requests have the same key '''
+    key = {}
+    for name, val in params.items():
+        if name not in UNSHARED_PARAMS:
+            key[name] = [v if isinstance(v, (list, dict)) else str(v) for v in (val if isinstance(val, list) else [val])]
+    return json.dumps(key, sort_keys=True)
+
+
+def get_deadline(params, cfg, isPost):
+    '''
+    Time by which a request should return, from deadline_ms or the configured default. None if no deadline. Time
+    spent queued counts towards this.
+    '''
+    deadline_ms = int(get_value(params, 'deadline_ms', cfg['deadline'], isPost))
+    return g.get('arrived', time.time())+(deadline_ms/1000.0) if deadline_ms>0 else None
+
+
+def expired(deadline):
+    return deadline is not None and time.time()>=deadline
+
+
+def truncated_response(body, truncated):
+    ''' Flag responses that only hold what was found before the deadline '''
+    if not truncated:
+        return body
+    return make_response(body, 200, {TRUNCATED_HEADER:'1'})
+
+
 def decode(url, root):
     u = urllib.parse.unquote(url)
     if u.startswith('file://'):
@@ -144,29 +411,45 @@ def encode(root, path, add_file_protocol):
     return full_path
 
 
-def genre_adjust(seed, entry, acceptable_genres, all_genres, no_genre_match_adj, genre_group_adj):
-    if 'genres' not in seed:
-        return no_genre_match_adj
-    if 'genres' not in entry:
-        return no_genre_match_adj
-    if len(seed['genres'].intersection(entry['genres']))>0:
-        # Exact genre match
-        return 0.0
-    if (acceptable_genres is not None and len(entry['genres'].intersection(acceptable_genres))==0) or \
-       (acceptable_genres is None and all_genres is not None and len(entry['genres'].intersection(all_genres))==0):
-        return no_genre_match_adj
-    # Genre in group
-    return genre_group_adj
+def get_musly_similars(mus, mta, track_ids, seed_weights, num_sim):
+    '''
+    Musly has no feature vectors to average, so for several seeds the similarity of each track to each seed is
+    combined using seed_weights instead.
+    '''
+    if 1==len(track_ids):
+        return mus.get_similars(mta['tracks'], mta['ids'], track_ids[0], num_sim)
+    num_tracks = len(mta['tracks'])
+    sims = numpy.zeros(num_tracks)
+    total_weight = 0.0
+    for track_id, seed_weight in zip(track_ids, seed_weights):
+        tracks = mus.get_similars(mta['tracks'], mta['ids'], track_id, num_tracks)
+        if tracks is not None:
+            for track in tracks:
+                sims[track['id']] += track['sim']*seed_weight
+            total_weight += seed_weight
+    if total_weight<=0.0:
+        return None
+    sims /= total_weight
+    order = numpy.argsort(sims, kind='stable')[:num_sim]
+    return [{'id':i, 'sim':s} for i, s in zip(order.tolist(), sims[order].tolist())]
 
 
-def get_similars(track_id, mus, num_sim, mta, tdb, cfg):
+def get_similars(track_id, gen, num_sim, cfg, weights=None):
+    return get_centroid_similars([track_id], [1.0], gen, num_sim, cfg, weights)
+
+
+def get_centroid_similars(track_ids, seed_weights, gen, num_sim, cfg, weights=None, partitions=None, eligible=None):
+    '''
+    Get similar tracks to the weighted centroid of the seeds. partitions and eligible are only used for Bliss and
+    Essentia, as per get_batch_similars.
+    '''
     tracks = []
 
     if cfg['simalgo']=='mixed' or cfg['simalgo']=='simplemixed':
         etracks = []
         btracks = []
         mtracks = []
-        num_tracks = tdb.num_tracks()
+        num_tracks = len(gen.paths)
         use_ess = cfg['essentia']['enabled'] and cfg['essentia']['highlevel'] and 'essentia' in cfg['mixed'] and cfg['mixed']['essentia']>0
         use_bliss = cfg['bliss']['enabled'] and 'bliss' in cfg['mixed'] and cfg['mixed']['bliss']>0
         use_musly = cfg['musly']['enabled'] and 'musly' in cfg['mixed'] and cfg['mixed']['musly']>0
@@ -180,15 +463,15 @@ def get_similars(track_id, mus, num_sim, mta, tdb, cfg):
         # Get similarities from enabled algorithms
         if use_ess:
             _LOGGER.debug('Get distances for all tracks from Essentia')
-            etracks = essentia_sim.get_similars(track_id, num_tracks)
+            etracks = gen.essentia.get_centroid_similars(track_ids, seed_weights, num_tracks, weights)
             etracks = sorted(etracks, key=lambda k: k['id'])
         if use_bliss:
             _LOGGER.debug('Get distances for all tracks from Bliss')
-            btracks = bliss_sim.get_similars(track_id, num_tracks)
+            btracks = gen.bliss.get_centroid_similars(track_ids, seed_weights, num_tracks, weights)
             btracks = sorted(btracks, key=lambda k: k['id'])
         if use_musly:
             _LOGGER.debug('Get distances for all tracks from Musly')
-            mtracks = mus.get_similars(mta['tracks'], mta['ids'], track_id, num_tracks)
+            mtracks = get_musly_similars(gen.mus, gen.mta, track_ids, seed_weights, num_tracks)
             mtracks = sorted(mtracks, key=lambda k: k['id'])
 
         if len(etracks)>0 or len(btracks)>0 or len(mtracks)>0:
@@ -239,15 +522,157 @@ def get_similars(track_id, mus, num_sim, mta, tdb, cfg):
             return tracks
 
     if cfg['simalgo']=='essentia':
-        _LOGGER.debug('Get %d similar tracks to %d from Essentia' % (num_sim, track_id))
-        return essentia_sim.get_similars(track_id, num_sim)
+        _LOGGER.debug('Get %d similar tracks to %s from Essentia' % (num_sim, str(track_ids)))
+        return gen.essentia.get_centroid_similars(track_ids, seed_weights, num_sim, weights, partitions, eligible)
 
     if cfg['simalgo']=='bliss':
-        _LOGGER.debug('Get %d similar tracks to %d from Bliss' % (num_sim, track_id))
-        return bliss_sim.get_similars(track_id, num_sim)
+        _LOGGER.debug('Get %d similar tracks to %s from Bliss' % (num_sim, str(track_ids)))
+        return gen.bliss.get_centroid_similars(track_ids, seed_weights, num_sim, weights, partitions, eligible)
 
-    _LOGGER.debug('Get %d similar tracks to %d from Musly' % (num_sim, track_id))
-    return mus.get_similars(mta['tracks'], mta['ids'], track_id, num_sim)
+    _LOGGER.debug('Get %d similar tracks to %s from Musly' % (num_sim, str(track_ids)))
+    return get_musly_similars(gen.mus, gen.mta, track_ids, seed_weights, num_sim)
+
+
+def get_batch_similars(track_ids, gen, num_sim, cfg, weights=None, partitions=None, eligible=None):
+    '''
+    Get similar tracks for each seed, querying all seeds in one go if the algorithm supports this. partitions,
+    if set, restricts the Bliss/Essentia search to these genre partitions, and eligible to the tracks in this mask.
+    '''
+    if cfg['simalgo']=='essentia':
+        _LOGGER.debug('Get %d similar tracks to %s from Essentia' % (num_sim, str(track_ids)))
+        return gen.essentia.get_batch_similars(track_ids, num_sim, weights, partitions, eligible)
+
+    if cfg['simalgo']=='bliss':
+        _LOGGER.debug('Get %d similar tracks to %s from Bliss' % (num_sim, str(track_ids)))
+        return gen.bliss.get_batch_similars(track_ids, num_sim, weights, partitions, eligible)
+
+    return [get_similars(track_id, gen, num_sim, cfg, weights) for track_id in track_ids]
+
+
+def warm_up(gen, count):
+    '''
+    Once gen has loaded, queue searches for the most played, and most recently played, tracks in LMS - as these are
+    likely to be used as seeds soon. Searches use the warmup settings from config, so that these match those of the
+    mixes LMS requests, and their results are kept until the next warm-up.
+    '''
+    while gen.loading():
+        time.sleep(WARMUP_POLL)
+    cfg = gen.get_request_config()
+    if cfg is None or gen.retired:
+        return
+    urls = warmup.get_played_tracks(cfg['lmsdb'], count)
+    root = get_music_path({}, cfg)
+    track_ids = [track_id for track_id in [gen.get_track_id(decode(url, root)) for url in urls] if track_id is not None]
+    _LOGGER.debug('Warm-up, %d of %d played track(s) found' % (len(track_ids), len(urls)))
+    wcfg = cfg['warmup']
+    exclude_christmas = wcfg['filterxmas'] and datetime.now().month!=12
+    genres = cfg['genres'] if wcfg['filtergenre'] and 'genres' in cfg and (cfg['simalgo']=='bliss' or cfg['simalgo']=='essentia') else None
+    weights = get_weights({}, cfg, False)
+    similarity_app.prefetcher.clear_kept()
+    for track_id in track_ids:
+        # Partitions, if filtering on genre, are those a mix with just this seed would search
+        partitions = None if genres is None else gen.partitions.select(genres, gen.partitions.expand(genres, gen.meta.genre_bits[track_id]))
+        search = get_search(gen, cfg, DEFAULT_TRACKS_TO_RETURN, 1, partitions, wcfg['min'], wcfg['max'], exclude_christmas, weights)
+        prefetch_similars(gen, [{'id':track_id}], search, True)
+
+
+def get_timed_tracks(tdb, track_ids, metas, stages):
+    ''' Read metadata of tracks into metas, None if not found, adding the time taken to the metadata stage '''
+    start = time.perf_counter()
+    found = tdb.get_tracks([track_id+1 for track_id in track_ids]) # IDs (rowid) in SQLite are 1.. musly is 0..
+    for track_id in track_ids:
+        metas[track_id] = found.get(track_id+1)
+    stages.add('metadata', time.perf_counter()-start)
+
+
+def observe_stages(stages, algo):
+    for stage, seconds in stages.times.items():
+        if 'query'==stage:
+            request_metrics.observe('query_seconds', (('algo', algo), ), seconds)
+        else:
+            request_metrics.observe('stage_seconds', (('stage', stage), ), seconds)
+
+
+def get_seed_similars(sid, track_ids, gen, num_sim, cfg, weights, partitions, eligible, search_key):
+    '''
+    As get_batch_similars, but using the similar tracks cached in the session (if sid is set) for seeds it has searched
+    before, or those prefetched for the seeds. search_key identifies the settings, other than num_sim, of the search.
+    '''
+    seed_simtracks = [None]*len(track_ids)
+    if sid is not None:
+        seed_simtracks = [similarity_app.sessions.get_neighbours(sid, gen, (track_id, num_sim, search_key)) for track_id in track_ids]
+    cached = [simtracks is not None for simtracks in seed_simtracks]
+    if sid is not None:
+        request_metrics.inc('cache_hits_total', (('cache', 'session'), ), sum(cached))
+        request_metrics.inc('cache_misses_total', (('cache', 'session'), ), len(cached)-sum(cached))
+    if similarity_app.prefetcher is not None:
+        seed_simtracks = [similarity_app.prefetcher.get((gen.number, track_id, search_key), num_sim) if simtracks is None else simtracks
+                          for track_id, simtracks in zip(track_ids, seed_simtracks)]
+        prefetched = sum(simtracks is not None for simtracks in seed_simtracks)-sum(cached)
+        request_metrics.inc('cache_hits_total', (('cache', 'prefetch'), ), prefetched)
+        request_metrics.inc('cache_misses_total', (('cache', 'prefetch'), ), len(cached)-sum(cached)-prefetched)
+    missing = [track_id for track_id, simtracks in zip(track_ids, seed_simtracks) if simtracks is None]
+    if len(missing)<len(track_ids):
+        _LOGGER.debug('%d/%d seed(s) cached' % (len(track_ids)-len(missing), len(track_ids)))
+    if len(missing)>0:
+        found = dict(zip(missing, get_batch_similars(missing, gen, num_sim, cfg, weights, partitions, eligible)))
+        seed_simtracks = [found[track_id] if simtracks is None else simtracks for track_id, simtracks in zip(track_ids, seed_simtracks)]
+    if sid is not None:
+        for track_id, simtracks, in_session in zip(track_ids, seed_simtracks, cached):
+            if not in_session:
+                similarity_app.sessions.set_neighbours(sid, gen, (track_id, num_sim, search_key), simtracks)
+    return seed_simtracks
+
+
+def prefetch_similars(gen, tracks, search, keep=False):
+    ''' Queue searches for the tracks returned by a mix, as these are likely to be the seeds of its next request '''
+    for track in tracks:
+        similarity_app.prefetcher.add((gen.number, track['id'], search['key']), search['num_sim'],
+                                      lambda track_id=track['id']: prefetch_search(gen.number, track_id, search), keep)
+
+
+def get_search(gen, cfg, count, num_seeds, partitions, min_duration, max_duration, exclude_christmas, weights):
+    '''
+    Settings for searches for the similar tracks of each seed. key identifies these settings, other than num_sim, so
+    that results may be cached. eligible is the mask of tracks that pass the hard filters, for Bliss and Essentia.
+    '''
+    key = (cfg['simalgo'], None if partitions is None else tuple(part[0] for part in partitions),
+           (min_duration, max_duration, exclude_christmas), json.dumps(weights, sort_keys=True))
+    # For Bliss and Essentia start with a small number of similar tracks, and ask for more only if too many of these
+    # are filtered out. Tracks that fail the ignore, duration, or Christmas filters are excluded by the search itself.
+    if cfg['simalgo']=='bliss' or cfg['simalgo']=='essentia':
+        num_sim = min(INITIAL_NUM_SIM, len(gen.paths))
+        eligible = gen.meta.eligible(min_duration, max_duration, exclude_christmas)
+    else:
+        num_sim = count * num_seeds * 50
+        if num_sim<MIN_NUM_SIM:
+            num_sim = MIN_NUM_SIM
+        if num_sim>len(gen.paths):
+            num_sim = len(gen.paths)
+        eligible = None
+    return {'key':key, 'num_sim':num_sim, 'cfg':cfg, 'weights':weights, 'partitions':partitions, 'eligible':eligible}
+
+
+def prefetch_search(number, track_id, search):
+    ''' Search for similar tracks on behalf of the prefetcher, unless the tracks have since been reloaded '''
+    gen = similarity_app.acquire()
+    try:
+        if gen.number!=number:
+            return None
+        return get_batch_similars([track_id], gen, search['num_sim'], search['cfg'], search['weights'], search['partitions'], search['eligible'])[0]
+    finally:
+        similarity_app.release(gen)
+
+
+def update_session(sid, gen, cfg, tracks, recent):
+    ''' Add the tracks returned by a request to the start of its session's recent tracks '''
+    tdb = tracks_db.TracksDb(cfg)
+    returned = []
+    for track in reversed(tracks):
+        meta = tdb.get_track(track['id']+1) # IDs (rowid) in SQLite are 1.. musly is 0..
+        returned.append(sessions.filter_entry(track['id'], track['path'], meta, get_album_key(meta) if meta else None))
+    tdb.close()
+    similarity_app.sessions.set_recent(sid, gen, returned+recent)
 
 
 def append_list(orig, to_add, min_count):
@@ -264,6 +689,12 @@ def append_list(orig, to_add, min_count):
     return orig
 
 
+def log_track(action, simtrack, paths, meta, sim=None):
+    ''' Log why a similar track was discarded, filtered, or used. Only call if debug logging is enabled. '''
+    _LOGGER.debug('%s ID:%d Path:%s Similarity:%f%s Meta:%s', action, simtrack['id'], paths[simtrack['id']], simtrack['sim'],
+                  '' if sim is None else ' AdjSim:%f' % sim, json.dumps(meta, cls=SetEncoder))
+
+
 def set_filtered(simtrack, paths, filtered_tracks, key):
     if simtrack['id'] in filtered_tracks['ids'][key] or (key=='attribs' and simtrack['id'] in filtered_tracks['ids']['meta']):
         return
@@ -287,6 +718,19 @@ def get_album_key(track):
     return '%s::%s' % (aa, track['album'])
 
 
+def get_collection_seeds(params, tdb, isPost):
+    ''' Get IDs of tracks on the album (seedartist and seedalbum), or by the artist (seedartist only), to seed a mix '''
+    artist = get_value(params, 'seedartist', None, isPost)
+    if artist is None or len(artist)==0:
+        return []
+    album = get_value(params, 'seedalbum', None, isPost)
+    track_ids = tdb.get_album_track_ids(artist, album) if album is not None and len(album)>0 else tdb.get_artist_track_ids(artist)
+    _LOGGER.debug('%d track(s) for seed artist:%s album:%s' % (len(track_ids), artist, album))
+    if len(track_ids)>MAX_COLLECTION_SEEDS:
+        track_ids = random.sample(track_ids, MAX_COLLECTION_SEEDS)
+    return track_ids
+
+
 def get_genre_cfg(config, params):
     ''' Get genre settings from URL or config '''
     genre_cfg={}
@@ -321,6 +765,28 @@ def get_essentia_cfg(config, params):
     return ess_cfg
 
 
+def get_weights(params, cfg, isPost):
+    ''' Get Bliss/Essentia feature weights from URL (e.g. weights=tempo:2,chroma:0.5) or config '''
+    weights = {}
+    for algo in ['bliss', 'essentia']:
+        if 'weights' in cfg[algo]:
+            weights.update(cfg[algo]['weights'])
+
+    val = get_value(params, 'weights', None, isPost)
+    if isinstance(val, dict):
+        weights.update(val)
+    elif val is not None and len(val)>0:
+        for item in val.split(','):
+            parts = item.split(':')
+            if len(parts)!=2:
+                raise ValueError('Invalid weight "%s"' % item)
+            weights[parts[0].strip()] = float(parts[1])
+
+    for key in weights:
+        weights[key] = float(weights[key])
+    return weights if len(weights)>0 else None
+
+
 def get_music_path(params, cfg):
     path = ''
     if 'mpath' in params and params['mpath'] is not None:
@@ -356,10 +822,11 @@ def dump_api():
     if len(params['track'])!=1:
         abort(400)
 
-    mus, mta = similarity_app.get_musly()
-    paths = similarity_app.get_paths()
-    cfg = similarity_app.get_config()
-    tdb = tracks_db.TracksDb(cfg)
+    gen = get_generation()
+    cfg = gen.get_request_config()
+    if cfg is None:
+        loading()
+    paths = gen.paths
     genre_cfg = get_genre_cfg(cfg, params)
     ess_cfg = get_essentia_cfg(cfg, params)
 
@@ -375,6 +842,12 @@ def dump_api():
     no_genre_match_adj = int(get_value(params, 'nogenrematchadj', DEFAULT_NO_GENRE_MATCH_ADJUSTMENT, isPost))/100.0
     genre_group_adj = int(get_value(params, 'genregroupadj', DEFAULT_GENRE_GROUP_MATCH_ADJUSTMENT, isPost))/100.0
     count = int(get_value(params, 'count', 1000, isPost))
+    try:
+        weights = get_weights(params, cfg, isPost)
+    except (TypeError, ValueError) as e:
+        _LOGGER.error(str(e))
+        abort(400)
+    deadline = get_deadline(params, cfg, isPost)
     fmt = get_value(params, 'format', '', isPost)
     txt = fmt=='text'
     txt_url = fmt=='text-url'
@@ -382,6 +855,7 @@ def dump_api():
 
     # Check that musly knows about this track
     track_id = -1
+    tdb = tracks_db.TracksDb(cfg)
     try:
         track_id = paths.index( track )
         if track_id<0:
@@ -389,15 +863,13 @@ def dump_api():
 
         if not raw:
             meta = tdb.get_track(track_id+1) # IDs (rowid) in SQLite are 1.. musly is 0..
-            all_genres = genre_cfg['all_genres'] if 'all_genres' in genre_cfg else None
-            acceptable_genres=set()
-            if 'genres' in meta:
-                acceptable_genres.update(meta['genres'])
-                if 'genres' in genre_cfg:
-                    for genre in meta['genres']:
-                        for group in genre_cfg['genres']:
-                            if genre in group:
-                                acceptable_genres.update(group)
+            # Genres are bitsets, see TrackMeta
+            seed_genres = gen.meta.genre_bits[track_id]
+            all_genres = None
+            acceptable_genres = seed_genres.copy()
+            if 'genres' in genre_cfg:
+                all_genres = gen.partitions.all_genres(genre_cfg['genres'])
+                acceptable_genres |= gen.partitions.expand(genre_cfg['genres'], seed_genres)
 
         num_sim = count * 50
         if num_sim<MIN_NUM_SIM:
@@ -405,15 +877,23 @@ def dump_api():
         if num_sim>len(paths):
             num_sim = len(paths)
 
-        simtracks = get_similars(track_id, mus, num_sim, mta, tdb, cfg)
+        simtracks = get_similars(track_id, gen, num_sim, cfg, weights)
+        if not raw:
+            genre_adj = gen.meta.genre_adjust(numpy.array([simtrack['id'] for simtrack in simtracks], dtype=numpy.int64), seed_genres,
+                                                acceptable_genres, all_genres, no_genre_match_adj, genre_group_adj)
 
         resp=[]
         prev_id=-1
 
         tracks=[]
-        for simtrack in simtracks:
+        truncated = False
+        for pos, simtrack in enumerate(simtracks):
             if simtrack['id']==prev_id:
                 break
+            if len(tracks)>0 and expired(deadline):
+                _LOGGER.debug('Deadline reached, after %d track(s)' % len(tracks))
+                truncated = True
+                break
             prev_id=simtrack['id']
             if math.isnan(simtrack['sim']):
                 continue
@@ -429,7 +909,7 @@ def dump_api():
                 if simtrack['id']!=track_id and 'title' in track and 'title' in meta and track['title'] == meta['title']:
                     continue
 
-                sim = simtrack['sim'] + genre_adjust(meta, track, acceptable_genres, all_genres, no_genre_match_adj, genre_group_adj)
+                sim = simtrack['sim'] + genre_adj[pos]
                 tracks.append({'path':paths[simtrack['id']], 'sim':sim})
             if len(tracks)==MIN_NUM_SIM:
                 break
@@ -450,12 +930,14 @@ def dump_api():
                 break
 
         if txt or txt_url:
-            return '\n'.join(resp)
+            return truncated_response('\n'.join(resp), truncated)
         else:
-            return json.dumps(resp)
+            return truncated_response(json.dumps(resp), truncated)
     except Exception as e:
         _LOGGER.error("EX:%s" % str(e))
         abort(404)
+    finally:
+        tdb.close()
 
 
 @similarity_app.route('/api/attrmix', methods=['GET', 'POST'])
@@ -472,7 +954,7 @@ def attrmix_api():
         abort(400)
 
     cfg = similarity_app.get_config()
-    tdb = tracks_db.TracksDb(cfg)
+    meta = get_generation().meta
 
     if not cfg['essentia']['enabled'] or not cfg['essentia']['highlevel']:
         _LOGGER.error('Essentia highlevel not supported/enabled')
@@ -482,6 +964,7 @@ def attrmix_api():
     if count<1:
         _LOGGER.error('Count must be higher than 0')
         abort(400)
+    deadline = get_deadline(params, cfg, isPost)
 
     req_filters=[]
 
@@ -493,10 +976,8 @@ def attrmix_api():
             maxv=minv
             minv=x
 
-        if minv>0:
-            req_filters.append('%s >= %d' % (attr, minv))
-        if maxv>0:
-            req_filters.append('%s <= %d' % (attr, maxv))
+        if minv>0 or maxv>0:
+            req_filters.append((attr, minv if minv>0 else None, maxv if maxv>0 else None))
 
 
     for attr in tracks_db.ESSENTIA_HIGHLEVEL_ATTRIBS:
@@ -512,9 +993,9 @@ def attrmix_api():
             val = int(strval)/100.0
 
         if val>0.0 and val<0.5:
-            req_filters.append('%s <= %.1f' % (attr, val))
+            req_filters.append((attr, None, round(val, 1)))
         elif val>0.5:
-            req_filters.append('%s >= %.1f' % (attr, val))
+            req_filters.append((attr, round(val, 1), None))
 
     if len(req_filters)<1:
         _LOGGER.error('No filters supplied')
@@ -526,24 +1007,30 @@ def attrmix_api():
     no_repeat_artist = int(get_value(params, 'norepart', 5, isPost))
     no_repeat_album = int(get_value(params, 'norepalb', 5, isPost))
 
+    tdb = tracks_db.TracksDb(cfg)
     try:
         genres = set(params['genre']) if 'genre' in params else None
         exclude_christmas = int(get_value(params, 'filterxmas', '0', isPost))==1 and datetime.now().month!=12
-        rows = tdb.get_track_ids(req_filters)
+        # Matching tracks, in a random order, from in-memory columns
+        track_ids = meta.select(req_filters)
+        if genres is not None and len(genres)>0:
+            # Tracks without a genre are not filtered out
+            track_ids = track_ids[meta.no_genre[track_ids] | track_meta.has_genre(meta.genre_bits[track_ids], meta.genre_mask(genres))]
+        if exclude_christmas:
+            track_ids = track_ids[~meta.christmas[track_ids]]
         selected_tracks = []
         resp = []
         artist_map = {} # Map of artist -> last index
         album_map = {}  # Map of album -> last index
         titles = set()
-        _LOGGER.debug('Num rows: %d' % len(rows))
-        for row in rows:
-            track = tdb.get_track(row[0], True)
-            if genres is not None and not filters.genre_matches({}, genres, track):
-                _LOGGER.debug('DISCARD(genre) %s' % json.dumps(track, cls=SetEncoder))
-                continue
-            if exclude_christmas and filters.is_christmas(track):
-                 _LOGGER.debug('DISCARD(christmas) %s' % json.dumps(track, cls=SetEncoder))
-                 continue
+        truncated = False
+        _LOGGER.debug('Num rows: %d' % len(track_ids))
+        for track_id in track_ids.tolist():
+            if len(resp)>0 and expired(deadline):
+                _LOGGER.debug('Deadline reached, after %d track(s)' % len(resp))
+                truncated = True
+                break
+            track = tdb.get_track(track_id+1, True) # IDs (rowid) in SQLite are 1..
             if track['title'] in titles:
                 _LOGGER.debug('DISCARD(title) %s' % json.dumps(track, cls=SetEncoder))
                 continue
@@ -569,37 +1056,32 @@ def attrmix_api():
             titles.add(track['title'])
 
         if get_value(params, 'format', '', isPost)=='text':
-            return '\n'.join(resp)
+            return truncated_response('\n'.join(resp), truncated)
         else:
-            return json.dumps(resp)
+            return truncated_response(json.dumps(resp), truncated)
 
     except Exception as e:
         _LOGGER.error("EX:%s" % str(e))
         abort(404)
+    finally:
+        tdb.close()
 
 
-@similarity_app.route('/api/similar', methods=['GET', 'POST'])
-def similar_api():
-    isPost = False
-    if request.method=='GET':
-        params = request.args.to_dict(flat=False)
-    else:
-        isPost = True
-        params = request.get_json()
-        _LOGGER.debug('Request: %s' % json.dumps(params))
-
-    if not params:
-        abort(400)
-
-    if not 'track' in params:
-        abort(400)
-
+def get_similar_mix(params, isPost, gen, cfg):
+    '''
+    Search for, and filter, tracks similar to the seeds of a similarity request. Random choices are left to the caller,
+    as these results may be shared by identical requests.
+    '''
+    stages = metrics.Stages()
+    # Only format per-track log messages if these will be output
+    debug = _LOGGER.isEnabledFor(logging.DEBUG)
     count = int(get_value(params, 'count', DEFAULT_TRACKS_TO_RETURN, isPost))
     if count < MIN_TRACKS_TO_RETURN:
         count = MIN_TRACKS_TO_RETURN
     elif count > MAX_TRACKS_TO_RETURN:
         count = MAX_TRACKS_TO_RETURN
 
+    centroid = int(get_value(params, 'centroid', '0', isPost))==1
     match_genre = int(get_value(params, 'filtergenre', '0', isPost))==1
     shuffle = int(get_value(params, 'shuffle', '1', isPost))==1
     max_similarity = int(get_value(params, 'maxsim', 75, isPost))/100.0
@@ -619,16 +1101,25 @@ def similar_api():
     if no_repeat_album<0 or no_repeat_album>200:
         no_repeat_album = DEFAULT_NUM_PREV_TRACKS_FILTER_ALBUM
 
-    mus, mta = similarity_app.get_musly()
-    paths = similarity_app.get_paths()
-    cfg = similarity_app.get_config()
-    tdb = tracks_db.TracksDb(cfg)
+    deadline = get_deadline(params, cfg, isPost)
+    paths = gen.paths
     genre_cfg = get_genre_cfg(cfg, params)
     ess_cfg = get_essentia_cfg(cfg, params)
+    try:
+        weights = get_weights(params, cfg, isPost)
+    except (TypeError, ValueError) as e:
+        _LOGGER.error(str(e))
+        abort(400)
+    sid = get_value(params, 'session', None, isPost) if similarity_app.sessions is not None else None
+    if sid is not None and not isinstance(sid, str):
+        _LOGGER.error('Invalid session ID')
+        abort(400)
+    tdb = tracks_db.TracksDb(cfg)
 
     # Strip LMS root path from track path
     root = get_music_path(params, cfg)
-    _LOGGER.debug('Music root: %s' % root)
+    _LOGGER.debug('Music root: %s', root)
+    stages.mark('decode')
 
     # Similar tracks
     similar_tracks=[]
@@ -644,48 +1135,94 @@ def similar_api():
     skip_track_ids = set()
 
     track_id_seed_metadata={} # Map from seed track's ID to its metadata
-    acceptable_genres=set()
-    seed_genres=set()
-    all_genres = genre_cfg['all_genres'] if 'all_genres' in genre_cfg else None
+    # Genres are bitsets, see TrackMeta
+    have_groups = 'genres' in genre_cfg
+    acceptable_genres = gen.meta.genre_mask([])
+    seed_genres = gen.meta.genre_mask([])
+    all_genres = gen.partitions.all_genres(genre_cfg['genres']) if have_groups else None
 
     if min_duration>0 or max_duration>0:
-        _LOGGER.debug('Duration:%d .. %d' % (min_duration, max_duration))
+        _LOGGER.debug('Duration:%d .. %d', min_duration, max_duration)
 
-    have_prev_tracks = 'previous' in params
-    # Musly IDs of seed tracks
+    # Previous tracks (as sessions.filter_entry), most recent first. Those of a session follow any in the request.
+    prev_tracks = []
+    for trk in params['previous'] if 'previous' in params else []:
+        track = decode(trk, root)
+        _LOGGER.debug('I TRACK %s -> %s', trk, track)
+
+        # Check that musly knows about this track
+        track_id = -1
+        try:
+            track_id = paths.index(track)
+        except:
+            pass
+        if track_id is not None and track_id>=0:
+            meta = tdb.get_track(track_id+1) # IDs (rowid) in SQLite are 1.. musly is 0..
+            prev_tracks.append(sessions.filter_entry(track_id, track, meta, get_album_key(meta) if meta else None))
+        else:
+            _LOGGER.debug('Could not locate %s in DB', track)
+            prev_tracks.append(sessions.filter_entry(-1, track, None, None))
+    if sid is not None:
+        # LMS may send tracks the session already has, so remove duplicates - but keep order
+        prev_paths = set()
+        merged = []
+        for prev in prev_tracks + similarity_app.sessions.get_recent(sid, gen):
+            if not prev['path'] in prev_paths:
+                prev_paths.add(prev['path'])
+                merged.append(prev)
+        prev_tracks = merged
+        _LOGGER.debug('Session %s, %d previous track(s)', sid, len(prev_tracks))
+
+    have_prev_tracks = len(prev_tracks)>0
+    # Musly IDs of seed tracks, and their weights for centroid queries
     track_ids = []
+    seed_weights = []
     trk_count = 0
-    add_file_protocol = params['track'][0].startswith('file://')
+    add_file_protocol = 'track' in params and params['track'][0].startswith('file://')
 
-    for trk in params['track']:
+    seeds = []
+    for trk in params['track'] if 'track' in params else []:
         track = decode(trk, root)
-        _LOGGER.debug('S TRACK %s -> %s' % (trk, track))
+        _LOGGER.debug('S TRACK %s -> %s', trk, track)
 
         # Check that musly knows about this track
         track_id = -1
         try:
             track_id = paths.index( track )
-            _LOGGER.debug('Get %d similar track(s) to %s, index: %d' % (count, track, track_id))
+            _LOGGER.debug('Get %d similar track(s) to %s, index: %d', count, track, track_id)
         except:
             pass
-        if track_id is not None and track_id>=0 and track_id not in track_ids:
+        if track_id is not None and track_id>=0:
+            # Seeds are listed most recent first, so weight earlier ones higher
+            seeds.append((track_id, CENTROID_RECENCY_DECAY**len(seeds)))
+        else:
+            _LOGGER.debug('Could not locate %s in DB', track)
+
+    track_seeds = [track_id for track_id, _ in seeds]
+
+    # All tracks of an album or artist count as much as one seed track
+    collection_ids = get_collection_seeds(params, tdb, isPost)
+    if len(collection_ids)>0:
+        centroid = True
+        seeds += [(track_id, 1.0/len(collection_ids)) for track_id in collection_ids]
+
+    for track_id, seed_weight in seeds:
+        if track_id not in track_ids:
             track_ids.append(track_id)
+            seed_weights.append(seed_weight)
             skip_track_ids.add(track_id)
             meta = tdb.get_track(track_id+1) # IDs (rowid) in SQLite are 1.. musly is 0..
-            _LOGGER.debug('Seed %d metadata:%s' % (track_id, json.dumps(meta, cls=SetEncoder)))
+            if debug:
+                _LOGGER.debug('Seed %d metadata:%s', track_id, json.dumps(meta, cls=SetEncoder))
             if meta is not None:
                 track_id_seed_metadata[track_id]=meta
                 # Get genres for this seed track - this takes its genres and gets any matching genres from config
-                if 'genres' in meta:
-                    seed_genres.update(meta['genres'])
-                    # Only add genres from configured groups to acceptable_genres
-                    #acceptable_genres.update(meta['genres'])
-                    if 'genres' in genre_cfg:
-                        for genre in meta['genres']:
-                            for group in genre_cfg['genres']:
-                                if genre in group:
-                                    acceptable_genres.update(group)
-                                    seed_genres.update(group)
+                seed_genres |= gen.meta.genre_bits[track_id]
+                # Only add genres from configured groups to acceptable_genres
+                if have_groups:
+                    group_genres = gen.partitions.expand(genre_cfg['genres'], gen.meta.genre_bits[track_id])
+                    acceptable_genres |= group_genres
+                    seed_genres |= group_genres
                 if 'title' in meta:
                     filter_out['titles'].add(meta['title'])
                 if not have_prev_tracks:
@@ -696,50 +1233,26 @@ def similar_api():
                         if akey is not None:
                             filter_out['albums'].add(akey)
             trk_count += 1
-        else:
-            _LOGGER.debug('Could not locate %s in DB' % track)
 
-    if have_prev_tracks:
-        trk_count = 0
-        for trk in params['previous']:
-            track = decode(trk, root)
-            _LOGGER.debug('I TRACK %s -> %s' % (trk, track))
-
-            # Check that musly knows about this track
-            track_id = -1
-            try:
-                track_id = paths.index(track)
-            except:
-                pass
-            if track_id is not None and track_id>=0:
-                skip_track_ids.add(track_id)
-                meta = tdb.get_track(track_id+1) # IDs (rowid) in SQLite are 1.. musly is 0..
-                if meta:
-                    if 'title' in meta:
-                        filter_out['titles'].add(meta['title'])
-                    if trk_count<no_repeat_artist:
-                        filter_out['artists'].add(meta['artist'])
-                    if trk_count<no_repeat_album:
-                        akey = get_album_key(meta)
-                        if akey is not None:
-                            filter_out['albums'].add(akey)
-                    if match_genre:
-                        # Get genres for this track - this takes its genres and gets any matching genres from config
-                        if 'genres' in meta:
-                            # Only add genres from configured groups to acceptable_genres
-                            #acceptable_genres.update(meta['genres'])
-                            if 'genres' in genre_cfg:
-                                for genre in meta['genres']:
-                                    for group in genre_cfg['genres']:
-                                        if genre in group:
-                                            acceptable_genres.update(group)
-            else:
-                _LOGGER.debug('Could not locate %s in DB' % track)
-            trk_count += 1
-
-    _LOGGER.debug('Seed genres: %s' % seed_genres)
-    if match_genre and len(acceptable_genres)>0:
-        _LOGGER.debug('Acceptable genres: %s' % acceptable_genres)
+    for trk_count, prev in enumerate(prev_tracks):
+        if prev['id']<0:
+            continue
+        skip_track_ids.add(prev['id'])
+        if 'artist' in prev:
+            if 'title' in prev:
+                filter_out['titles'].add(prev['title'])
+            if trk_count<no_repeat_artist:
+                filter_out['artists'].add(prev['artist'])
+            if trk_count<no_repeat_album and prev['album'] is not None:
+                filter_out['albums'].add(prev['album'])
+            if match_genre and have_groups:
+                # Get genres for this track - this takes its genres and gets any matching genres from config
+                acceptable_genres |= gen.partitions.expand(genre_cfg['genres'], gen.meta.genre_bits[prev['id']])
+
+    if debug:
+        _LOGGER.debug('Seed genres: %s', gen.meta.mask_genres(seed_genres))
+        if match_genre and acceptable_genres.any():
+            _LOGGER.debug('Acceptable genres: %s', gen.meta.mask_genres(acceptable_genres))
 
     similarity_count = int(count * SHUFFLE_FACTOR) if shuffle and (count<20 or len(track_ids)<10) else count
     # If only 1 seed then get more tracks to increase randomness
@@ -747,121 +1260,281 @@ def similar_api():
         similarity_count *= 2
     tracks_per_seed = int(similarity_count*2.5) if similarity_count<15 else similarity_count
 
-    num_sim = count * len(track_ids) * 50
-    if num_sim<MIN_NUM_SIM:
-        num_sim = MIN_NUM_SIM
-    if num_sim>len(paths):
-        num_sim = len(paths)
+    # In centroid mode there is a single query, from the weighted centroid of all seeds. Filters that compare
+    # against a seed then use the most recent seed, but with the genres of all seeds.
+    centroid = centroid and len(track_ids)>1
+    query_ids = track_ids[:1] if centroid else track_ids
+    query_genres = {track_id:gen.meta.genre_bits[track_id] for track_id in track_ids}
+    if centroid:
+        query_genres[track_ids[0]] = numpy.bitwise_or.reduce(gen.meta.genre_bits[track_ids], axis=0)
 
     matched_artists={}
     artist_max_sim = 0.01 if cfg['bliss']['enabled'] else 0.1
-    for track_id in track_ids:
-        # Query musly and/or essentia for similar tracks
-        simtracks = get_similars(track_id, mus, num_sim, mta, tdb, cfg)
+    # If filtering on genre, then only need to search the partitions containing acceptable genres
+    partitions = None
+    if match_genre and have_groups and (cfg['simalgo']=='bliss' or cfg['simalgo']=='essentia'):
+        partitions = gen.partitions.select(genre_cfg['genres'], acceptable_genres)
+        if debug:
+            _LOGGER.debug('Genre partitions: %d, tracks: %d', len(partitions), sum([len(p[1]) for p in partitions]))
+
+    # For Bliss and Essentia searches are deepened if too many tracks are filtered out, see get_search
+    deepen = cfg['simalgo']=='bliss' or cfg['simalgo']=='essentia'
+    search = get_search(gen, cfg, count, len(query_ids), partitions, min_duration, max_duration, exclude_christmas, weights)
+    num_sim = search['num_sim']
+    eligible = search['eligible']
+    search_key = search['key']
+
+    stages.mark('seeds')
+
+    # Query musly and/or essentia for similar tracks
+    if centroid:
+        seed_simtracks = [get_centroid_similars(track_ids, seed_weights, gen, num_sim, cfg, weights, partitions, eligible)]
+    else:
+        seed_simtracks = get_seed_similars(sid, track_ids, gen, num_sim, cfg, weights, partitions, eligible, search_key)
+    stages.mark('query')
+    funnels = []
+    metas = {} # Metadata of candidate tracks, read in batches
+    # Once the deadline is reached, and some tracks have been accepted, no more seeds are examined (or searches deepened)
+    # and the mix is made from the tracks accepted so far.
+    truncated = False
+    for track_id, simtracks in zip(query_ids, seed_simtracks):
+        if len(similar_tracks)>0 and expired(deadline):
+            _LOGGER.debug('Deadline reached, before seed %d', track_id)
+            truncated = True
+            break
         accepted_tracks = 0
-        for simtrack in simtracks:
-            if math.isnan(simtrack['sim']):
-                continue
-            if simtrack['sim']>max_similarity:
-                break
-
-            if (simtrack['sim']>0.0) and (simtrack['sim']<=max_similarity) and (not simtrack['id'] in skip_track_ids):
-                prev_idx = similar_track_positions[simtrack['id']] if simtrack['id'] in similar_track_positions else -1
-                meta = similar_tracks[prev_idx] if prev_idx>=0 else tdb.get_track(simtrack['id']+1) # IDs (rowid) in SQLite are 1.. musly is 0..
-                filtered_due_to = None
-                if prev_idx>=0:
-                    # Seen from previous seed, so set similarity to lowest value
-                    sim = simtrack['sim'] + genre_adjust(track_id_seed_metadata[track_id], meta, seed_genres, all_genres, no_genre_match_adj, genre_group_adj)
-                    if similar_tracks[prev_idx]['similarity']>sim:
-                        _LOGGER.debug('SEEN %d before, prev:%f, current:%f' % (simtrack['id'], similar_tracks[prev_idx]['similarity'], sim))
-                        similar_tracks[prev_idx]['similarity']=sim
-                elif not meta:
-                    _LOGGER.debug('DISCARD(not found) ID:%d Path:%s Similarity:%f' % (simtrack['id'], paths[simtrack['id']], simtrack['sim']))
-                    skip_track_ids.add(simtrack['id'])
-                elif meta['ignore']:
-                    _LOGGER.debug('DISCARD(ignore) ID:%d Path:%s Similarity:%f Meta:%s' % (simtrack['id'], paths[simtrack['id']], simtrack['sim'], json.dumps(meta, cls=SetEncoder)))
-                    skip_track_ids.add(simtrack['id'])
-                elif (min_duration>0 or max_duration>0) and not filters.check_duration(min_duration, max_duration, meta):
-                    _LOGGER.debug('DISCARD(duration) ID:%d Path:%s Similarity:%f Meta:%s' % (simtrack['id'], paths[simtrack['id']], simtrack['sim'], json.dumps(meta, cls=SetEncoder)))
-                    skip_track_ids.add(simtrack['id'])
-                elif match_genre and not filters.genre_matches(genre_cfg, acceptable_genres, meta):
-                    _LOGGER.debug('DISCARD(genre) ID:%d Path:%s Similarity:%f Meta:%s' % (simtrack['id'], paths[simtrack['id']], simtrack['sim'], json.dumps(meta, cls=SetEncoder)))
-                    skip_track_ids.add(simtrack['id'])
-                elif exclude_christmas and filters.is_christmas(meta):
-                    _LOGGER.debug('DISCARD(xmas) ID:%d Path:%s Similarity:%f Meta:%s' % (simtrack['id'], paths[simtrack['id']], simtrack['sim'], json.dumps(meta, cls=SetEncoder)))
-                    skip_track_ids.add(simtrack['id'])
-                else:
-                    if (ess_cfg['enabled'] or cfg['bliss']['enabled']) and bpm_max_diff is not None and bpm_max_diff>0 and bpm_max_diff<150:
-                        filtered_due_to = filters.check_bpm(track_id_seed_metadata[track_id], meta, bpm_max_diff)
-                        if filtered_due_to is not None:
-                            _LOGGER.debug('FILTERED(attribs(%s)) ID:%d Path:%s Similarity:%f Meta:%s' % (filtered_due_to, simtrack['id'], paths[simtrack['id']], simtrack['sim'], json.dumps(meta, cls=SetEncoder)))
-                            set_filtered(simtrack, paths, filtered_tracks, 'attribs')
-                            continue
-
-                    if ess_cfg['enabled']:
-                        if filter_on_key:
-                            filtered_due_to = filters.check_key(track_id_seed_metadata[track_id], meta, ess_cfg)
-                        if filtered_due_to is None and filter_on_attribs:
-                            filtered_due_to = filters.check_attribs(track_id_seed_metadata[track_id], meta, ess_cfg)
-                        if filtered_due_to is not None:
-                            _LOGGER.debug('FILTERED(attribs(%s)) ID:%d Path:%s Similarity:%f Meta:%s' % (filtered_due_to, simtrack['id'], paths[simtrack['id']], simtrack['sim'], json.dumps(meta, cls=SetEncoder)))
-                            set_filtered(simtrack, paths, filtered_tracks, 'attribs')
+        seed_num_sim = num_sim
+        examined = set()
+        funnel = trace.Funnel(track_id, num_sim)
+        funnels.append(funnel)
+        while True:
+            # Fewer tracks than asked for implies there are no more to be found
+            finished = not deepen or seed_num_sim>=len(paths) or len(simtracks)<seed_num_sim
+            # Check genres for all tracks in one go
+            sim_ids = numpy.array([simtrack['id'] for simtrack in simtracks], dtype=numpy.int64)
+            genre_ok = gen.meta.genre_matches(sim_ids, acceptable_genres, all_genres) if match_genre else None
+            genre_adj = gen.meta.genre_adjust(sim_ids, query_genres[track_id], seed_genres, all_genres, no_genre_match_adj, genre_group_adj)
+            for pos, simtrack in enumerate(simtracks):
+                if simtrack['id'] in examined:
+                    continue
+                examined.add(simtrack['id'])
+                if math.isnan(simtrack['sim']):
+                    continue
+                if simtrack['sim']>max_similarity:
+                    finished = True
+                    break
+
+                if (simtrack['sim']>0.0) and (simtrack['sim']<=max_similarity) and (not simtrack['id'] in skip_track_ids):
+                    prev_idx = similar_track_positions[simtrack['id']] if simtrack['id'] in similar_track_positions else -1
+                    if prev_idx>=0:
+                        meta = similar_tracks[prev_idx]
+                    else:
+                        if not simtrack['id'] in metas:
+                            # Read metadata for the next few candidates in one query, rather than one at a time
+                            get_timed_tracks(tdb, [t['id'] for t in simtracks[pos:pos+META_BATCH_SIZE] if not t['id'] in metas], metas, stages)
+                        meta = metas[simtrack['id']]
+                    filtered_due_to = None
+                    if prev_idx>=0:
+                        # Seen from previous seed, so set similarity to lowest value
+                        sim = simtrack['sim'] + genre_adj[pos]
+                        if similar_tracks[prev_idx]['similarity']>sim:
+                            if debug:
+                                _LOGGER.debug('SEEN %d before, prev:%f, current:%f', simtrack['id'], similar_tracks[prev_idx]['similarity'], sim)
+                            similar_tracks[prev_idx]['similarity']=sim
+                    elif not meta:
+                        if debug:
+                            _LOGGER.debug('DISCARD(not found) ID:%d Path:%s Similarity:%f', simtrack['id'], paths[simtrack['id']], simtrack['sim'])
+                        funnel.reasons['notfound'] += 1
+                        skip_track_ids.add(simtrack['id'])
+                    elif eligible is None and meta['ignore']:
+                        if debug:
+                            log_track('DISCARD(ignore)', simtrack, paths, meta)
+                        funnel.reasons['ignore'] += 1
+                        skip_track_ids.add(simtrack['id'])
+                    elif eligible is None and (min_duration>0 or max_duration>0) and not filters.check_duration(min_duration, max_duration, meta):
+                        if debug:
+                            log_track('DISCARD(duration)', simtrack, paths, meta)
+                        funnel.reasons['duration'] += 1
+                        skip_track_ids.add(simtrack['id'])
+                    elif match_genre and not genre_ok[pos]:
+                        if debug:
+                            log_track('DISCARD(genre)', simtrack, paths, meta)
+                        funnel.reasons['genre'] += 1
+                        skip_track_ids.add(simtrack['id'])
+                    elif eligible is None and exclude_christmas and filters.is_christmas(meta):
+                        if debug:
+                            log_track('DISCARD(xmas)', simtrack, paths, meta)
+                        funnel.reasons['xmas'] += 1
+                        skip_track_ids.add(simtrack['id'])
+                    else:
+                        if (ess_cfg['enabled'] or cfg['bliss']['enabled']) and bpm_max_diff is not None and bpm_max_diff>0 and bpm_max_diff<150:
+                            filtered_due_to = filters.check_bpm(track_id_seed_metadata[track_id], meta, bpm_max_diff)
+                            if filtered_due_to is not None:
+                                if debug:
+                                    log_track('FILTERED(attribs(%s))' % filtered_due_to, simtrack, paths, meta)
+                                funnel.reasons['attribs'] += 1
+                                set_filtered(simtrack, paths, filtered_tracks, 'attribs')
+                                continue
+
+                        if ess_cfg['enabled']:
+                            if filter_on_key:
+                                filtered_due_to = filters.check_key(track_id_seed_metadata[track_id], meta, ess_cfg)
+                            if filtered_due_to is None and filter_on_attribs:
+                                filtered_due_to = filters.check_attribs(track_id_seed_metadata[track_id], meta, ess_cfg)
+                            if filtered_due_to is not None:
+                                if debug:
+                                    log_track('FILTERED(attribs(%s))' % filtered_due_to, simtrack, paths, meta)
+                                funnel.reasons['attribs'] += 1
+                                set_filtered(simtrack, paths, filtered_tracks, 'attribs')
+                                continue
+
+                        if no_repeat_artist>0:
+                            if meta['artist'] in filter_out['artists']:
+                                if debug:
+                                    log_track('FILTERED(artist)', simtrack, paths, meta)
+                                funnel.reasons['artist'] += 1
+                                set_filtered(simtrack, paths, filtered_tracks, 'meta')
+
+                                if meta['artist'] in matched_artists and len(matched_artists[meta['artist']]['tracks'])<5 and simtrack['sim'] - matched_artists[meta['artist']]['similarity'] <= artist_max_sim:
+                                    # Only add this track as a possibility if album not in previous
+                                    akey = get_album_key(meta)
+                                    if akey is None or akey not in filter_out['albums']:
+                                        matched_artists[meta['artist']]['tracks'].append({'path':paths[simtrack['id']], 'id':simtrack['id'], 'similarity':simtrack['sim']})
+                                continue
+
+                        if no_repeat_album>0:
+                            akey = get_album_key(meta)
+                            if akey is not None and akey in filter_out['albums']:
+                                if debug:
+                                    log_track('FILTERED(album)', simtrack, paths, meta)
+                                funnel.reasons['album'] += 1
+                                set_filtered(simtrack, paths, filtered_tracks, 'meta')
+                                continue
+
+                        if 'title' in meta and meta['title'] in filter_out['titles']:
+                            if debug:
+                                log_track('FILTERED(title)', simtrack, paths, meta)
+                            funnel.reasons['title'] += 1
+                            set_filtered(simtrack, paths, filtered_tracks, 'meta')
                             continue
 
-                    if no_repeat_artist>0:
-                        if meta['artist'] in filter_out['artists']:
-                            _LOGGER.debug('FILTERED(artist) ID:%d Path:%s Similarity:%f Meta:%s' % (simtrack['id'], paths[simtrack['id']], simtrack['sim'], json.dumps(meta, cls=SetEncoder)))
-                            set_filtered(simtrack, paths, filtered_tracks, 'meta')
+                        key = '%s::%s::%s' % (meta['artist'], meta['album'], meta['albumartist'] if 'albumartist' in meta and meta['albumartist'] is not None else '')
+                        sim = simtrack['sim'] + genre_adj[pos]
+
+                        if debug:
+                            log_track('USABLE', simtrack, paths, meta, sim)
+                        similar_tracks.append({'path':paths[simtrack['id']], 'id':simtrack['id'], 'similarity':sim})
+                        # Keep list of all tracks of an artist, so that we can randomly select one => we don't always use the same one
+                        matched_artists[meta['artist']]={'similarity':simtrack['sim'], 'tracks':[{'path':paths[simtrack['id']], 'id':simtrack['id'], 'similarity':sim}], 'pos':len(similar_tracks)-1}
+                        if 'title' in meta:
+                            filter_out['titles'].add(meta['title'])
+
+                        if no_repeat_album>0:
+                            akey = get_album_key(meta)
+                            if akey is not None:
+                                filter_out['albums'].add(akey)
+                        if no_repeat_artist>0:
+                            filter_out['artists'].add(meta['artist'])
+
+                        accepted_tracks += 1
+                        funnel.accepted += 1
+                        # Save mapping of this ID to its position in similar_tracks so that we can determine if we have
+                        # seen this track before.
+                        similar_track_positions[simtrack['id']]=len(similar_tracks)-1
+                        if accepted_tracks>=tracks_per_seed:
+                            finished = True
+                            break
+            funnel.examined = len(examined)
+            if finished:
+                break
+            if len(similar_tracks)>0 and expired(deadline):
+                _LOGGER.debug('Deadline reached, %d track(s) accepted for %d', accepted_tracks, track_id)
+                truncated = True
+                break
+            seed_num_sim = min(seed_num_sim*2, len(paths))
+            funnel.num_sim = seed_num_sim
+            funnel.searches += 1
+            _LOGGER.debug('%d track(s) accepted for %d, asking for %d similar tracks', accepted_tracks, track_id, seed_num_sim)
+            start = time.perf_counter()
+            if centroid:
+                simtracks = get_centroid_similars(track_ids, seed_weights, gen, seed_num_sim, cfg, weights, partitions, eligible)
+            else:
+                simtracks = get_seed_similars(sid, [track_id], gen, seed_num_sim, cfg, weights, partitions, eligible, search_key)[0]
+            stages.add('query', time.perf_counter()-start)
+    stages.mark('filter')
 
-                            if meta['artist'] in matched_artists and len(matched_artists[meta['artist']]['tracks'])<5 and simtrack['sim'] - matched_artists[meta['artist']]['similarity'] <= artist_max_sim:
-                                # Only add this track as a possibility if album not in previous
-                                akey = get_album_key(meta)
-                                if akey is None or akey not in filter_out['albums']:
-                                    matched_artists[meta['artist']]['tracks'].append({'path':paths[simtrack['id']], 'similarity':simtrack['sim']})
-                            continue
+    recent = None
+    if sid is not None:
+        # The seeds and previous tracks, for the session's next request
+        recent = [sessions.filter_entry(track_id, paths[track_id], track_id_seed_metadata.get(track_id),
+                    get_album_key(track_id_seed_metadata[track_id]) if track_id in track_id_seed_metadata else None) for track_id in track_seeds]
+        recent += prev_tracks
 
-                    if no_repeat_album>0:
-                        akey = get_album_key(meta)
-                        if akey is not None and akey in filter_out['albums']:
-                            _LOGGER.debug('FILTERED(album) ID:%d Path:%s Similarity:%f Meta:%s' % (simtrack['id'], paths[simtrack['id']], simtrack['sim'], json.dumps(meta, cls=SetEncoder)))
-                            set_filtered(simtrack, paths, filtered_tracks, 'meta')
-                            continue
+    tdb.close()
+    observe_stages(stages, cfg['simalgo'])
+    discards = collections.Counter()
+    for funnel in funnels:
+        discards.update(funnel.reasons)
+    request_metrics.inc_all('filtered_total', 'reason', discards)
+    return {'similar_tracks':similar_tracks, 'matched_artists':matched_artists, 'filtered_tracks':filtered_tracks,
+            'count':count, 'similarity_count':similarity_count, 'shuffle':shuffle, 'root':root,
+            'add_file_protocol':add_file_protocol, 'truncated':truncated, 'session':sid, 'recent':recent,
+            'num_sim':num_sim, 'funnels':funnels, 'stages':stages.times,
+            'search':None if centroid else search} # Not for centroid searches, as the next centroid will differ
+
+
+def trace_mix(mix, stages, gen, cfg, shared, returned):
+    ''' Write how the tracks of a mix were chosen, and how long each stage took, to the trace log '''
+    times = dict(mix['stages'])
+    times.update(stages.times)
+    similarity_app.trace_log.write({'generation':gen.number, 'simalgo':cfg['simalgo'], 'count':mix['count'],
+                                    'num_sim':mix['num_sim'], 'seeds':[funnel.to_dict() for funnel in mix['funnels']],
+                                    'stages':{stage:round(seconds*1000.0, 3) for stage, seconds in times.items()},
+                                    'shared':shared, 'truncated':mix['truncated'], 'returned':returned})
 
-                    if 'title' in meta and meta['title'] in filter_out['titles']:
-                        _LOGGER.debug('FILTERED(title) ID:%d Path:%s Similarity:%f Meta:%s' % (simtrack['id'], paths[simtrack['id']], simtrack['sim'], json.dumps(meta, cls=SetEncoder)))
-                        set_filtered(simtrack, paths, filtered_tracks, 'meta')
-                        continue
 
-                    key = '%s::%s::%s' % (meta['artist'], meta['album'], meta['albumartist'] if 'albumartist' in meta and meta['albumartist'] is not None else '')
-                    sim = simtrack['sim'] + genre_adjust(track_id_seed_metadata[track_id], meta, seed_genres, all_genres, no_genre_match_adj, genre_group_adj)
+@similarity_app.route('/api/similar', methods=['GET', 'POST'])
+def similar_api():
+    isPost = False
+    if request.method=='GET':
+        params = request.args.to_dict(flat=False)
+    else:
+        isPost = True
+        params = request.get_json()
+        _LOGGER.debug('Request: %s' % json.dumps(params))
 
-                    _LOGGER.debug('USABLE ID:%d Path:%s Similarity:%f AdjSim:%f Meta:%s' % (simtrack['id'], paths[simtrack['id']], simtrack['sim'], sim, json.dumps(meta, cls=SetEncoder)))
-                    similar_tracks.append({'path':paths[simtrack['id']], 'similarity':sim})
-                    # Keep list of all tracks of an artist, so that we can randomly select one => we don't always use the same one
-                    matched_artists[meta['artist']]={'similarity':simtrack['sim'], 'tracks':[{'path':paths[simtrack['id']], 'similarity':sim}], 'pos':len(similar_tracks)-1}
-                    if 'title' in meta:
-                        filter_out['titles'].add(meta['title'])
+    if not params:
+        abort(400)
 
-                    if no_repeat_album>0:
-                        akey = get_album_key(meta)
-                        if akey is not None:
-                            filter_out['albums'].add(akey)
-                    if no_repeat_artist>0:
-                        filter_out['artists'].add(meta['artist'])
+    if not 'track' in params and not 'seedartist' in params:
+        abort(400)
 
-                    accepted_tracks += 1
-                    # Save mapping of this ID to its position in similar_tracks so that we can determine if we have
-                    # seen this track before.
-                    similar_track_positions[simtrack['id']]=len(similar_tracks)-1
-                    if accepted_tracks>=tracks_per_seed:
-                        break
+    gen = get_generation()
+    cfg = gen.get_request_config()
+    if cfg is None:
+        loading()
+    # Identical concurrent requests share one search, but each caller makes its own random choices from its results
+    mix, shared = similar_requests.do((gen.number, get_request_key(params)), lambda: get_similar_mix(params, isPost, gen, cfg), release_worker_early)
+    stages = metrics.Stages()
+    if shared:
+        _LOGGER.debug('Using results of identical concurrent request')
+        request_metrics.inc('cache_hits_total', (('cache', 'coalesced'), ))
+    similar_tracks = [dict(track) for track in mix['similar_tracks']]
+    matched_artists = mix['matched_artists']
+    filtered_tracks = mix['filtered_tracks']
+    count = mix['count']
+    similarity_count = mix['similarity_count']
+    shuffle = mix['shuffle']
+    root = mix['root']
+    add_file_protocol = mix['add_file_protocol']
+    truncated = mix['truncated']
 
     # For each matched_artists randomly select a track...
     for matched in matched_artists:
         if len(matched_artists[matched]['tracks'])>1:
             _LOGGER.debug('Choosing random track for %s (%d tracks)' % (matched, len(matched_artists[matched]['tracks'])))
             sim = similar_tracks[matched_artists[matched]['pos']]['similarity']
-            similar_tracks[matched_artists[matched]['pos']] = random.choice(matched_artists[matched]['tracks'])
+            similar_tracks[matched_artists[matched]['pos']] = dict(random.choice(matched_artists[matched]['tracks']))
             similar_tracks[matched_artists[matched]['pos']]['similarity'] = sim
 
     # Too few tracks? Add some from the filtered lists
@@ -873,6 +1546,7 @@ def similar_api():
         if len(filtered_tracks[key])>0:
             _LOGGER.debug('Add some tracks from filtered_tracks::%s, %d/%d' % (key, len(similar_tracks), len(filtered_tracks[key])))
             similar_tracks = append_list(similar_tracks, filtered_tracks[key], min_count)
+    stages.mark('dedup')
 
     # Sort by similarity
     similar_tracks = sorted(similar_tracks, key=lambda k: k['similarity'])
@@ -885,16 +1559,28 @@ def similar_api():
     similar_tracks = similar_tracks[:count]
 
     track_list = []
+    debug = _LOGGER.isEnabledFor(logging.DEBUG)
     for track in similar_tracks:
         path = encode(root, track['path'], add_file_protocol)
         track_list.append(path)
-        _LOGGER.debug('Path:%s %f' % (path, track['similarity']))
+        if debug:
+            _LOGGER.debug('Path:%s %f' % (path, track['similarity']))
+    stages.mark('shuffle')
 
-    tdb.close()
     if get_value(params, 'format', '', isPost)=='text':
-        return '\n'.join(track_list)
+        body = '\n'.join(track_list)
     else:
-        return json.dumps(track_list)
+        body = json.dumps(track_list)
+    stages.mark('json')
+    observe_stages(stages, cfg['simalgo'])
+    if similarity_app.trace_log.wanted(get_value(params, 'trace', '0', isPost)=='1'):
+        trace_mix(mix, stages, gen, cfg, shared, len(track_list))
+
+    if mix['session'] is not None:
+        update_session(mix['session'], gen, cfg, similar_tracks, mix['recent'])
+    if similarity_app.prefetcher is not None and mix['search'] is not None:
+        prefetch_similars(gen, similar_tracks, mix['search'])
+    return truncated_response(body, truncated)
 
 
 @similarity_app.route('/api/config', methods=['GET'])
@@ -913,20 +1599,62 @@ def essentia_api():
     return f
 
 
-genre_list = None
+@similarity_app.route('/api/status', methods=['GET'])
+def status_api():
+    return json.dumps(similarity_app.get_status())
+
+
+@similarity_app.route('/api/metrics', methods=['GET'])
+def metrics_api():
+    status = similarity_app.get_status()
+    gauges = [('generation', (), status['generation']), ('tracks', (), status['tracks']), ('reloading', (), status['reloading']),
+              ('queue_running', (), status['queue']['running']), ('queue_waiting', (), status['queue']['waiting'])]
+    gauges += [('backend_ready', (('backend', backend), ), backend_status['state']==generation.BACKEND_READY)
+               for backend, backend_status in status['backends'].items()]
+    if 'sessions' in status:
+        gauges.append(('sessions', (), status['sessions']))
+    if 'prefetch' in status:
+        gauges += [('prefetch_cached', (), status['prefetch']['cached']), ('prefetch_pending', (), status['prefetch']['pending'])]
+    gauges += [('memory_bytes', (('component', component), ), usage['bytes']) for component, usage in status['memory']['indexes'].items()]
+    gauges.append(('db_connections', (), status['memory']['dbconnections']))
+    if status['memory']['process']['rss'] is not None:
+        gauges.append(('process_rss_bytes', (), status['memory']['process']['rss']))
+    return request_metrics.render(gauges), 200, {'Content-Type':metrics.CONTENT_TYPE}
+
+
+@similarity_app.route('/api/debug/profile', methods=['GET'])
+def profile_api():
+    cfg = similarity_app.get_config()
+    if not cfg['profile']['enabled']:
+        abort(404)
+    params = request.args.to_dict(flat=False)
+    seconds = min(float(get_value(params, 'seconds', DEFAULT_PROFILE_SECONDS, False)), cfg['profile']['maxseconds'])
+    interval = float(get_value(params, 'interval_ms', DEFAULT_PROFILE_INTERVAL_MS, False))/1000.0
+    _LOGGER.info('Profiling for %.1fs' % seconds)
+    result = request_profiler.run(seconds, interval)
+    if result is None:
+        return 'Already profiling', 409
+    stacks, samples = result
+    if get_value(params, 'format', '', False)=='collapsed':
+        return profiler.collapsed(stacks), 200, {'Content-Type':'text/plain; charset=utf-8'}
+    return json.dumps({'seconds':seconds, 'samples':samples, 'functions':profiler.hot_functions(stacks, PROFILE_TOP_FUNCTIONS)})
+
+
+@similarity_app.route('/api/reload', methods=['POST'])
+def reload_api():
+    if not similarity_app.reload():
+        return 'Already loading', 409
+    return 'Reloading', 202
+
+
 @similarity_app.route('/api/genres', methods=['GET'])
 def genres_api():
-    global genre_list
-    if genre_list is None:
-        cfg = similarity_app.get_config()
-        tdb = tracks_db.TracksDb(cfg)
-        genre_list = tdb.get_genres()
-    if genre_list is None:
-        abort(404)
-    return '\n'.join(genre_list)
+    return '\n'.join(get_generation().genre_list)
 
 
 def start_app(args, config, jukebox_path):
     similarity_app.init(args, config, jukebox_path)
+    if hasattr(signal, 'SIGHUP'):
+        signal.signal(signal.SIGHUP, lambda signum, frame: similarity_app.reload())
     _LOGGER.debug('Ready to process requests')
     similarity_app.run(host=config['host'], port=config['port'])
@@ -5,53 +5,36 @@
 # GPLv3 license.
 #
 
-import logging, pickle, math, numpy
-from scipy.spatial import cKDTree
-from . import bliss_analysis, tracks_db
+import logging, pickle, numpy
+from . import bliss_analysis, vector_sim
 
 _LOGGER = logging.getLogger(__name__)
 
+# Groups of Bliss values that may be weighted via the 'weights' API parameter
+WEIGHT_GROUPS = {'tempo':[0], 'timbre':list(range(1, 8)), 'loudness':[8, 9], 'chroma':list(range(10, bliss_analysis.NUM_BLISS_VALS))}
 
 
-attrib_list = []
-max_sim = math.sqrt(bliss_analysis.NUM_BLISS_VALS)
-total_tracks = 0
-tree = None
+class BlissSim(vector_sim.VectorSim):
+    '''
+    Bliss values of all tracks, indexed by track ID, and a nearest neighbour index over these. If base (a BlissSim)
+    is set then only the tracks added to the DB since base was loaded are read, see VectorSim.set_vectors.
+    '''
+    weight_groups = WEIGHT_GROUPS
 
-
-def init(db):
-    global attrib_list, total_tracks, tree
-    if tree is None:
-        _LOGGER.debug('Loading bliss from DB')
+    def __init__(self, db, cfg, base=None, merge=False):
+        first = 0 if base is None else base.total_tracks
+        _LOGGER.debug('Loading bliss from DB, from track %d' % first)
         cursor = db.get_cursor()
 
         attr_list = []
-        paths = []
         empty = [0.0] * bliss_analysis.NUM_BLISS_VALS
-        cursor.execute('SELECT file, bliss FROM tracks ORDER BY rowid ASC')
+        cursor.execute('SELECT file, bliss FROM tracks WHERE rowid>? ORDER BY rowid ASC', (first, ))
         for row in cursor:
-            paths.append(row[0])
             if row[1] is None:
                 _LOGGER.error('%s has not been analysed with Bliss' % row[0])
                 attr_list.append(empty)
             else:
                 attr_list.append(pickle.loads(row[1]))
 
-        attrib_list = numpy.array(attr_list)
-        tree = cKDTree(attrib_list)
-        total_tracks = len(paths)
-        return paths
-    return None
-            
-
-def get_similars(track_id, num_tracks):
-    global attrib_list, max_sim, total_tracks, tree
-    if num_tracks>total_tracks or num_tracks<0:
-        num_tracks = total_tracks
-    distances, indexes = tree.query(numpy.array([attrib_list[track_id]]), k=num_tracks)
-
-    entries = []
-    for i in range(min(len(indexes[0]), num_tracks)):
-        entries.append({'id':indexes[0][i], 'sim':distances[0][i]/max_sim})
-
-    return entries;
+        attrib_list = numpy.array(attr_list).reshape(len(attr_list), bliss_analysis.NUM_BLISS_VALS)
+        self.set_vectors(attrib_list, cfg, cfg['bliss']['metric'], base, merge)
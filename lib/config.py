@@ -6,7 +6,7 @@
 #
 
 import json, logging, os, pathlib, platform
-from . import tracks_db
+from . import knn, tracks_db
 
 _LOGGER = logging.getLogger(__name__)
 # Only Linux and mac, for now, support highlevel analysis
@@ -240,6 +240,120 @@ def read_config(path, analyse):
     if not config['simalgo'] in ['bliss', 'essentia', 'musly', 'mixed', 'simplemixed']:
         exit_with_error("Invalid 'simalgo' setting")
 
+    if not 'knn' in config:
+        config['knn']={}
+
+    if not 'method' in config['knn']:
+        config['knn']['method']=knn.METHOD_AUTO
+
+    if not config['knn']['method'] in knn.METHODS:
+        exit_with_error("Invalid 'knn.method' setting")
+
+    if not 'chunksize' in config['knn'] or config['knn']['chunksize']<1:
+        config['knn']['chunksize']=knn.DEFAULT_CHUNK_SIZE
+
+    if not 'weightcache' in config['knn'] or config['knn']['weightcache']<0:
+        config['knn']['weightcache']=knn.DEFAULT_WEIGHT_CACHE_SIZE
+
+    if not 'deadline' in config or config['deadline']<0:
+        config['deadline']=0
+
+    if not 'queue' in config:
+        config['queue']={}
+
+    if not 'workers' in config['queue'] or config['queue']['workers']<1:
+        config['queue']['workers']=os.cpu_count()
+
+    if not 'depth' in config['queue'] or config['queue']['depth']<0:
+        config['queue']['depth']=config['queue']['workers']*4
+
+    if not 'sessions' in config:
+        config['sessions']={}
+
+    if not 'max' in config['sessions'] or config['sessions']['max']<0:
+        config['sessions']['max']=100
+
+    if not 'ttl' in config['sessions'] or config['sessions']['ttl']<1:
+        config['sessions']['ttl']=3600
+
+    if not 'prefetch' in config:
+        config['prefetch']={}
+
+    if not 'enabled' in config['prefetch']:
+        config['prefetch']['enabled']=False
+
+    if not 'max' in config['prefetch'] or config['prefetch']['max']<1:
+        config['prefetch']['max']=500
+
+    if not 'ttl' in config['prefetch'] or config['prefetch']['ttl']<1:
+        config['prefetch']['ttl']=600
+
+    if not 'budget' in config['prefetch'] or config['prefetch']['budget']<=0 or config['prefetch']['budget']>100:
+        config['prefetch']['budget']=25
+
+    if not 'warmup' in config:
+        config['warmup']={}
+
+    if not 'tracks' in config['warmup'] or config['warmup']['tracks']<0:
+        config['warmup']['tracks']=0
+
+    if not 'min' in config['warmup'] or config['warmup']['min']<0:
+        config['warmup']['min']=0
+
+    if not 'max' in config['warmup'] or config['warmup']['max']<0:
+        config['warmup']['max']=0
+
+    if not 'filterxmas' in config['warmup']:
+        config['warmup']['filterxmas']=False
+
+    if not 'filtergenre' in config['warmup']:
+        config['warmup']['filtergenre']=False
+
+    if not 'trace' in config:
+        config['trace']={}
+
+    if not 'file' in config['trace'] or not config['trace']['file']:
+        config['trace']['file']=None
+
+    if not 'sample' in config['trace'] or config['trace']['sample']<0:
+        config['trace']['sample']=0
+
+    if not 'profile' in config:
+        config['profile']={}
+
+    if not 'enabled' in config['profile']:
+        config['profile']['enabled']=False
+
+    if not 'maxseconds' in config['profile'] or config['profile']['maxseconds']<1:
+        config['profile']['maxseconds']=60
+
+    if not 'memory' in config:
+        config['memory']={}
+
+    if not 'tracemalloc' in config['memory']:
+        config['memory']['tracemalloc']=False
+
+    if not 'slowlog' in config:
+        config['slowlog']={}
+
+    if not 'file' in config['slowlog'] or not config['slowlog']['file']:
+        config['slowlog']['file']=None
+
+    if not 'threshold' in config['slowlog'] or config['slowlog']['threshold']<0:
+        config['slowlog']['threshold']=1000
+
+    if not 'maxsize' in config['slowlog'] or config['slowlog']['maxsize']<1:
+        config['slowlog']['maxsize']=10
+
+    if not 'backups' in config['slowlog'] or config['slowlog']['backups']<0:
+        config['slowlog']['backups']=3
+
+    if not 'reload' in config:
+        config['reload']={}
+
+    if not 'poll' in config['reload'] or config['reload']['poll']<0:
+        config['reload']['poll']=0
+
     if not 'bliss' in config:
         config['bliss']={}
 
@@ -251,6 +365,14 @@ def read_config(path, analyse):
 
     setup_paths(config, analyse)
 
+    for algo in ['bliss', 'essentia']:
+        if not 'metric' in config[algo]:
+            config[algo]['metric']=knn.METRIC_EUCLIDEAN
+        elif not config[algo]['metric'] in knn.METRICS:
+            exit_with_error("Invalid '%s.metric' setting" % algo)
+        if 'weights' in config[algo] and not isinstance(config[algo]['weights'], dict):
+            exit_with_error("Invalid '%s.weights' setting" % algo)
+
     if not 'enabled' in config['bliss']:
         config['bliss']['enabled'] = (not analyse) or (sname in SUPPORT_BLISS)
 
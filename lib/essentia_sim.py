@@ -5,73 +5,64 @@
 # GPLv3 license.
 #
 
-import logging, math, numpy
-from scipy.spatial import cKDTree
-from . import tracks_db
+import logging, numpy
+from . import tracks_db, vector_sim
 
 _LOGGER = logging.getLogger(__name__)
 
+# Groups of Essentia attribs that may be weighted via the 'weights' API parameter, each highlevel attrib may
+# also be weighted individually.
+WEIGHT_GROUPS = {'bpm':[0], 'mood':list(range(1, len(tracks_db.ESSENTIA_HIGHLEVEL_ATTRIBS)+1))}
+WEIGHT_GROUPS.update({attr:[i+1] for i, attr in enumerate(tracks_db.ESSENTIA_HIGHLEVEL_ATTRIBS)})
 
-min_bpm = None
-bpm_range = None
-max_sim = math.sqrt(len(tracks_db.ESSENTIA_HIGHLEVEL_ATTRIBS) + 1) # +1 for bpm
-attrib_list = []
-total_tracks = 0
-tree = None
+NUM_ATTRIBS = len(tracks_db.ESSENTIA_HIGHLEVEL_ATTRIBS) + 1 # +1 for bpm
 
 
-def init(db):
-    global min_bpm, bpm_range, attrib_list, total_tracks, tree
-    if min_bpm is None:
-        _LOGGER.debug('Loading essentia attribs from DB')
+class EssentiaSim(vector_sim.VectorSim):
+    '''
+    Essentia bpm, and highlevel, attributes of all tracks, indexed by track ID, and a nearest neighbour index over
+    these. If base (an EssentiaSim) is set then only the tracks added to the DB since base was loaded are read - and
+    base's BPM range is used for these, see VectorSim.set_vectors.
+    '''
+    weight_groups = WEIGHT_GROUPS
+
+    def __init__(self, db, cfg, base=None, merge=False):
+        first = 0 if base is None else base.total_tracks
+        _LOGGER.debug('Loading essentia attribs from DB, from track %d' % first)
         cursor = db.get_cursor()
-        cursor.execute('SELECT min(bpm), max(bpm) from tracks')
-        row = cursor.fetchone()
-        if row[0] is None or row[1] is None:
-            min_bpm = 0
-            bpm_range = 100
+        if base is not None:
+            self.min_bpm = base.min_bpm
+            self.bpm_range = base.bpm_range
         else:
-            min_bpm = row[0]
-            bpm_range = row[1] - min_bpm
+            cursor.execute('SELECT min(bpm), max(bpm) from tracks')
+            row = cursor.fetchone()
+            if row[0] is None or row[1] is None:
+                self.min_bpm = 0
+                self.bpm_range = 100
+            else:
+                self.min_bpm = row[0]
+                self.bpm_range = row[1] - self.min_bpm
 
         attr_list = []
-        paths = []
         cols = 'file, bpm' # From lowlevel
         for ess in tracks_db.ESSENTIA_HIGHLEVEL_ATTRIBS:
             cols+=', %s' % ess
 
-        cursor.execute('SELECT %s FROM tracks ORDER BY rowid ASC' % cols)
+        cursor.execute('SELECT %s FROM tracks WHERE rowid>? ORDER BY rowid ASC' % cols, (first, ))
         for row in cursor:
             attribs=[]
-            paths.append(row[0])
             loggedError = False
-            for attr in range(len(tracks_db.ESSENTIA_HIGHLEVEL_ATTRIBS) + 1): # +1 for bpm
+            for attr in range(NUM_ATTRIBS):
                 if row[attr+1] is None:
                     attribs.append(0.0)
                     if not loggedError:
                         _LOGGER.error('%s has not been analysed with Essentia' % row[0])
                         loggedError = True
                 elif 0==attr:
-                    attribs.append((row[attr+1]-min_bpm)/bpm_range)
+                    attribs.append((row[attr+1]-self.min_bpm)/self.bpm_range)
                 else:
                     attribs.append(row[attr+1])
             attr_list.append(attribs)
 
-        attrib_list = numpy.array(attr_list)
-        tree = cKDTree(attrib_list)
-        total_tracks = len(paths)
-        return paths
-    return None
-            
-
-def get_similars(track_id, num_tracks):
-    global attrib_list, max_sim, total_tracks, tree
-    if num_tracks>total_tracks or num_tracks<0:
-        num_tracks = total_tracks
-    distances, indexes = tree.query(numpy.array([attrib_list[track_id]]), k=num_tracks)
-
-    entries = []
-    for i in range(min(len(indexes[0]), num_tracks)):
-        entries.append({'id':indexes[0][i], 'sim':distances[0][i]/max_sim})
-
-    return entries;
+        attrib_list = numpy.array(attr_list).reshape(len(attr_list), NUM_ATTRIBS)
+        self.set_vectors(attrib_list, cfg, cfg['essentia']['metric'], base, merge)
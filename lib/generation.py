@@ -0,0 +1,281 @@
+#
+# Analyse files with Musly, Essentia, and Bliss, and provide an API to retrieve similar tracks
+#
+# Copyright (c) 2021-2022 Craig Drummond <craig.p.drummond@gmail.com>
+# GPLv3 license.
+#
+
+import copy, ctypes, logging, os, threading, time
+from . import bliss_sim, essentia_sim, genre_partitions, memory, musly, track_meta, tracks_db
+
+_LOGGER = logging.getLogger(__name__)
+
+
+BACKEND_LOADING = 'loading'
+BACKEND_READY   = 'ready'
+BACKEND_FAILED  = 'failed'
+
+MAX_DELTA_TRACKS = 5000 # Merge delta indexes into the main indexes once they hold more tracks than this
+
+
+class Generation(object):
+    '''
+    Everything loaded from the DB that is used to serve requests - track paths, metadata, and the similarity
+    indexes. Reloading creates a new generation, which replaces the current one once it has loaded. Requests
+    use the generation that was current when they started, and this is closed once no request is using it.
+    '''
+    def __init__(self, cfg, jukebox_path, number):
+        self.cfg = cfg
+        self.jukebox_path = jukebox_path
+        self.number = number
+        self.users = 0        # Number of requests using this generation
+        self.retired = False  # Set once replaced by a newer generation
+        self.bliss = None
+        self.essentia = None
+        self.mus = None
+        self.mta = {'tracks':None, 'ids':None}
+
+        tdb = tracks_db.TracksDb(cfg)
+        self.paths = tdb.get_paths()
+        self.paths_bytes = None # Size of paths, calculated when first needed
+        self.path_ids = None    # Path -> track ID, built when first needed
+        self.meta = track_meta.TrackMeta(tdb)
+        tdb.close()
+        self.partitions = genre_partitions.GenrePartitions(self.meta)
+        self.genre_list = sorted(self.meta.genre_names)
+
+        mixed = cfg['simalgo']=='mixed' or cfg['simalgo']=='simplemixed'
+        # Backends required for the configured similarity algorithm
+        self.algo_backends = []
+        if cfg['simalgo']=='essentia' or (mixed and cfg['mixed']['essentia']>0):
+            self.algo_backends.append('essentia')
+        if cfg['simalgo']=='bliss' or (mixed and cfg['mixed']['bliss']>0):
+            self.algo_backends.append('bliss')
+        if cfg['simalgo']=='musly' or (mixed and cfg['mixed']['musly']>0):
+            self.algo_backends.append('musly')
+
+        backends = list(self.algo_backends)
+        if backends==['musly']:
+            # Musly can take a long time to load (or rebuild) its jukebox, so also load Bliss, or Essentia, so that
+            # requests can be served whilst this happens.
+            if cfg['bliss']['enabled']:
+                backends.append('bliss')
+            elif cfg['essentia']['enabled'] and cfg['essentia']['highlevel']:
+                backends.append('essentia')
+        self.backends = {backend:{'state':BACKEND_LOADING, 'seconds':None} for backend in backends}
+
+
+    def load(self, wait=False):
+        ''' Load the backends, each in its own thread. If wait is False this returns whilst they are loading. '''
+        threads = [threading.Thread(target=self.load_backend, args=(backend,), name='load-%s-%d' % (backend, self.number), daemon=True) for backend in self.backends]
+        for thread in threads:
+            thread.start()
+        if wait:
+            for thread in threads:
+                thread.join()
+
+
+    def load_backend(self, backend):
+        '''
+        Load, or build, the index for a backend. If this fails due to an error it is tried once more, but if the DB
+        changed whilst loading then the tracks need to be reloaded instead.
+        '''
+        start = time.time()
+        ok, changed = self.try_load_backend(backend)
+        if not ok and not changed:
+            _LOGGER.warning('Failed to load %s, retrying' % backend)
+            ok, changed = self.try_load_backend(backend)
+
+        self.backends[backend] = {'state':BACKEND_READY if ok else BACKEND_FAILED, 'seconds':round(time.time()-start, 1)}
+        if ok:
+            _LOGGER.info('%s ready, took %.1fs' % (backend, self.backends[backend]['seconds']))
+        elif changed:
+            _LOGGER.error('DB changed whilst loading %s, use /api/reload (or set reload.poll) to load the current tracks' % backend)
+        else:
+            _LOGGER.error('Failed to load %s, have you analysed all tracks? Use /api/reload to try again' % backend)
+
+
+    def try_load_backend(self, backend):
+        ''' Returns (whether backend loaded, whether this failed as the number of tracks in the DB changed) '''
+        # SQLite connections cannot be shared between threads, so use own connection
+        tdb = tracks_db.TracksDb(self.cfg)
+        ok = False
+        changed = False
+        try:
+            if 'musly'==backend:
+                ok = self.load_musly(tdb)
+            else:
+                sim = essentia_sim.EssentiaSim(tdb, self.cfg) if 'essentia'==backend else bliss_sim.BlissSim(tdb, self.cfg)
+                _LOGGER.debug('%d track(s) loaded from %s' % (sim.total_tracks, backend))
+                ok = sim.total_tracks==len(self.paths)
+                changed = not ok
+                if ok and 'genres' in self.cfg and backend==self.cfg['simalgo']:
+                    # Build an index for each configured genre group, used for genre filtered requests
+                    partitions = self.partitions.get_all(self.cfg['genres'])
+                    _LOGGER.debug('Building %d genre partition indexes' % len(partitions))
+                    sim.init_partitions(partitions)
+                if ok:
+                    if 'essentia'==backend:
+                        self.essentia = sim
+                    else:
+                        self.bliss = sim
+        except Exception as e:
+            _LOGGER.error('Failed to load %s - %s' % (backend, str(e)))
+            ok = False
+        tdb.close()
+        return ok, changed
+
+
+    def load_musly(self, tdb):
+        ''' Load Musly tracks, and jukebox - recreating this if it does not match the DB '''
+        mus = musly.Musly(self.cfg['musly']['lib'])
+        mta = {'tracks':None, 'ids':None}
+        (paths, mta['tracks']) = mus.get_alltracks_db(tdb.get_cursor())
+        _LOGGER.debug('%d track(s) loaded from Musly' % (len(paths) if paths is not None else 0))
+        if paths is None or mta['tracks'] is None or len(paths)!=len(self.paths):
+            mus.jukebox_off()
+            return False
+
+        # If we can, load musly from jukebox...
+        if os.path.exists(self.jukebox_path):
+            mta['ids'] = mus.get_jukebox_from_file(self.jukebox_path)
+
+        if mta['ids'] is None or len(mta['ids'])!=len(paths):
+            _LOGGER.debug('Adding tracks from DB to musly')
+            mta['ids'] = mus.add_tracks(mta['tracks'], self.cfg['musly']['styletracks'], self.cfg['musly']['styletracksmethod'], tdb)
+            if mta['ids'] is None:
+                mus.jukebox_off()
+                return False
+            mus.write_jukebox(self.jukebox_path)
+
+        self.mta = mta
+        self.mus = mus
+        return True
+
+
+    def num_appended(self, tdb):
+        '''
+        Number of tracks appended to the DB since this generation was loaded. -1 if the tracks that were loaded have
+        changed (e.g. some have been removed, and the rest re-numbered) as then a full reload is required.
+        '''
+        count = tdb.num_tracks()
+        if count<len(self.paths) or tdb.get_path(0)!=self.paths[0] or tdb.get_path(len(self.paths)-1)!=self.paths[-1] or tdb.get_path(count-1) is None:
+            return -1
+        return count-len(self.paths)
+
+
+    def extend(self, number, merge=False):
+        '''
+        Create a new generation with the tracks of this one, plus any appended to the DB since this was loaded. The
+        Bliss/Essentia vectors of the new tracks are placed in delta indexes, unless merge is True - in which case new
+        main indexes of all tracks are built. Musly is not supported, as the jukebox would need to be rebuilt.
+        Returns None if no tracks have been appended (and merge is False), the DB has changed in other ways, or it
+        changed whilst the new tracks were being read.
+        '''
+        tdb = tracks_db.TracksDb(self.cfg)
+        try:
+            if 'musly' in self.backends:
+                return None
+            appended = self.num_appended(tdb)
+            if appended<0 or (0==appended and not merge):
+                return None
+            gen = copy.copy(self)
+            gen.number = number
+            gen.users = 0
+            gen.retired = False
+            gen.paths = self.paths + tdb.get_paths(len(self.paths))
+            gen.paths_bytes = None
+            gen.path_ids = None
+            gen.meta = track_meta.TrackMeta(tdb, self.meta)
+            gen.partitions = genre_partitions.GenrePartitions(gen.meta)
+            gen.genre_list = sorted(gen.meta.genre_names)
+            gen.backends = {backend:dict(status) for backend, status in self.backends.items()}
+            if self.bliss is not None:
+                gen.bliss = bliss_sim.BlissSim(tdb, self.cfg, self.bliss, merge)
+            if self.essentia is not None:
+                gen.essentia = essentia_sim.EssentiaSim(tdb, self.cfg, self.essentia, merge)
+            sims = [sim for sim in [gen.bliss, gen.essentia] if sim is not None]
+            if gen.meta.total_tracks!=len(gen.paths) or any(sim.total_tracks!=len(gen.paths) for sim in sims):
+                _LOGGER.debug('DB changed whilst reading new tracks')
+                return None
+            if merge and 'genres' in self.cfg:
+                for backend, sim in [('bliss', gen.bliss), ('essentia', gen.essentia)]:
+                    if sim is not None and backend==self.cfg['simalgo']:
+                        sim.init_partitions(gen.partitions.get_all(self.cfg['genres']))
+            return gen
+        finally:
+            tdb.close()
+
+
+    def get_track_id(self, path):
+        ''' ID of the track with path, None if not found '''
+        path_ids = self.path_ids
+        if path_ids is None:
+            # Concurrent callers may each build this, but the result is the same
+            path_ids = self.path_ids = {path:track_id for track_id, path in enumerate(self.paths)}
+        return path_ids.get(path)
+
+
+    def delta_size(self):
+        ''' Number of tracks in the largest delta index '''
+        return max([len(sim.delta) for sim in [self.bliss, self.essentia] if sim is not None and sim.delta is not None] + [0])
+
+
+    def memory_usage(self):
+        ''' Estimated size, in bytes, of each component - with its number of items '''
+        if self.paths_bytes is None:
+            self.paths_bytes = memory.strings_bytes(self.paths)
+        usage = {'paths':memory.usage(self.paths_bytes, len(self.paths)), 'meta':self.meta.memory_usage()}
+        for backend, sim in [('bliss', self.bliss), ('essentia', self.essentia)]:
+            if sim is not None:
+                usage[backend] = sim.memory_usage()
+        if self.mus is not None:
+            # Track models are ctypes arrays, the jukebox is held by libmusly - so use its serialised size
+            tracks = self.mta['tracks']
+            nbytes = ctypes.sizeof(tracks)+len(tracks)*ctypes.sizeof(self.mus.mtrack_type)+self.mus.get_jukebox_binsize()
+            usage['musly'] = memory.usage(nbytes, len(tracks))
+        return usage
+
+
+    def close(self):
+        ''' Release the resources that are not freed by garbage collection '''
+        _LOGGER.debug('Closing generation %d' % self.number)
+        if self.mus is not None:
+            self.mus.jukebox_off()
+            self.mus = None
+
+
+    def loading(self):
+        return any(status['state']==BACKEND_LOADING for status in self.backends.values())
+
+
+    def backend_ready(self, backend):
+        return backend in self.backends and self.backends[backend]['state']==BACKEND_READY
+
+
+    def get_ready_algo(self):
+        '''
+        Similarity algorithm to use for requests - the configured one if its backends are ready, otherwise any
+        single backend that is ready. None if no backend is ready yet.
+        '''
+        if all(self.backend_ready(backend) for backend in self.algo_backends):
+            return self.cfg['simalgo']
+        for backend in ['bliss', 'essentia', 'musly']:
+            if self.backend_ready(backend):
+                return backend
+        return None
+
+
+    def get_request_config(self):
+        ''' Config for a similarity request, with simalgo set to the algorithm that is ready. None if none are. '''
+        algo = self.get_ready_algo()
+        if algo is None or algo==self.cfg['simalgo']:
+            return None if algo is None else self.cfg
+        cfg = dict(self.cfg)
+        cfg['simalgo'] = algo
+        return cfg
+
+
+    def get_status(self):
+        return {'generation':self.number, 'simalgo':self.cfg['simalgo'], 'active':self.get_ready_algo(), 'tracks':len(self.paths),
+                'backends':{backend:dict(status) for backend, status in self.backends.items()}}
@@ -0,0 +1,99 @@
+#
+# Analyse files with Musly, Essentia, and Bliss, and provide an API to retrieve similar tracks
+#
+# Copyright (c) 2021-2022 Craig Drummond <craig.p.drummond@gmail.com>
+# GPLv3 license.
+#
+
+import collections, logging, numpy, threading
+from .track_meta import has_genre
+
+_LOGGER = logging.getLogger(__name__)
+
+
+UNGROUPED     = 'ungrouped' # Tracks that have genres, but none of these are in a group
+NO_GENRE      = 'nogenre'   # Tracks without a genre, these are always accepted by genre filtering
+MAX_GROUPINGS = 4           # Number of different genre group configs to keep compiled, with partitions
+
+
+def group_name(group):
+    return tuple(sorted(group))
+
+
+def groups_key(groups):
+    return tuple(sorted(group_name(group) for group in groups))
+
+
+class GenrePartitions(object):
+    ''' Genre groups compiled against the genres of a TrackMeta, with the partitions of its tracks '''
+    def __init__(self, meta):
+        self.meta = meta
+        self.groupings = collections.OrderedDict() # groups key -> compiled groups, in LRU order
+        self.lock = threading.Lock()
+
+
+    def build(self, groups):
+        '''
+        Compile genre groups into bitsets, and split track IDs into one partition per genre group plus ungrouped
+        and no-genre partitions.
+        '''
+        meta = self.meta
+        names = [group_name(group) for group in groups]
+        masks = numpy.array([meta.genre_mask(group) for group in groups], dtype=numpy.uint64).reshape(len(groups), meta.genre_bits.shape[1])
+        all_genres = numpy.bitwise_or.reduce(masks, axis=0) if len(groups)>0 else numpy.zeros(meta.genre_bits.shape[1], dtype=numpy.uint64)
+        parts = {}
+        for name, mask in zip(names, masks):
+            parts[name] = numpy.flatnonzero(has_genre(meta.genre_bits, mask))
+        parts[UNGROUPED] = numpy.flatnonzero(~meta.no_genre & ~has_genre(meta.genre_bits, all_genres))
+        parts[NO_GENRE] = numpy.flatnonzero(meta.no_genre)
+        return {'names':names, 'masks':masks, 'all':all_genres, 'parts':parts}
+
+
+    def get(self, groups):
+        ''' Get compiled genre groups, building these if not cached '''
+        key = groups_key(groups)
+        with self.lock:
+            if key in self.groupings:
+                self.groupings.move_to_end(key)
+                return key, self.groupings[key]
+        compiled = self.build(groups)
+        _LOGGER.debug('Built %d genre partitions' % len(compiled['parts']))
+        with self.lock:
+            self.groupings[key] = compiled
+            while len(self.groupings)>MAX_GROUPINGS:
+                self.groupings.popitem(last=False)
+        return key, compiled
+
+
+    def get_all(self, groups):
+        ''' Return list of (partition key, track IDs) for all non-empty partitions '''
+        key, compiled = self.get(groups)
+        return [((key, name), ids) for name, ids in compiled['parts'].items() if len(ids)>0]
+
+
+    def expand(self, groups, genres):
+        ''' Return bitset of all genres in the groups that contain any of the genres in the genres bitset '''
+        _, compiled = self.get(groups)
+        matched = compiled['masks'][has_genre(compiled['masks'], genres)]
+        return numpy.bitwise_or.reduce(matched, axis=0) if len(matched)>0 else numpy.zeros_like(genres)
+
+
+    def all_genres(self, groups):
+        ''' Return bitset of all genres in any group '''
+        _, compiled = self.get(groups)
+        return compiled['all']
+
+
+    def select(self, groups, acceptable_genres):
+        '''
+        Return list of (partition key, track IDs) for the partitions that may hold tracks that
+        TrackMeta.genre_matches would accept for the acceptable_genres bitset.
+        '''
+        key, compiled = self.get(groups)
+        parts = compiled['parts']
+        if acceptable_genres.any():
+            names = [name for name, mask in zip(compiled['names'], compiled['masks']) if (mask & acceptable_genres).any()]
+        else:
+            names = [UNGROUPED]
+        names.append(NO_GENRE)
+        return [((key, name), parts[name]) for name in names if name in parts and len(parts[name])>0]
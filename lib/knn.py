@@ -0,0 +1,368 @@
+#
+# Analyse files with Musly, Essentia, and Bliss, and provide an API to retrieve similar tracks
+#
+# Copyright (c) 2021-2022 Craig Drummond <craig.p.drummond@gmail.com>
+# GPLv3 license.
+#
+
+import collections, logging, numpy, threading, time
+from scipy.spatial import cKDTree
+from . import memory
+
+_LOGGER = logging.getLogger(__name__)
+
+
+METHOD_AUTO        = 'auto'
+METHOD_TREE        = 'tree'
+METHOD_BRUTE       = 'brute'
+METRIC_EUCLIDEAN   = 'euclidean'
+METRIC_COSINE      = 'cosine'
+METHODS            = [METHOD_AUTO, METHOD_TREE, METHOD_BRUTE]
+METRICS            = [METRIC_EUCLIDEAN, METRIC_COSINE]
+DEFAULT_CHUNK_SIZE = 16384 # Number of library rows compared against the seeds in one block
+BENCHMARK_RUNS     = 4     # Number of queries to time each method with
+BENCHMARK_SEEDS    = 3     # Number of seeds per query, requests search for all of their seeds at once
+BENCHMARK_K        = 500   # Number of neighbours to ask for when timing, matches INITIAL_NUM_SIM of app.py
+BENCHMARK_ELIGIBLE = 0.9   # Fraction of tracks eligible (see TrackMeta.eligible) when timing
+ZERO_DISTANCE      = 1e-9  # Squared distances less than this are rounding errors, treat as 0
+DEFAULT_WEIGHT_CACHE_SIZE   = 4  # Number of weighted trees to keep
+WEIGHTED_TREE_MIN_REQUESTS  = 3  # Weightings requested less often than this use brute-force
+MAX_TRACKED_WEIGHTINGS      = 64 # Limit on number of weightings we count requests for
+MAX_PARTITIONS              = 64 # Number of partition (subset) indexes to keep
+
+
+def _unit_rows(vals):
+    norms = numpy.linalg.norm(vals, axis=1)
+    norms[norms==0.0] = 1.0
+    return vals / norms[:, None]
+
+
+def _merge_top_k(best_d, best_i, dist, ids, k):
+    ''' Merge candidate (dist, ids) into current best, keeping k smallest per row '''
+    if best_d is not None:
+        dist = numpy.concatenate((best_d, dist), axis=1)
+        ids = numpy.concatenate((best_i, ids), axis=1)
+    if dist.shape[1]>k:
+        part = numpy.argpartition(dist, k-1, axis=1)[:, :k]
+        dist = numpy.take_along_axis(dist, part, axis=1)
+        ids = numpy.take_along_axis(ids, part, axis=1)
+    return dist, ids
+
+
+def brute_query(data, seeds, k, weights=None, metric=METRIC_EUCLIDEAN, chunk_size=DEFAULT_CHUNK_SIZE, sq_norms=None, mask=None):
+    '''
+    Find the k nearest rows of data to each row of seeds, by computing distances block by block so that memory
+    is bounded by len(seeds)*chunk_size. All seeds are compared against a block in a single matrix multiply.
+    weights, if set, scales each dimension (weighted euclidean, or weighted cosine). sq_norms may hold the
+    pre-computed squared norms of the rows of data (only used for unweighted euclidean). If mask is set, rows
+    where this is False are given an infinite distance.
+    Returns (distances, indexes) - each of shape (len(seeds), k) - sorted nearest first.
+    '''
+    total = data.shape[0]
+    k = max(min(k, total), 1)
+    seeds = numpy.atleast_2d(numpy.asarray(seeds, dtype=data.dtype))
+    scale = None if weights is None else numpy.sqrt(numpy.asarray(weights, dtype=data.dtype))
+    if scale is not None:
+        seeds = seeds * scale
+        sq_norms = None
+    if metric==METRIC_COSINE:
+        seeds = _unit_rows(seeds)
+    else:
+        seed_sq = numpy.einsum('ij,ij->i', seeds, seeds)
+
+    best_d = None
+    best_i = None
+    for start in range(0, total, chunk_size):
+        block = data[start:start+chunk_size]
+        if scale is not None:
+            block = block * scale
+        if metric==METRIC_COSINE:
+            dist = 1.0 - (seeds @ _unit_rows(block).T)
+        else:
+            block_sq = sq_norms[start:start+chunk_size] if sq_norms is not None else numpy.einsum('ij,ij->i', block, block)
+            dist = seed_sq[:, None] + block_sq[None, :] - 2.0 * (seeds @ block.T)
+        if mask is not None:
+            dist[:, ~mask[start:start+chunk_size]] = numpy.inf
+        ids = numpy.broadcast_to(numpy.arange(start, start+block.shape[0]), dist.shape)
+        best_d, best_i = _merge_top_k(best_d, best_i, dist, ids, k)
+
+    order = numpy.argsort(best_d, axis=1, kind='stable')
+    best_d = numpy.take_along_axis(best_d, order, axis=1)
+    best_i = numpy.take_along_axis(best_i, order, axis=1)
+    best_d[best_d<ZERO_DISTANCE] = 0.0
+    if metric!=METRIC_COSINE:
+        best_d = numpy.sqrt(best_d)
+    return best_d, best_i
+
+
+class Index(object):
+    '''
+    Nearest neighbour index over a (tracks x attribs) array. Queries are answered by either a KD-tree, or by
+    a chunked brute-force search - whichever was quickest for this library size when the index was built.
+    If ids is set, then the index only covers these tracks (row N of data is track ids[N]).
+    '''
+    def __init__(self, data, method=METHOD_AUTO, metric=METRIC_EUCLIDEAN, chunk_size=DEFAULT_CHUNK_SIZE, weight_cache_size=DEFAULT_WEIGHT_CACHE_SIZE, ids=None):
+        self.data = numpy.ascontiguousarray(data, dtype=numpy.float64)
+        self.ids = ids
+        self.metric = metric
+        self.chunk_size = chunk_size
+        self.weight_cache_size = weight_cache_size
+        self.weighted_trees = collections.OrderedDict() # weights -> tree built over scaled data, in LRU order
+        self.weighting_requests = collections.OrderedDict() # weights -> number of times requested
+        self.partitions = collections.OrderedDict() # key -> Index over a subset of tracks, in LRU order
+        self.lock = threading.Lock()
+        self.sq_norms = numpy.einsum('ij,ij->i', self.data, self.data)
+        self.tree = None
+        self.method = method
+        if method!=METHOD_BRUTE and len(self.data)>0:
+            # Euclidean distance between unit vectors is a monotonic function of cosine distance, so the
+            # tree can serve cosine queries if it is built on normalised rows.
+            self.tree = self._build_tree(self.data)
+        if method==METHOD_AUTO:
+            self.method = self.benchmark()
+            if self.method==METHOD_BRUTE:
+                # Not used for brute-force queries, so do not keep it
+                self.tree = None
+
+
+    def __len__(self):
+        return len(self.data)
+
+
+    def memory_usage(self, owner=None):
+        ''' Estimated size of the index, including cached weighted trees and partition indexes '''
+        with self.lock:
+            trees = list(self.weighted_trees.values())
+            partitions = list(self.partitions.values())
+        nbytes = memory.array_bytes(self.data, owner)+self.sq_norms.nbytes+memory.array_bytes(self.ids)
+        nbytes += memory.tree_bytes(self.tree, self.data)+sum(memory.tree_bytes(tree, None) for tree in trees)
+        nbytes += sum(part.memory_usage()['bytes'] for part in partitions)
+        return memory.usage(nbytes, len(self.data), trees=len(trees), partitions=len(partitions))
+
+
+    def benchmark(self):
+        '''
+        Time tree and brute-force queries, shaped like those of similarity requests (a batch of seeds, a small k,
+        and a mask of eligible tracks), and return the quicker method
+        '''
+        if self.tree is None:
+            return METHOD_BRUTE
+        batches = [self.data[numpy.random.randint(0, len(self.data), BENCHMARK_SEEDS)] for _ in range(BENCHMARK_RUNS)]
+        mask = numpy.random.random(len(self.data))<BENCHMARK_ELIGIBLE
+        k = min(BENCHMARK_K, len(self.data))
+        start = time.perf_counter()
+        for seeds in batches:
+            self._masked_tree_query(seeds, k, self.tree, None, mask)
+        tree_time = time.perf_counter() - start
+        start = time.perf_counter()
+        for seeds in batches:
+            brute_query(self.data, seeds, k, None, self.metric, self.chunk_size, self.sq_norms, mask)
+        brute_time = time.perf_counter() - start
+        method = METHOD_TREE if tree_time<=brute_time else METHOD_BRUTE
+        _LOGGER.debug('KNN benchmark, %d tracks, tree:%.2fms brute:%.2fms, using %s' % (len(self.data), tree_time*1000.0/BENCHMARK_RUNS, brute_time*1000.0/BENCHMARK_RUNS, method))
+        return method
+
+
+    def _build_tree(self, data):
+        return cKDTree(_unit_rows(data) if self.metric==METRIC_COSINE else data)
+
+
+    def _weighted_tree(self, weights):
+        '''
+        Return a tree built over data scaled by weights, if this weighting is requested often enough to be
+        worth building (and caching) one. Otherwise returns None, and query will use brute-force.
+        '''
+        key = tuple(weights.tolist())
+        with self.lock:
+            if key in self.weighted_trees:
+                self.weighted_trees.move_to_end(key)
+                return self.weighted_trees[key]
+            count = self.weighting_requests.pop(key, 0) + 1
+            self.weighting_requests[key] = count
+            while len(self.weighting_requests)>MAX_TRACKED_WEIGHTINGS:
+                self.weighting_requests.popitem(last=False)
+            if self.weight_cache_size<1 or count<WEIGHTED_TREE_MIN_REQUESTS:
+                return None
+
+        _LOGGER.debug('Building tree for weights %s' % str(key))
+        tree = self._build_tree(self.data * numpy.sqrt(weights))
+        with self.lock:
+            self.weighted_trees[key] = tree
+            while len(self.weighted_trees)>self.weight_cache_size:
+                self.weighted_trees.popitem(last=False)
+        return tree
+
+
+    def _tree_query(self, seeds, k, tree=None, weights=None):
+        if weights is not None:
+            seeds = seeds * numpy.sqrt(weights)
+        if self.metric==METRIC_COSINE:
+            seeds = _unit_rows(seeds)
+        distances, indexes = (self.tree if tree is None else tree).query(seeds, k=k)
+        if 1==k:
+            distances = distances[:, None]
+            indexes = indexes[:, None]
+        if self.metric==METRIC_COSINE:
+            distances = (distances*distances)/2.0
+        return distances, indexes
+
+
+    def partition(self, key, ids):
+        '''
+        Return an index covering only the tracks in ids, building (and caching) this if required. This uses the same
+        method as this index, so that only the first index built needs to be benchmarked.
+        '''
+        with self.lock:
+            if key in self.partitions:
+                self.partitions.move_to_end(key)
+                return self.partitions[key]
+        part = Index(self.data[ids], self.method, self.metric, self.chunk_size, self.weight_cache_size, ids)
+        with self.lock:
+            self.partitions[key] = part
+            while len(self.partitions)>MAX_PARTITIONS:
+                self.partitions.popitem(last=False)
+        return part
+
+
+    def _masked_tree_query(self, seeds, k, tree, weights, mask):
+        '''
+        Trees cannot skip ineligible tracks, so ask for more neighbours than required - based upon the fraction
+        of tracks that are eligible - and keep asking for more until k eligible tracks are found for each seed.
+        '''
+        total = len(self.data)
+        eligible = int(mask.sum())
+        if 0==eligible:
+            return [numpy.zeros(0)]*len(seeds), [numpy.zeros(0, dtype=numpy.int64)]*len(seeds)
+        k = min(k, eligible)
+        fetch = min(total, int(k*total/eligible*1.1)+16)
+        while True:
+            distances, indexes = self._tree_query(seeds, fetch, tree, weights)
+            keep = mask[indexes]
+            if fetch>=total or numpy.all(keep.sum(axis=1)>=k):
+                break
+            fetch = min(total, fetch*2)
+        return [distances[i][keep[i]][:k] for i in range(len(seeds))], [indexes[i][keep[i]][:k] for i in range(len(seeds))]
+
+
+    def query(self, seeds, k, weights=None, mask=None):
+        '''
+        Return (distances, indexes) of the k nearest tracks to each seed vector, sorted nearest first. Weighted
+        queries use a cached tree of scaled data for common weightings, and brute-force for the rest.
+        mask, if set, is an array of booleans (indexed by track ID) of tracks that may be returned. In this case
+        lists (one per seed) of possibly fewer than k tracks are returned.
+        '''
+        seeds = numpy.atleast_2d(seeds)
+        k = max(min(k, len(self.data)), 1)
+        if mask is not None:
+            # mask covers all tracks, which may be more than this index does
+            mask = mask[self.ids] if self.ids is not None else mask[:len(self.data)]
+        distances = None
+        if self.method==METHOD_TREE:
+            tree = self.tree if weights is None else self._weighted_tree(weights)
+            if tree is not None:
+                if mask is None:
+                    distances, indexes = self._tree_query(seeds, k, tree, weights)
+                else:
+                    distances, indexes = self._masked_tree_query(seeds, k, tree, weights, mask)
+        if distances is None:
+            distances, indexes = brute_query(self.data, seeds, k, weights, self.metric, self.chunk_size, self.sq_norms if weights is None else None, mask)
+            if mask is not None:
+                finite = numpy.isfinite(distances)
+                distances = [distances[i][finite[i]] for i in range(len(seeds))]
+                indexes = [indexes[i][finite[i]] for i in range(len(seeds))]
+        if self.ids is not None:
+            indexes = [self.ids[row] for row in indexes] if mask is not None else self.ids[indexes]
+        return distances, indexes
+
+
+def query_all(indexes, seeds, k, weights=None, mask=None):
+    '''
+    Query several indexes (e.g. partitions of the library) and merge the results. As a track may be in more
+    than one index, each seed's results may differ in length - so lists of (distances, indexes) are returned.
+    '''
+    results = [index.query(seeds, k, weights, mask) for index in indexes if len(index)>0]
+    all_distances = []
+    all_indexes = []
+    for row in range(len(numpy.atleast_2d(seeds))):
+        if len(results)==0:
+            all_distances.append(numpy.zeros(0))
+            all_indexes.append(numpy.zeros(0, dtype=numpy.int64))
+            continue
+        distances = numpy.concatenate([res[0][row] for res in results])
+        ids = numpy.concatenate([res[1][row] for res in results])
+        order = numpy.argsort(distances, kind='stable')
+        distances = distances[order]
+        ids = ids[order]
+        _, first = numpy.unique(ids, return_index=True) # Remove duplicates, keeping the nearest
+        keep = numpy.sort(first)[:k]
+        all_distances.append(distances[keep])
+        all_indexes.append(ids[keep])
+    return all_distances, all_indexes
+
+
+def query_delta(index, delta, seeds, k, weights=None, partitions=None, mask=None):
+    '''
+    Query a main index, and a delta index holding tracks added after the main index was built (delta may be None).
+    partitions, if set, is a list of (key, track IDs) and restricts the search to these tracks - partition
+    indexes are only built from the main index, the delta is restricted via the mask instead.
+    '''
+    if partitions is None and delta is None:
+        return index.query(seeds, k, weights, mask)
+    if partitions is None:
+        indexes = [index]
+    else:
+        indexes = [index.partition(key, ids[ids<len(index)]) for key, ids in partitions]
+    if delta is not None:
+        if partitions is not None:
+            in_partitions = numpy.zeros(len(index)+len(delta), dtype=bool)
+            for _, ids in partitions:
+                in_partitions[ids] = True
+            mask = in_partitions if mask is None else in_partitions & mask
+        indexes.append(delta)
+    return query_all(indexes, seeds, k, weights, mask)
+
+
+def normalize_weights(weights):
+    '''
+    Scale weights so that their mean is 1, this way the maximum possible distance - and hence the similarity
+    range - is the same as for unweighted queries. Returns None if weighting would make no difference.
+    '''
+    weights = numpy.clip(numpy.asarray(weights, dtype=numpy.float64), 0.0, None)
+    mean = weights.mean()
+    if mean<=0.0:
+        return None
+    weights = numpy.round(weights/mean, 3) # Round, so that near identical weightings share a cached tree
+    if numpy.all(weights==1.0):
+        return None
+    return weights
+
+
+def weights_vector(groups, num_dims, weights):
+    '''
+    Convert a dict of group name -> weight into a per-attribute weight vector. groups maps each name to the
+    attribute indexes it covers, names not in groups are ignored. Returns None if unweighted.
+    '''
+    if not weights:
+        return None
+    vec = numpy.ones(num_dims)
+    for key, val in weights.items():
+        if key in groups:
+            vec[groups[key]] = val
+    return normalize_weights(vec)
+
+
+def centroid(rows, seed_weights, metric=METRIC_EUCLIDEAN):
+    '''
+    Weighted mean of several seed vectors, returned as a single row. For cosine the rows are normalised first, so
+    that each seed's direction counts in proportion to its weight regardless of its magnitude.
+    '''
+    rows = numpy.atleast_2d(rows)
+    if METRIC_COSINE==metric:
+        rows = _unit_rows(rows)
+    seed_weights = numpy.asarray(seed_weights, dtype=numpy.float64)
+    return (seed_weights[:, None] * rows).sum(axis=0, keepdims=True) / seed_weights.sum()
+
+
+def to_entries(distances, indexes, max_sim):
+    ''' Convert a row of query results into the list of {'id', 'sim'} dicts used by the API '''
+    return [{'id':i, 'sim':s} for i, s in zip(indexes.tolist(), (distances/max_sim).tolist())]
@@ -0,0 +1,51 @@
+#
+# Analyse files with Musly, Essentia, and Bliss, and provide an API to retrieve similar tracks
+#
+# Copyright (c) 2021-2022 Craig Drummond <craig.p.drummond@gmail.com>
+# GPLv3 license.
+#
+
+import numpy, os, sys
+
+KDTREE_NODE_BYTES = 64 # Approximate size of a cKDTree node, the tree itself does not report this
+
+
+def array_bytes(array, owner=None):
+    ''' Size of a numpy array's data, 0 if this is shared with owner (i.e. is counted there) '''
+    if array is None or (owner is not None and numpy.shares_memory(array, owner)):
+        return 0
+    return array.nbytes
+
+
+def tree_bytes(tree, data):
+    ''' Estimated size of a cKDTree, its copy of the data is not counted if it shares that of the index '''
+    if tree is None:
+        return 0
+    return array_bytes(tree.data, data)+tree.indices.nbytes+getattr(tree, 'size', 0)*KDTREE_NODE_BYTES
+
+
+def strings_bytes(strings):
+    ''' Size of a list of strings, including the strings themselves '''
+    return sys.getsizeof(strings)+sum(sys.getsizeof(s) for s in strings)
+
+
+def usage(nbytes, items, **extra):
+    return dict(extra, bytes=int(nbytes), items=items)
+
+
+def get_process_memory():
+    ''' Resident size of the process, and its peak, in bytes. Values are None where these cannot be read. '''
+    rss = None
+    peak = None
+    try:
+        with open('/proc/self/statm') as f:
+            rss = int(f.read().split()[1])*os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError, AttributeError):
+        pass
+    try:
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        peak *= 1 if sys.platform=='darwin' else 1024 # macOS reports bytes, Linux KiB
+    except (ImportError, OSError):
+        pass
+    return {'rss':rss, 'peak':peak}
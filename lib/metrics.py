@@ -0,0 +1,143 @@
+#
+# Analyse files with Musly, Essentia, and Bliss, and provide an API to retrieve similar tracks
+#
+# Copyright (c) 2021-2022 Craig Drummond <craig.p.drummond@gmail.com>
+# GPLv3 license.
+#
+
+import bisect, threading, time
+
+CONTENT_TYPE    = 'text/plain; version=0.0.4; charset=utf-8'
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Histogram(object):
+    ''' Count of observations within each bucket, plus their sum. Buckets are upper bounds, as per Prometheus. '''
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0]*(len(buckets)+1)
+        self.total = 0.0
+        self.lock = threading.Lock()
+
+
+    def observe(self, value):
+        i = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[i] += 1
+            self.total += value
+
+
+    def snapshot(self):
+        with self.lock:
+            return list(self.counts), self.total
+
+
+class Stages(object):
+    '''
+    Time spent in each stage of a request. A stage runs from the end of the previous one until mark() is called, less
+    any time that was added, via add(), to other stages in the meantime.
+    '''
+    def __init__(self):
+        self.times = {}
+        self.last = time.perf_counter()
+        self.nested = 0.0
+
+
+    def mark(self, stage):
+        now = time.perf_counter()
+        self.times[stage] = self.times.get(stage, 0.0)+(now-self.last-self.nested)
+        self.last = now
+        self.nested = 0.0
+
+
+    def add(self, stage, seconds):
+        self.times[stage] = self.times.get(stage, 0.0)+seconds
+        self.nested += seconds
+
+
+class Metrics(object):
+    '''
+    Counters and histograms, each identified by name and a tuple of (label, value) pairs, rendered in the Prometheus
+    text format. Metrics are created when first used. Updates only hold a lock for as long as it takes to add to a
+    value, so are cheap enough to always be enabled.
+    '''
+    def __init__(self, prefix):
+        self.prefix = prefix
+        self.help = {}       # name -> help text
+        self.counters = {}   # (name, labels) -> value
+        self.histograms = {} # (name, labels) -> Histogram
+        self.lock = threading.Lock()
+
+
+    def describe(self, name, text):
+        self.help[name] = text
+
+
+    def inc(self, name, labels=(), amount=1):
+        with self.lock:
+            key = (name, labels)
+            self.counters[key] = self.counters.get(key, 0)+amount
+
+
+    def inc_all(self, name, label, counts):
+        ''' Increment counter name, for each value of label in counts (a dict of value -> amount) '''
+        with self.lock:
+            for value, amount in counts.items():
+                key = (name, ((label, value), ))
+                self.counters[key] = self.counters.get(key, 0)+amount
+
+
+    def observe(self, name, labels, value):
+        key = (name, labels)
+        hist = self.histograms.get(key)
+        if hist is None:
+            with self.lock:
+                hist = self.histograms.setdefault(key, Histogram(DEFAULT_BUCKETS))
+        hist.observe(value)
+
+
+    def render(self, gauges=[]):
+        ''' Render all metrics, plus gauges - a list of (name, labels, value) - in Prometheus text format '''
+        with self.lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted(self.histograms.items(), key=lambda item: item[0])
+        lines = []
+        described = set()
+
+        def describe(name, mtype):
+            if name not in described:
+                described.add(name)
+                if name in self.help:
+                    lines.append('# HELP %s%s %s' % (self.prefix, name, self.help[name]))
+                lines.append('# TYPE %s%s %s' % (self.prefix, name, mtype))
+
+        for name, labels, value in sorted(gauges, key=lambda gauge: (gauge[0], gauge[1])):
+            describe(name, 'gauge')
+            lines.append('%s%s%s %s' % (self.prefix, name, format_labels(labels), format_value(value)))
+        for (name, labels), value in counters:
+            describe(name, 'counter')
+            lines.append('%s%s%s %s' % (self.prefix, name, format_labels(labels), format_value(value)))
+        for (name, labels), hist in histograms:
+            describe(name, 'histogram')
+            counts, total = hist.snapshot()
+            cumulative = 0
+            for bound, count in zip(list(hist.buckets)+['+Inf'], counts):
+                cumulative += count
+                lines.append('%s%s_bucket%s %d' % (self.prefix, name, format_labels(labels+(('le', str(bound)), )), cumulative))
+            lines.append('%s%s_sum%s %s' % (self.prefix, name, format_labels(labels), format_value(total)))
+            lines.append('%s%s_count%s %d' % (self.prefix, name, format_labels(labels), cumulative))
+        return '\n'.join(lines)+'\n'
+
+
+def format_labels(labels):
+    if len(labels)==0:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (label, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for label, value in labels)
+
+
+def format_value(value):
+    if isinstance(value, bool):
+        return '1' if value else '0'
+    if isinstance(value, int):
+        return str(value)
+    return repr(float(value))
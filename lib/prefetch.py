@@ -0,0 +1,134 @@
+#
+# Analyse files with Musly, Essentia, and Bliss, and provide an API to retrieve similar tracks
+#
+# Copyright (c) 2021-2022 Craig Drummond <craig.p.drummond@gmail.com>
+# GPLv3 license.
+#
+
+import collections, logging, os, threading, time
+
+_LOGGER = logging.getLogger(__name__)
+
+
+MAX_PENDING = 500 # Max number of searches waiting to be run, the oldest are dropped
+IDLE_WAIT   = 0.1 # Seconds to wait before checking again whether the server is idle
+
+
+class Prefetcher(object):
+    '''
+    Run searches that are likely to be needed soon, e.g. for the tracks just returned by a mix (as these will be the
+    seeds for the next request), in a low priority background thread whilst the server is idle. Results are cached
+    until used, the least recently added are evicted first, and any older than ttl seconds are discarded. Results of
+    searches added with keep set (i.e. warm-up) are instead kept until clear_kept() is called, and are not removed when
+    used. The thread uses at most budget (0..1) of a CPU - after each search it sleeps, in proportion to the CPU time used.
+    '''
+    def __init__(self, max_entries, ttl, budget, is_idle):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.budget = budget
+        self.is_idle = is_idle
+        self.cache = collections.OrderedDict()   # key -> (time, num_sim, tracks)
+        self.kept = {}                           # key -> (time, num_sim, tracks)
+        self.pending = collections.OrderedDict() # key -> (time, num_sim, func, keep)
+        self.cond = threading.Condition()
+        self.stats = {'queued':0, 'run':0, 'dropped':0, 'hits':0, 'misses':0, 'cpu':0.0}
+        threading.Thread(target=self.run, name='prefetch', daemon=True).start()
+
+
+    def add(self, key, num_sim, func, keep=False):
+        ''' Queue func, which should return num_sim similar tracks, to be run and its result cached against key '''
+        with self.cond:
+            if key in self.pending or (key in self.cache and self.cache[key][1]>=num_sim) or (key in self.kept and self.kept[key][1]>=num_sim):
+                return
+            self.pending[key] = (time.time(), num_sim, func, keep)
+            self.stats['queued'] += 1
+            while len(self.pending)>MAX_PENDING:
+                self.pending.popitem(last=False)
+                self.stats['dropped'] += 1
+            self.cond.notify()
+
+
+    def get(self, key, num_sim):
+        '''
+        Return the first num_sim cached similar tracks for key, or None if not cached (or fewer were searched for).
+        Entries are removed once used, unless kept.
+        '''
+        now = time.time()
+        with self.cond:
+            entry = self.cache.pop(key, None)
+            if entry is not None and now-entry[0]>=self.ttl:
+                entry = None
+            if entry is None:
+                entry = self.kept.get(key)
+            if entry is None or (entry[1]<num_sim and len(entry[2])>=entry[1]):
+                self.stats['misses'] += 1
+                return None
+            self.stats['hits'] += 1
+            return entry[2][:num_sim]
+
+
+    def next_job(self):
+        ''' Wait for the oldest search that has not expired, and for the server to be idle '''
+        while True:
+            with self.cond:
+                while len(self.pending)==0:
+                    self.cond.wait()
+                key, (added, num_sim, func, keep) = next(iter(self.pending.items()))
+                if not keep and time.time()-added>=self.ttl:
+                    del self.pending[key]
+                    self.stats['dropped'] += 1
+                    continue
+            if self.is_idle():
+                with self.cond:
+                    if key in self.pending:
+                        del self.pending[key]
+                        return key, num_sim, func, keep
+            else:
+                time.sleep(IDLE_WAIT)
+
+
+    def run(self):
+        try:
+            # Only Linux allows the priority of a single thread to be lowered
+            os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), 19)
+        except (AttributeError, OSError):
+            pass
+        while True:
+            key, num_sim, func, keep = self.next_job()
+            start = time.thread_time()
+            try:
+                tracks = func()
+            except Exception as e:
+                _LOGGER.debug('Prefetch failed - %s' % str(e))
+                tracks = None
+            used = time.thread_time()-start
+            with self.cond:
+                self.stats['run'] += 1
+                self.stats['cpu'] += used
+                if tracks is not None and keep:
+                    self.kept[key] = (time.time(), num_sim, tracks)
+                elif tracks is not None:
+                    self.cache[key] = (time.time(), num_sim, tracks)
+                    self.cache.move_to_end(key)
+                    while len(self.cache)>self.max_entries:
+                        self.cache.popitem(last=False)
+            if self.budget<1.0:
+                time.sleep(used*(1.0-self.budget)/self.budget)
+
+
+    def clear_kept(self):
+        ''' Remove kept results, and any kept searches that have not yet run '''
+        with self.cond:
+            self.kept.clear()
+            for key in [key for key, job in self.pending.items() if job[3]]:
+                del self.pending[key]
+
+
+    def get_status(self):
+        with self.cond:
+            status = dict(self.stats)
+            status['cpu'] = round(status['cpu'], 3)
+            status['cached'] = len(self.cache)
+            status['kept'] = len(self.kept)
+            status['pending'] = len(self.pending)
+            return status
@@ -0,0 +1,67 @@
+#
+# Analyse files with Musly, Essentia, and Bliss, and provide an API to retrieve similar tracks
+#
+# Copyright (c) 2021-2022 Craig Drummond <craig.p.drummond@gmail.com>
+# GPLv3 license.
+#
+
+import collections, os, sys, threading, time
+
+MIN_INTERVAL = 0.005 # Shortest allowed time between samples, in seconds
+MAX_DEPTH    = 64    # Stacks are cut at this many frames
+IDLE_FILES   = ['selectors.py', 'socketserver.py', 'threading.py', 'queue.py'] # Threads waiting in these are not sampled
+
+
+class Profiler(object):
+    '''
+    Sample the Python stacks of all other threads every interval seconds, and count how often each stack is seen.
+    Threads that are waiting (for a request, a lock, etc.) are skipped. Only one profile may run at a time.
+    '''
+    def __init__(self):
+        self.lock = threading.Lock()
+
+
+    def run(self, seconds, interval):
+        ''' Returns (stacks, samples) - stacks is a Counter of tuples of frames, root first. None if already running. '''
+        if not self.lock.acquire(blocking=False):
+            return None
+        try:
+            interval = max(interval, MIN_INTERVAL)
+            stacks = collections.Counter()
+            samples = 0
+            own = threading.get_ident()
+            end = time.monotonic()+seconds
+            while time.monotonic()<end:
+                for ident, frame in sys._current_frames().items():
+                    if ident!=own and os.path.basename(frame.f_code.co_filename) not in IDLE_FILES:
+                        stacks[get_stack(frame)] += 1
+                samples += 1
+                time.sleep(interval)
+            return stacks, samples
+        finally:
+            self.lock.release()
+
+
+def get_stack(frame):
+    stack = []
+    while frame is not None and len(stack)<MAX_DEPTH:
+        stack.append('%s:%s' % (os.path.basename(frame.f_code.co_filename), frame.f_code.co_name))
+        frame = frame.f_back
+    stack.reverse()
+    return tuple(stack)
+
+
+def collapsed(stacks):
+    ''' Stacks in the collapsed format used by flamegraph.pl, etc. '''
+    return ''.join('%s %d\n' % (';'.join(stack), count) for stack, count in stacks.most_common())
+
+
+def hot_functions(stacks, limit):
+    ''' The limit functions most often seen running (self), with how often each was anywhere on the stack (total) '''
+    own = collections.Counter()
+    total = collections.Counter()
+    for stack, count in stacks.items():
+        own[stack[-1]] += count
+        for func in set(stack):
+            total[func] += count
+    return [{'function':func, 'self':count, 'total':total[func]} for func, count in own.most_common(limit)]
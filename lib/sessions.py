@@ -0,0 +1,122 @@
+#
+# Analyse files with Musly, Essentia, and Bliss, and provide an API to retrieve similar tracks
+#
+# Copyright (c) 2021-2022 Craig Drummond <craig.p.drummond@gmail.com>
+# GPLv3 license.
+#
+
+import collections, logging, threading, time
+
+_LOGGER = logging.getLogger(__name__)
+
+
+MAX_RECENT_TRACKS     = 200 # Max number of recent tracks to remember per session, matches max 'norepart' and 'norepalb'
+MAX_CACHED_NEIGHBOURS = 32  # Max number of similar track lists to keep per session
+
+
+class Session(object):
+    '''
+    State kept between the similarity requests of a mix. recent holds the filter keys (see filter_entry) of the seeds,
+    previous, and returned tracks, most recent first. neighbours caches the similar tracks found for seeds.
+    '''
+    def __init__(self, generation):
+        self.generation = generation
+        self.recent = []
+        self.neighbours = collections.OrderedDict() # search key -> similar tracks, in LRU order
+        self.used = time.time()
+
+
+class Sessions(object):
+    ''' Sessions, by ID. At most max_sessions are kept, and these expire if not used for ttl seconds. '''
+    def __init__(self, max_sessions, ttl):
+        self.max_sessions = max_sessions
+        self.ttl = ttl
+        self.sessions = collections.OrderedDict() # ID -> Session, in LRU order
+        self.lock = threading.Lock()
+
+
+    def expire(self, now):
+        while len(self.sessions)>0:
+            sid, session = next(iter(self.sessions.items()))
+            if now-session.used<self.ttl and len(self.sessions)<=self.max_sessions:
+                break
+            _LOGGER.debug('Expire session %s' % sid)
+            self.sessions.popitem(last=False)
+
+
+    def get_recent(self, sid, gen):
+        '''
+        Return the recent tracks of a session, creating the session if it does not exist. If the tracks have been
+        reloaded since the session was last used, then the IDs of its tracks are updated and its cache cleared.
+        '''
+        now = time.time()
+        with self.lock:
+            self.expire(now)
+            session = self.sessions.get(sid)
+            if session is None:
+                session = self.sessions[sid] = Session(gen.number)
+                self.expire(now)
+            self.sessions.move_to_end(sid)
+            session.used = now
+            if session.generation!=gen.number:
+                session.generation = gen.number
+                session.neighbours.clear()
+                session.recent = [entry for entry in [update_entry(entry, gen) for entry in session.recent] if entry is not None]
+            return list(session.recent)
+
+
+    def set_recent(self, sid, gen, recent):
+        ''' Store the recent tracks of a session, most recent first. Duplicates are removed. '''
+        seen = set()
+        unique = []
+        for entry in recent:
+            if entry['id']>=0 and not entry['id'] in seen:
+                seen.add(entry['id'])
+                unique.append(entry)
+        with self.lock:
+            session = self.sessions.get(sid)
+            if session is not None and session.generation==gen.number:
+                session.recent = unique[:MAX_RECENT_TRACKS]
+
+
+    def get_neighbours(self, sid, gen, key):
+        with self.lock:
+            session = self.sessions.get(sid)
+            if session is None or session.generation!=gen.number or not key in session.neighbours:
+                return None
+            session.neighbours.move_to_end(key)
+            return session.neighbours[key]
+
+
+    def set_neighbours(self, sid, gen, key, tracks):
+        with self.lock:
+            session = self.sessions.get(sid)
+            if session is None or session.generation!=gen.number:
+                return
+            session.neighbours[key] = tracks
+            while len(session.neighbours)>MAX_CACHED_NEIGHBOURS:
+                session.neighbours.popitem(last=False)
+
+
+    def num_sessions(self):
+        with self.lock:
+            return len(self.sessions)
+
+
+def filter_entry(track_id, path, meta, album_key):
+    ''' The details of a track that are needed to filter on previous tracks '''
+    entry = {'id':track_id, 'path':path}
+    if meta:
+        if 'title' in meta:
+            entry['title'] = meta['title']
+        entry['artist'] = meta['artist']
+        entry['album'] = album_key
+    return entry
+
+
+def update_entry(entry, gen):
+    ''' Update the ID of entry, to that of its path in gen. None if no longer in gen. '''
+    if entry['id']<len(gen.paths) and gen.paths[entry['id']]==entry['path']:
+        return entry
+    track_id = gen.get_track_id(entry['path'])
+    return None if track_id is None else dict(entry, id=track_id)
@@ -0,0 +1,65 @@
+#
+# Analyse files with Musly, Essentia, and Bliss, and provide an API to retrieve similar tracks
+#
+# Copyright (c) 2021-2022 Craig Drummond <craig.p.drummond@gmail.com>
+# GPLv3 license.
+#
+
+import threading
+
+
+class Call(object):
+    ''' A call that is in progress, and its result once complete '''
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.waiters = 0
+
+
+class SingleFlight(object):
+    '''
+    Only run one call at a time for each key - callers that ask for a key whose call is already in progress wait
+    for this, and share its result (or exception).
+    '''
+    def __init__(self):
+        self.calls = {} # key -> Call
+        self.lock = threading.Lock()
+
+
+    def num_calls(self):
+        with self.lock:
+            return len(self.calls)
+
+
+    def do(self, key, func, before_wait=None):
+        '''
+        Return (result of func, whether this was shared with another caller). If set, before_wait is called before
+        waiting for another caller's call - e.g. to release resources that are not needed whilst waiting.
+        '''
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = Call()
+            else:
+                call.waiters += 1
+
+        if not leader:
+            if before_wait is not None:
+                before_wait()
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result, True
+
+        try:
+            call.result = func()
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call.done.set()
+        return call.result, call.waiters>0
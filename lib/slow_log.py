@@ -0,0 +1,34 @@
+#
+# Analyse files with Musly, Essentia, and Bliss, and provide an API to retrieve similar tracks
+#
+# Copyright (c) 2021-2022 Craig Drummond <craig.p.drummond@gmail.com>
+# GPLv3 license.
+#
+
+import json, logging, logging.handlers, time
+
+_LOGGER = logging.getLogger(__name__)
+
+
+class SlowLog(object):
+    '''
+    Record requests that took at least threshold seconds, one JSON object per line, so that these can be replayed
+    later (see scripts/replay.py). The file is rotated once it reaches max_bytes, and backups old files are kept.
+    '''
+    def __init__(self, path, threshold, max_bytes, backups):
+        self.threshold = threshold
+        self.handler = logging.handlers.RotatingFileHandler(path, maxBytes=max_bytes, backupCount=backups)
+
+
+    def record(self, method, path, params, status, seconds, generation):
+        if seconds<self.threshold:
+            return
+        entry = {'time':round(time.time(), 3), 'method':method, 'path':path, 'params':params, 'status':status,
+                 'ms':round(seconds*1000.0, 1), 'generation':generation}
+        try:
+            line = json.dumps(entry, sort_keys=True)
+        except (TypeError, ValueError) as e:
+            _LOGGER.debug('Failed to record slow request - %s' % str(e))
+            return
+        # handle() serialises writes, and rotation, with the handler's lock
+        self.handler.handle(logging.makeLogRecord({'msg':line, 'levelno':logging.INFO, 'levelname':'INFO'}))
@@ -0,0 +1,125 @@
+#
+# Analyse files with Musly, Essentia, and Bliss, and provide an API to retrieve similar tracks
+#
+# Copyright (c) 2021-2022 Craig Drummond <craig.p.drummond@gmail.com>
+# GPLv3 license.
+#
+
+import logging, numpy
+
+_LOGGER = logging.getLogger(__name__)
+
+
+METHOD_ALBUMS = 'albums'
+METHOD_GENRES = 'genres'
+
+# Preferred duration ranges, in order, for a track to represent its album - (min, max), None for no limit
+ALBUM_DURATION_TIERS = [(90, 300), (90, 420), (90, 600), (90, None)]
+# ...for tracks to represent a genre, tracks outside of these are not used
+GENRE_DURATION_TIERS = [(90, 300), (301, 420)]
+# ...for any other tracks needed
+OTHER_DURATION_TIERS = [(90, 420), (421, None)]
+
+
+def _factorize(values):
+    ''' Map values to integer codes, None is mapped to -1 '''
+    codes = {}
+    return numpy.array([-1 if v is None else codes.setdefault(v, len(codes)) for v in values], dtype=numpy.int64), codes
+
+
+def _tiers(durations, tiers):
+    ''' Return index of first tier each duration is within, or len(tiers) if not in any '''
+    tier = numpy.full(len(durations), len(tiers), dtype=numpy.int64)
+    for i in reversed(range(len(tiers))):
+        minv, maxv = tiers[i]
+        within = durations>=minv
+        if maxv is not None:
+            within &= durations<=maxv
+        tier[within] = i
+    return tier
+
+
+def _first_of_groups(groups):
+    ''' Given sorted group codes, return mask of the first entry of each group '''
+    first = numpy.ones(len(groups), dtype=bool)
+    first[1:] = groups[1:]!=groups[:-1]
+    return first
+
+
+def load(db):
+    ''' Load album, genre, and duration of each track (in rowid order) '''
+    cursor = db.get_cursor()
+    cursor.execute('SELECT albumartist, album, genre, duration FROM tracks ORDER BY rowid ASC')
+    rows = cursor.fetchall()
+    albums, _ = _factorize([None if row[0] is None or row[1] is None else (row[0], row[1]) for row in rows])
+    genres, _ = _factorize([row[2] for row in rows])
+    # None -> NaN, so that unknown durations are not within any tier
+    durations = numpy.array([row[3] for row in rows], dtype=numpy.float64)
+    return {'albums':albums, 'genres':genres, 'durations':durations}
+
+
+def album_tracks(meta, rng):
+    ''' Choose a random track from each album, preferring tracks within the earliest duration tier '''
+    albums = meta['albums']
+    tier = _tiers(meta['durations'], ALBUM_DURATION_TIERS)
+    order = numpy.lexsort((rng.random(len(albums)), tier, albums))
+    order = order[albums[order]>=0]
+    return order[_first_of_groups(albums[order])]
+
+
+def genre_tracks(meta, count, rng):
+    '''
+    Choose tracks from each genre, in proportion to the number of tracks with this genre. Tracks in the first
+    duration tier are preferred, then the second. Genres with the most tracks are chosen from first.
+    '''
+    genres = meta['genres']
+    num_genres = genres.max()+1 if len(genres)>0 else 0
+    genre_counts = numpy.bincount(genres[genres>=0], minlength=num_genres)
+    amounts = numpy.maximum((genre_counts*float(count)/len(genres)).astype(numpy.int64), 1)
+
+    tier = _tiers(meta['durations'], GENRE_DURATION_TIERS)
+    usable = (genres>=0) & (tier<len(GENRE_DURATION_TIERS))
+    order = numpy.lexsort((rng.random(len(genres)), tier, genres))
+    order = order[usable[order]]
+    # Rank of each track within its genre, so that the first 'amount' of each can be taken
+    sorted_genres = genres[order]
+    starts = numpy.flatnonzero(_first_of_groups(sorted_genres))
+    rank = numpy.arange(len(order)) - numpy.repeat(starts, numpy.diff(numpy.append(starts, len(order))))
+    order = order[rank<amounts[sorted_genres]]
+
+    # Most common genres first
+    genre_order = numpy.argsort(-genre_counts, kind='stable')
+    genre_rank = numpy.empty(num_genres, dtype=numpy.int64)
+    genre_rank[genre_order] = numpy.arange(num_genres)
+    order = order[numpy.argsort(genre_rank[genres[order]], kind='stable')]
+    return order[:count]
+
+
+def other_tracks(meta, count, exclude, rng):
+    ''' Choose random tracks not in exclude, preferring those within the duration tiers '''
+    durations = meta['durations']
+    tier = _tiers(durations, OTHER_DURATION_TIERS)
+    order = numpy.lexsort((rng.random(len(durations)), tier))
+    excluded = numpy.zeros(len(durations), dtype=bool)
+    excluded[exclude] = True
+    return order[~excluded[order]][:count]
+
+
+def select(db, method, count):
+    ''' Select (up to) count track IDs to be used to set Musly's music style '''
+    rng = numpy.random.default_rng()
+    meta = load(db)
+    if METHOD_ALBUMS==method:
+        _LOGGER.debug('Select style track from each album')
+        tracks = album_tracks(meta, rng)
+        _LOGGER.debug('Num album style tracks: %d, required style tracks: %d' % (len(tracks), count))
+        if len(tracks)>count:
+            tracks = rng.choice(tracks, count, replace=False)
+    elif METHOD_GENRES==method:
+        tracks = genre_tracks(meta, count, rng)
+    else:
+        return []
+    if len(tracks)<count:
+        _LOGGER.debug('Choosing another %d tracks from DB' % (count-len(tracks)))
+        tracks = numpy.concatenate((tracks, other_tracks(meta, count-len(tracks), tracks, rng)))
+    return tracks.tolist()
@@ -0,0 +1,63 @@
+#
+# Analyse files with Musly, Essentia, and Bliss, and provide an API to retrieve similar tracks
+#
+# Copyright (c) 2021-2022 Craig Drummond <craig.p.drummond@gmail.com>
+# GPLv3 license.
+#
+
+import collections, json, logging, threading, time
+
+_LOGGER = logging.getLogger(__name__)
+
+
+DISCARD_REASONS = ['notfound', 'ignore', 'duration', 'genre', 'xmas'] # Any other reason is a filter
+
+
+class Funnel(object):
+    ''' How the similar tracks of one seed were whittled down to those accepted '''
+    def __init__(self, seed, num_sim):
+        self.seed = seed
+        self.num_sim = num_sim
+        self.searches = 1
+        self.examined = 0
+        self.reasons = collections.Counter() # Reason -> number of tracks discarded, or filtered
+        self.accepted = 0
+
+
+    def to_dict(self):
+        return {'seed':self.seed, 'num_sim':self.num_sim, 'searches':self.searches, 'examined':self.examined,
+                'discarded':{reason:num for reason, num in self.reasons.items() if reason in DISCARD_REASONS},
+                'filtered':{reason:num for reason, num in self.reasons.items() if not reason in DISCARD_REASONS},
+                'accepted':self.accepted}
+
+
+class TraceLog(object):
+    '''
+    Write traces of similarity requests, one JSON object per line, to path - or to the log (at INFO) if path is not
+    set. Requests that ask to be traced are always written, and 1 in every sample others (if sample>0).
+    '''
+    def __init__(self, path, sample):
+        self.path = path
+        self.sample = sample
+        self.requests = 0
+        self.lock = threading.Lock()
+
+
+    def wanted(self, requested):
+        with self.lock:
+            self.requests += 1
+            return requested or (self.sample>0 and 0==self.requests%self.sample)
+
+
+    def write(self, entry):
+        entry = dict(entry, time=round(time.time(), 3))
+        line = json.dumps(entry, sort_keys=True)
+        if self.path is None:
+            _LOGGER.info('TRACE %s' % line)
+            return
+        with self.lock:
+            try:
+                with open(self.path, 'a') as f:
+                    f.write(line+'\n')
+            except OSError as e:
+                _LOGGER.error('Failed to write trace to %s - %s' % (self.path, str(e)))
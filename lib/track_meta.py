@@ -0,0 +1,165 @@
+#
+# Analyse files with Musly, Essentia, and Bliss, and provide an API to retrieve similar tracks
+#
+# Copyright (c) 2021-2022 Craig Drummond <craig.p.drummond@gmail.com>
+# GPLv3 license.
+#
+
+import logging, numpy
+from . import filters, memory, tracks_db
+
+_LOGGER = logging.getLogger(__name__)
+
+
+MAX_CACHED_MASKS = 16
+WORD_BITS        = 64
+
+
+def has_genre(bits, mask):
+    ''' Return whether each bitset in bits has any genre of mask '''
+    return numpy.any(bits & mask, axis=-1)
+
+
+class TrackMeta(object):
+    '''
+    Metadata that is needed for every request, held in memory and indexed by track ID. If base (a TrackMeta) is set
+    then its metadata is copied, and only that of the tracks added to the DB since base was loaded is read.
+    '''
+    def __init__(self, db, base=None):
+        first = 0 if base is None else base.total_tracks
+        _LOGGER.debug('Loading metadata from DB, from track %d' % first)
+        cursor = db.get_cursor()
+        index = {} if base is None else dict(base.genre_index)
+        names = [] if base is None else list(base.genre_names)
+        set_tracks = [] # (track ID, genre bit) for each genre of each track
+        track_ignored = []
+        col_names = ['duration', 'bpm']
+        if db.use_essentia_hl:
+            col_names += tracks_db.ESSENTIA_HIGHLEVEL_ATTRIBS
+        col_vals = []
+        cursor.execute('SELECT genre, ignore, %s FROM tracks WHERE rowid>? ORDER BY rowid ASC' % ', '.join(col_names), (first, ))
+        for row in cursor:
+            if row[0]:
+                for genre in set(row[0].split(tracks_db.GENRE_SEPARATOR)):
+                    if genre not in index:
+                        index[genre] = len(names)
+                        names.append(genre)
+                    set_tracks.append((first+len(track_ignored), index[genre]))
+            track_ignored.append(row[1] is not None and row[1]==1)
+            col_vals.append(row[2:])
+        self.genre_index = index  # Genre name -> bit number
+        self.genre_names = names  # Bit number -> genre name
+        self.total_tracks = first+len(track_ignored)
+        # Genres of each track, as a row of uint64 words of bits
+        self.genre_bits = numpy.zeros((self.total_tracks, max(1, (len(names)+WORD_BITS-1)//WORD_BITS)), dtype=numpy.uint64)
+        if base is not None:
+            self.genre_bits[:first, :base.genre_bits.shape[1]] = base.genre_bits
+        if len(set_tracks)>0:
+            ids, bits = numpy.array(set_tracks, dtype=numpy.int64).T
+            numpy.bitwise_or.at(self.genre_bits, (ids, bits//WORD_BITS), numpy.left_shift(numpy.uint64(1), (bits%WORD_BITS).astype(numpy.uint64)))
+        self.no_genre = ~self.genre_bits.any(axis=1)
+        _LOGGER.debug('%d genre(s)' % len(names))
+        # None -> NaN, so that (as in SQL) unset values never match a range. Used for attribute mixes.
+        vals = numpy.array(col_vals, dtype=numpy.float64).reshape(len(col_vals), len(col_names))
+        self.columns = {name:vals[:, i].copy() if base is None else numpy.concatenate((base.columns[name], vals[:, i])) for i, name in enumerate(col_names)}
+        self.durations = numpy.nan_to_num(self.columns['duration'], nan=0.0).astype(numpy.int32) # 0 if not known
+        self.ignored = numpy.array(track_ignored, dtype=bool)
+        if base is not None:
+            self.ignored = numpy.concatenate((base.ignored, self.ignored))
+        self.christmas = has_genre(self.genre_bits, self.genre_mask(filters.CHRISTMAS_GENRES))
+        self.eligible_masks = {}  # (min_duration, max_duration, exclude_christmas) -> mask
+
+
+    def memory_usage(self):
+        masks = list(self.eligible_masks.values())
+        nbytes = sum(array.nbytes for array in [self.genre_bits, self.no_genre, self.durations, self.ignored, self.christmas]+
+                     list(self.columns.values())+masks)
+        return memory.usage(nbytes, self.total_tracks, genres=len(self.genre_names), masks=len(masks))
+
+
+    def genre_mask(self, genres):
+        ''' Convert genre names into a bitset, genres not in the library are ignored as no track can match these '''
+        mask = numpy.zeros(self.genre_bits.shape[1], dtype=numpy.uint64)
+        for genre in genres:
+            if genre in self.genre_index:
+                bit = self.genre_index[genre]
+                mask[bit//WORD_BITS] |= numpy.uint64(1)<<numpy.uint64(bit%WORD_BITS)
+        return mask
+
+
+    def mask_genres(self, mask):
+        ''' Convert a bitset back into a set of genre names '''
+        return set(self.genre_names[bit] for bit in range(len(self.genre_names)) if (int(mask[bit//WORD_BITS])>>(bit%WORD_BITS))&1)
+
+
+    def genre_matches(self, ids, acceptable, all_genres):
+        '''
+        Vectorised filters.genre_matches for tracks IDs. acceptable and all_genres are bitsets, all_genres may be
+        None if no genre groups are configured.
+        '''
+        bits = self.genre_bits[ids]
+        if acceptable.any():
+            return self.no_genre[ids] | has_genre(bits, acceptable)
+        if all_genres is None:
+            return numpy.ones(len(ids), dtype=bool)
+        # No acceptable genres, so filter out any track in a genre group
+        return self.no_genre[ids] | ~has_genre(bits, all_genres)
+
+
+    def genre_adjust(self, ids, seed, acceptable, all_genres, no_genre_match_adj, genre_group_adj):
+        '''
+        Amount to add to the similarity of each track, depending upon how its genres match those of the seed. 0 if a
+        genre is shared, genre_group_adj if a genre is in acceptable (or all_genres if acceptable is None), otherwise
+        no_genre_match_adj. All genre parameters are bitsets.
+        '''
+        adj = numpy.full(len(ids), no_genre_match_adj)
+        if not seed.any():
+            return adj
+        bits = self.genre_bits[ids]
+        group_mask = acceptable if acceptable is not None else all_genres
+        if group_mask is not None:
+            adj[has_genre(bits, group_mask)] = genre_group_adj
+        else:
+            adj[:] = genre_group_adj
+        adj[has_genre(bits, seed)] = 0.0
+        adj[self.no_genre[ids]] = no_genre_match_adj
+        return adj
+
+
+    def eligible(self, min_duration, max_duration, exclude_christmas):
+        '''
+        Return mask of tracks that pass the cheap 'hard' filters - ignore, duration, and Christmas. This matches
+        filters.check_duration and filters.is_christmas, so can be pushed down into the similarity search.
+        '''
+        key = (min_duration, max_duration, exclude_christmas)
+        masks = self.eligible_masks
+        if key in masks:
+            return masks[key]
+        mask = ~self.ignored
+        if min_duration>0 or max_duration>0:
+            dur_ok = numpy.ones(self.total_tracks, dtype=bool)
+            if min_duration>0:
+                dur_ok &= self.durations>=min_duration
+            if max_duration>0:
+                dur_ok &= self.durations<=max_duration
+            mask &= dur_ok | (self.durations<=0) # No duration to check!
+        if exclude_christmas:
+            mask &= ~self.christmas
+        if len(masks)>=MAX_CACHED_MASKS:
+            self.eligible_masks = masks = {}
+        masks[key] = mask
+        return mask
+
+
+    def select(self, ranges):
+        '''
+        Return IDs, in a random order, of tracks that are not ignored and whose values are within the given ranges.
+        ranges is a list of (column, min, max) - where min or max may be None.
+        '''
+        mask = ~self.ignored
+        for col, minv, maxv in ranges:
+            if minv is not None:
+                mask &= self.columns[col]>=minv
+            if maxv is not None:
+                mask &= self.columns[col]<=maxv
+        return numpy.random.permutation(numpy.flatnonzero(mask))
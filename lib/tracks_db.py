@@ -5,7 +5,7 @@
 # GPLv3 license.
 #
 
-import json, logging, os, sqlite3
+import json, logging, os, sqlite3, threading
 from . import cue, tags
 
 DB_FILE = 'music-similarity.db'
@@ -13,10 +13,25 @@ GENRE_SEPARATOR = ';'
 _LOGGER = logging.getLogger(__name__)
 ESSENTIA_HIGHLEVEL_ATTRIBS = ['danceable', 'aggressive', 'electronic', 'acoustic', 'happy', 'party', 'relaxed', 'sad', 'dark', 'tonal', 'voice']
 ESSENTIA_LOWLEVEL_ATTRIBS = ['bpm', 'key']
+MAX_QUERY_IDS = 500 # Max number of IDs per 'IN (...)' query, SQLite limits the number of parameters
+NORMALIZED_COLS = ['ntitle', 'nartist', 'nalbum', 'nalbumartist'] # Normalised versions of title, artist, album, and albumartist
 
 album_rem = ['anniversary edition', 'deluxe edition', 'expanded edition', 'extended edition', 'special edition', 'deluxe', 'deluxe version', 'extended deluxe', 'super deluxe', 're-issue', 'remastered', 'mixed', 'remixed and remastered']
 artist_rem = ['feat', 'ft', 'featuring']
 title_rem = ['demo', 'demo version', 'radio edit', 'remastered', 'session version', 'live', 'live acoustic', 'acoustic', 'industrial remix', 'alternative version', 'alternate version', 'original mix', 'bonus track', 're-recording', 'alternate']
+open_lock = threading.Lock()
+open_connections = 0 # Number of TracksDb objects that have not been closed, to catch leaks
+
+
+def set_open(change):
+    global open_connections
+    with open_lock:
+        open_connections += change
+
+
+def get_open_connections():
+    with open_lock:
+        return open_connections
 
 
 def normalize_str(s):
@@ -60,13 +75,22 @@ def normalize_title(title):
     return normalize_str(s)
 
 
+def normalize_names(title, artist, album, albumartist):
+    return (normalize_title(title), normalize_artist(artist), normalize_album(album), normalize_artist(albumartist))
+
+
+def normalize_options():
+    ''' Current normalisation settings, stored in DB so that we can tell if names need to be normalised again '''
+    return json.dumps({'album':album_rem, 'artist':artist_rem, 'title':title_rem}, sort_keys=True)
+
+
 def set_normalize_options(opts):
     if 'album' in opts and isinstance(opts['album'], list):
         global album_rem
         album_rem = [e.lower() for e in opts['album']]
     if 'artist' in opts and isinstance(opts['artist'], list):
         global artist_rem
-        artist_rem = [e.lower() for e in opts['album']]
+        artist_rem = [e.lower() for e in opts['artist']]
     if 'title' in opts and isinstance(opts['title'], list):
         global title_rem
         title_rem = [e.lower() for e in opts['title']]
@@ -80,9 +104,11 @@ class TracksDb(object):
         self.use_essentia_hl = config['essentia']['enabled'] and config['essentia']['highlevel']
         self.conn = None
         self.cursor = None
+        self.use_normalized = False # Stored normalised names match current settings?
         if create or os.path.exists(path):
             self.conn = sqlite3.connect(path)
             self.cursor = self.conn.cursor()
+            set_open(1)
             if create:
                 for table in ['tracks', 'tracks_tmp']:
                     if config['essentia']['highlevel']:
@@ -143,7 +169,22 @@ class TracksDb(object):
                             except:
                                 pass
 
+                    for col in NORMALIZED_COLS:
+                        try:
+                            self.cursor.execute('ALTER TABLE %s ADD COLUMN %s varchar default null' % (table, col))
+                        except:
+                            pass
+
                 self.cursor.execute('CREATE UNIQUE INDEX IF NOT EXISTS tracks_idx ON tracks(file)')
+                # Indexes for the album and artist lookups of get_album_track_ids and get_artist_track_ids
+                self.cursor.execute('CREATE INDEX IF NOT EXISTS tracks_album_lookup_idx ON tracks(album, albumartist)')
+                self.cursor.execute('CREATE INDEX IF NOT EXISTS tracks_artist_idx ON tracks(artist)')
+                self.cursor.execute('CREATE INDEX IF NOT EXISTS tracks_albumartist_idx ON tracks(albumartist)')
+                # Style tracks are now selected in memory, so the indexes for their queries are no longer needed
+                for idx in ['tracks_nalbum_idx', 'tracks_album_idx', 'tracks_genre_idx', 'tracks_duration_idx']:
+                    self.cursor.execute('DROP INDEX IF EXISTS %s' % idx)
+                self.cursor.execute('CREATE TABLE IF NOT EXISTS settings (key varchar UNIQUE NOT NULL, value varchar)')
+            self.use_normalized = self.get_setting('normalize')==normalize_options()
 
 
     def commit(self):
@@ -155,6 +196,8 @@ class TracksDb(object):
         if self.conn is not None:
             self.cursor.close()
             self.conn.close()
+            self.conn = None
+            set_open(-1)
 
 
     def add(self, path, musly, essentia, bliss, meta, bpm):
@@ -191,48 +234,116 @@ class TracksDb(object):
 
     def get_track(self, i, withFile=False):
         try:
-            cols = 'title, artist, album, albumartist, genre, duration, ignore'
-            if self.use_essentia:
-                for ess in ESSENTIA_LOWLEVEL_ATTRIBS:
-                    cols+=', %s' % ess
-                if self.use_essentia_hl:
-                    for ess in ESSENTIA_HIGHLEVEL_ATTRIBS:
-                        cols+=', %s' % ess
-            elif self.use_bliss:
-                cols+=', bpm'
-            if withFile:
-                cols+=', file'
-            self.cursor.execute('SELECT %s FROM tracks WHERE rowid=%d' % (cols, i))
-            row = self.cursor.fetchone()
-            meta = {'title':normalize_title(row[0]), 'artist':normalize_artist(row[1]), 'album':normalize_album(row[2]), 'albumartist':normalize_artist(row[3]), 'duration':row[5]}
-            if row[4] and len(row[4])>0:
-                meta['genres']=set(row[4].split(GENRE_SEPARATOR))
-            meta['ignore']=row[6] is not None and row[6]==1
-
-            col = 7
-            if self.use_essentia:
-                for ess in ESSENTIA_LOWLEVEL_ATTRIBS:
-                    meta[ess]=row[col]
-                    col+=1
-                if self.use_essentia_hl:
-                    for ess in ESSENTIA_HIGHLEVEL_ATTRIBS:
-                        meta[ess]=row[col]
-                        col+=1
-            elif self.use_bliss:
-                meta['bpm']=row[col]
-                col+=1
-            if withFile:
-                meta['file']=row[col]
-            return meta
+            self.cursor.execute('SELECT %s FROM tracks WHERE rowid=%d' % (self.track_cols(withFile), i))
+            return self.to_meta(self.cursor.fetchone(), withFile)
         except Exception as e:
             _LOGGER.error('Failed to read metadata for %d - %s' % (i, str(e)))
             pass
         return None
 
 
+    def get_tracks(self, ids):
+        ''' Get metadata of several tracks, with one query per MAX_QUERY_IDS. Returns a dict of rowid -> metadata. '''
+        tracks = {}
+        cols = self.track_cols(False)
+        for i in range(0, len(ids), MAX_QUERY_IDS):
+            batch = ids[i:i+MAX_QUERY_IDS]
+            try:
+                self.cursor.execute('SELECT rowid, %s FROM tracks WHERE rowid IN (%s)' % (cols, ', '.join(['?']*len(batch))), batch)
+                for row in self.cursor.fetchall():
+                    tracks[row[0]] = self.to_meta(row[1:], False)
+            except Exception as e:
+                _LOGGER.error('Failed to read metadata - %s' % str(e))
+        return tracks
+
+
+    def track_cols(self, withFile):
+        cols = 'title, artist, album, albumartist, genre, duration, ignore'
+        if self.use_normalized:
+            cols+=', %s' % ', '.join(NORMALIZED_COLS)
+        if self.use_essentia:
+            for ess in ESSENTIA_LOWLEVEL_ATTRIBS:
+                cols+=', %s' % ess
+            if self.use_essentia_hl:
+                for ess in ESSENTIA_HIGHLEVEL_ATTRIBS:
+                    cols+=', %s' % ess
+        elif self.use_bliss:
+            cols+=', bpm'
+        if withFile:
+            cols+=', file'
+        return cols
+
+
+    def to_meta(self, row, withFile):
+        ''' Convert a row, of the columns from track_cols(), into a metadata dict '''
+        col = 7
+        names = None
+        if self.use_normalized:
+            # Use stored normalised names, unless track was added before these were stored
+            col+=len(NORMALIZED_COLS)
+            if any(v is not None for v in row[7:col]):
+                names = row[7:col]
+        if names is None:
+            names = normalize_names(row[0], row[1], row[2], row[3])
+        meta = {'title':names[0], 'artist':names[1], 'album':names[2], 'albumartist':names[3], 'duration':row[5]}
+        if row[4] and len(row[4])>0:
+            meta['genres']=set(row[4].split(GENRE_SEPARATOR))
+        meta['ignore']=row[6] is not None and row[6]==1
+
+        if self.use_essentia:
+            for ess in ESSENTIA_LOWLEVEL_ATTRIBS:
+                meta[ess]=row[col]
+                col+=1
+            if self.use_essentia_hl:
+                for ess in ESSENTIA_HIGHLEVEL_ATTRIBS:
+                    meta[ess]=row[col]
+                    col+=1
+        elif self.use_bliss:
+            meta['bpm']=row[col]
+            col+=1
+        if withFile:
+            meta['file']=row[col]
+        return meta
+
+
+    def analyze(self):
+        ''' Update the statistics SQLite uses to choose indexes, should be called after tracks are added or removed '''
+        self.commit()
+        self.cursor.execute('ANALYZE')
+        self.commit()
+
+
+    def get_setting(self, key):
+        try:
+            self.cursor.execute('SELECT value FROM settings WHERE key=?', (key,))
+            row = self.cursor.fetchone()
+            return row[0] if row is not None else None
+        except:
+            # Older DB, without settings table
+            return None
+
+
+    def normalize_all(self):
+        ''' Store normalised names of all tracks, needs to be called if the 'normalize' settings change '''
+        _LOGGER.info('Normalising track names')
+        self.cursor.execute('SELECT title, artist, album, albumartist, rowid FROM tracks')
+        rows = self.cursor.fetchall()
+        self.cursor.executemany('UPDATE tracks SET %s=? WHERE rowid=?' % '=?, '.join(NORMALIZED_COLS), [normalize_names(*row[:4]) + (row[4],) for row in rows])
+        self.cursor.execute('INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)', ('normalize', normalize_options()))
+        self.commit()
+        self.use_normalized = True
+
+
+    def normalize_if_required(self):
+        if not self.use_normalized:
+            self.normalize_all()
+
+
     def update_metadata(self, path, meta):
         #if not self.file_entry_exists(path):
         #    self.cursor.execute('INSERT INTO tracks (file) VALUES (?)', (path))
+        self.cursor.execute('UPDATE tracks SET %s=? WHERE file=?' % '=?, '.join(NORMALIZED_COLS),
+                            normalize_names(meta['title'], meta['artist'], meta['album'], meta['albumartist'] if 'albumartist' in meta else None) + (path,))
 
         if not 'albumartist' in meta or meta['albumartist'] is None:
             if not 'genres' in meta or meta['genres'] is None:
@@ -390,114 +501,37 @@ class TracksDb(object):
             return False
 
 
-    def get_albums(self):
-        albums = []
-        self.cursor.execute('SELECT distinct albumartist, album FROM tracks')
-        rows = self.cursor.fetchall()
-        for row in rows:
-            albums.append({'artist':row[0], 'title':row[1]})
-        return albums
+    def get_album_track_ids(self, artist, album):
+        ''' Get IDs (0..) of the tracks on an album '''
+        self.cursor.execute('SELECT rowid FROM tracks WHERE album=? AND (albumartist=? OR (albumartist IS NULL AND artist=?)) ORDER BY rowid', (album, artist, artist))
+        return [row[0]-1 for row in self.cursor.fetchall()]
 
 
-    def num_tracks(self):
-        self.cursor.execute('SELECT count(*) FROM tracks')
-        row = self.cursor.fetchone()
-        if row is not None:
-            return int(row[0])
-        return 0
+    def get_artist_track_ids(self, artist):
+        ''' Get IDs (0..) of the tracks by, or on albums of, an artist '''
+        self.cursor.execute('SELECT rowid FROM tracks WHERE artist=? OR albumartist=? ORDER BY rowid', (artist, artist))
+        return [row[0]-1 for row in self.cursor.fetchall()]
 
 
-    def get_genres_with_count(self):
-        genres = []
-        self.cursor.execute('SELECT distinct genre from tracks')
-        rows = self.cursor.fetchall()
-        for row in rows:
-            self.cursor.execute('SELECT count(*) FROM tracks WHERE genre=?', (row[0],))
-            cr = self.cursor.fetchone()
-            if cr is not None:
-                genres.append({'genre':row[0], 'count':cr[0]})
-        return genres
+    def get_paths(self, first=0):
+        ''' Get path of each track, from ID first onwards, indexed by ID (0..) '''
+        self.cursor.execute('SELECT file FROM tracks WHERE rowid>? ORDER BY rowid ASC', (first, ))
+        return [row[0] for row in self.cursor.fetchall()]
 
 
-    def get_sample_track(self, album):
-        ''' Get a random track betwen 60 and 5mins '''
-        self.cursor.execute('SELECT rowid from tracks where albumartist=? and album=? and duration>=90 and duration<=300 order by random() limit 1', (album['artist'], album['title']))
+    def get_path(self, i):
+        ''' Get path of track with ID i (0..) '''
+        self.cursor.execute('SELECT file FROM tracks WHERE rowid=?', (i+1, ))
         row = self.cursor.fetchone()
-        if row is None:
-            self.cursor.execute('SELECT rowid from tracks where albumartist=? and album=? and duration>=90 and duration<=420 order by random() limit 1', (album['artist'], album['title']))
-            row = self.cursor.fetchone()
-        if row is None:
-            self.cursor.execute('SELECT rowid from tracks where albumartist=? and album=? and duration>=90 and duration<=600 order by random() limit 1', (album['artist'], album['title']))
-            row = self.cursor.fetchone()
-        if row is None:
-            self.cursor.execute('SELECT rowid from tracks where albumartist=? and album=? and duration>=90 order by random() limit 1', (album['artist'], album['title']))
-            row = self.cursor.fetchone()
-        if row is None:
-            self.cursor.execute('SELECT rowid from tracks where albumartist=? and album=? order by random() limit 1', (album['artist'], album['title']))
-            row = self.cursor.fetchone()
-        if row is None:
-            return None
-        return row[0]
-
-
-    def get_sample_genre_tracks(self, genre, count):
-        tracks=[]
-        self.cursor.execute('SELECT rowid from tracks where genre=? and duration>=90 and duration<=300 order by random() limit ?', (genre, count))
-        rows = self.cursor.fetchall()
-        if rows is not None:
-            for row in rows:
-                tracks.append(row[0]-1)
-        if len(tracks)>=count:
-            return tracks
+        return row[0] if row is not None else None
 
-        self.cursor.execute('SELECT rowid from tracks where genre=? and duration>300 and duration<=420 order by random() limit ?', (genre, count))
-        rows = self.cursor.fetchall()
-        if rows is not None:
-            for row in rows:
-                tracks.append(row[0]-1)
-        return tracks
 
-
-    def get_other_sample_tracks(self, limit, exclude):
-        tracks=[]
-        exclude_set = set(exclude)
-        self.cursor.execute('SELECT rowid from tracks where duration>=90 and duration<=420 order by random()')
-        rows = self.cursor.fetchall()
-        for row in rows:
-            index = row[0]-1
-            if index not in exclude_set:
-                tracks.append(index)
-                if len(tracks)==limit:
-                    return tracks
-        if len(tracks)<limit:
-            self.cursor.execute('SELECT rowid from tracks where duration>=420 order by random()')
-            rows = self.cursor.fetchall()
-            for row in rows:
-                index = row[0]-1
-                if index not in exclude_set:
-                    tracks.append(index)
-                    if len(tracks)==limit:
-                        return tracks
-        if len(tracks)<limit:
-            self.cursor.execute('SELECT rowid from tracks order by random()')
-            rows = self.cursor.fetchall()
-            for row in rows:
-                index = row[0]-1
-                if index not in exclude_set:
-                    tracks.append(index)
-                    if len(tracks)==limit:
-                        return tracks
-        return tracks
-
-
-    def get_track_ids(self, filters):
-        sql = 'SELECT rowid FROM tracks WHERE ignore IS NOT 1'
-        for f in filters:
-            sql += ' AND %s' % f
-        sql += ' ORDER BY random()'
-        _LOGGER.debug('Select tracks using SQL:%s' % sql)
-        self.cursor.execute(sql)
-        return self.cursor.fetchall()
+    def num_tracks(self):
+        self.cursor.execute('SELECT count(*) FROM tracks')
+        row = self.cursor.fetchone()
+        if row is not None:
+            return int(row[0])
+        return 0
 
 
     def get_genres(self):
@@ -0,0 +1,78 @@
+#
+# Analyse files with Musly, Essentia, and Bliss, and provide an API to retrieve similar tracks
+#
+# Copyright (c) 2021-2022 Craig Drummond <craig.p.drummond@gmail.com>
+# GPLv3 license.
+#
+
+import logging, math, numpy
+from . import knn, memory
+
+_LOGGER = logging.getLogger(__name__)
+
+
+class VectorSim(object):
+    '''
+    Attribute vectors of all tracks, indexed by track ID, and a nearest neighbour index over these. Subclasses read
+    the vectors from the DB, and pass these to set_vectors. weight_groups maps the names that may be used in the
+    'weights' API parameter to the columns they weight.
+    '''
+    weight_groups = {}
+
+    def set_vectors(self, attrib_list, cfg, metric, base=None, merge=False):
+        '''
+        Store attrib_list, and build the index. If base is set then attrib_list holds only the tracks added since base
+        was loaded - unless merge is True these are placed in a delta index, searched alongside base's (shared) index.
+        '''
+        self.attrib_list = attrib_list if base is None else numpy.concatenate((base.attrib_list, attrib_list))
+        self.total_tracks = len(self.attrib_list)
+        self.delta = None
+        if base is None or merge:
+            self.index = knn.Index(self.attrib_list, cfg['knn']['method'], metric, cfg['knn']['chunksize'], cfg['knn']['weightcache'])
+        else:
+            self.index = base.index
+            self.delta = knn.Index(self.attrib_list[len(self.index):], knn.METHOD_BRUTE, self.index.metric, cfg['knn']['chunksize'], 0, numpy.arange(len(self.index), self.total_tracks))
+        self.max_sim = 2.0 if knn.METRIC_COSINE==self.index.metric else math.sqrt(self.attrib_list.shape[1]) # Cosine distance range is 0..2
+
+
+    def memory_usage(self):
+        ''' Estimated size of the attributes, and indexes. A delta's main index is shared with the previous generation. '''
+        index = self.index.memory_usage(self.attrib_list)
+        nbytes = self.attrib_list.nbytes+index['bytes']+(0 if self.delta is None else self.delta.memory_usage()['bytes'])
+        return memory.usage(nbytes, self.total_tracks, delta=0 if self.delta is None else len(self.delta),
+                            trees=index['trees'], partitions=index['partitions'])
+
+
+    def init_partitions(self, partitions):
+        ''' Build indexes for list of (key, track IDs) partitions up front '''
+        for key, ids in partitions:
+            self.index.partition(key, ids)
+
+
+    def get_similars(self, track_id, num_tracks, weights=None):
+        return self.get_batch_similars([track_id], num_tracks, weights)[0]
+
+
+    def get_batch_similars(self, track_ids, num_tracks, weights=None, partitions=None, mask=None):
+        '''
+        Get similar tracks for several seeds with one index query. weights maps weight_groups names to weights. If
+        partitions (a list of (key, track IDs)) is set then only the tracks within these are searched. If mask (array
+        of booleans, indexed by track ID) is set then only tracks where this is True are returned.
+        '''
+        return self._query(self.attrib_list[track_ids], num_tracks, weights, partitions, mask)
+
+
+    def get_centroid_similars(self, track_ids, seed_weights, num_tracks, weights=None, partitions=None, mask=None):
+        '''
+        Get similar tracks to the weighted centroid of several seeds, with a single index query. seed_weights
+        gives the relative weight of each seed. Other parameters are as for get_batch_similars.
+        '''
+        return self._query(knn.centroid(self.attrib_list[track_ids], seed_weights, self.index.metric), num_tracks, weights, partitions, mask)[0]
+
+
+    def _query(self, seeds, num_tracks, weights, partitions, mask):
+        if num_tracks>self.total_tracks or num_tracks<0:
+            num_tracks = self.total_tracks
+        wvec = knn.weights_vector(self.weight_groups, self.attrib_list.shape[1], weights)
+        distances, indexes = knn.query_delta(self.index, self.delta, seeds, num_tracks, wvec, partitions, mask)
+        return [knn.to_entries(distances[i], indexes[i], self.max_sim) for i in range(len(seeds))]
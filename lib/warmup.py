@@ -0,0 +1,47 @@
+#
+# Analyse files with Musly, Essentia, and Bliss, and provide an API to retrieve similar tracks
+#
+# Copyright (c) 2021-2022 Craig Drummond <craig.p.drummond@gmail.com>
+# GPLv3 license.
+#
+
+import logging, os, sqlite3
+
+_LOGGER = logging.getLogger(__name__)
+
+
+PERSIST_DB = 'persist.db' # Newer LMS versions store play counts in this, alongside library.db
+
+
+def query_played(db, count):
+    ''' Return URLs of the most played tracks, followed by the most recently played '''
+    cursor = db.cursor()
+    urls = []
+    cursor.execute('SELECT url FROM tracks_persistent WHERE playCount>0 ORDER BY playCount DESC LIMIT ?', (count, ))
+    urls += [row[0] for row in cursor.fetchall()]
+    cursor.execute('SELECT url FROM tracks_persistent WHERE lastPlayed IS NOT NULL ORDER BY lastPlayed DESC LIMIT ?', (count, ))
+    urls += [row[0] for row in cursor.fetchall()]
+    return urls
+
+
+def get_played_tracks(lms_db_path, count):
+    '''
+    Read the URLs of up to count most played, and count most recently played, tracks from the LMS DB. These are
+    read from library.db, or (if this has no tracks_persistent table) persist.db in the same folder.
+    '''
+    for path in [lms_db_path, os.path.join(os.path.dirname(lms_db_path), PERSIST_DB)]:
+        if not os.path.exists(path):
+            continue
+        try:
+            db = sqlite3.connect('file:%s?mode=ro' % path, uri=True)
+            try:
+                urls = query_played(db, count)
+            finally:
+                db.close()
+        except sqlite3.Error as e:
+            _LOGGER.debug('Failed to read played tracks from %s - %s' % (path, str(e)))
+            continue
+        # Remove duplicates, but keep order
+        return list(dict.fromkeys(urls))
+    _LOGGER.warning('Failed to read played tracks from LMS DB')
+    return []
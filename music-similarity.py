@@ -26,6 +26,7 @@ if __name__=='__main__':
     parser.add_argument('-t', '--test', action='store_true', default=False, help='Test musly')
     parser.add_argument('-r', '--repeat', action='store_true', default=False, help='Repeat test until OK (used in conjuction with --test)')
     parser.add_argument('-u', '--update-db', action='store_true', default=False, help='Update database to remove contraints')
+    parser.add_argument('-n', '--normalize', action='store_true', default=False, help="Update stored normalised names (use after changing 'normalize' in config)")
     args = parser.parse_args()
     logging.basicConfig(format='%(asctime)s %(levelname).1s %(message)s', level=args.log_level, datefmt='%Y-%m-%d %H:%M:%S')
     cfg = config.read_config(args.config, args.analyse)
@@ -34,6 +35,10 @@ if __name__=='__main__':
     if args.update_db:
         db = tracks_db.TracksDb(cfg, False)
         db.update_if_required()
+    elif args.normalize:
+        db = tracks_db.TracksDb(cfg, True)
+        db.normalize_all()
+        db.close()
     elif args.analyse:
         path = cfg['paths']['local'] if args.analyse =='m' else args.analyse
         analysis.analyse_files(cfg, path, not args.keep_old, args.meta_only, args.force, jukebox_file, args.max_tracks, args.dry_run)
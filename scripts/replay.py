@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+
+#
+# Analyse files with Musly, Essentia, and Bliss, and provide an API to retrieve similar tracks
+#
+# Copyright (c) 2021-2022 Craig Drummond <craig.p.drummond@gmail.com>
+# GPLv3 license.
+#
+
+import argparse, json, os, sys, time, urllib.parse, urllib.request, urllib.error
+
+JUKEBOX_FILE = 'music-similarity.jukebox'
+
+
+def info(s):
+    print("INFO: %s" % s)
+
+
+def error(s):
+    print("ERROR: %s" % s)
+    exit(-1)
+
+
+def read_entries(files):
+    entries = []
+    for f in files:
+        if not os.path.exists(f):
+            error('%s does not exist' % f)
+        with open(f, 'r') as ifile:
+            for line in ifile:
+                line = line.strip()
+                if line:
+                    entries.append(json.loads(line))
+    return entries
+
+
+class ServerClient(object):
+    ''' Send requests to a running server '''
+    def __init__(self, url):
+        self.url = url.rstrip('/')
+
+
+    def send(self, entry):
+        if entry['method']=='GET':
+            req = urllib.request.Request('%s%s?%s' % (self.url, entry['path'], urllib.parse.urlencode(entry['params'] or {}, doseq=True)))
+        else:
+            req = urllib.request.Request(self.url+entry['path'], data=json.dumps(entry['params']).encode('utf-8'),
+                                         headers={'Content-Type':'application/json'}, method=entry['method'])
+        try:
+            with urllib.request.urlopen(req) as resp:
+                resp.read()
+                return resp.status
+        except urllib.error.HTTPError as e:
+            return e.code
+
+
+class EngineClient(object):
+    ''' Process requests in this process, using the server's config (and so the same DB) '''
+    def __init__(self, config_file):
+        sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+        from lib import app, config
+        cfg = config.read_config(config_file, False)
+        # Do not record replayed requests (the slow log may be the file being replayed), and do not run background
+        # work that would affect the timings
+        cfg['slowlog']['file'] = None
+        cfg['trace']['file'] = None
+        cfg['warmup']['tracks'] = 0
+        cfg['prefetch']['enabled'] = False
+        cfg['reload']['poll'] = 0
+        app.similarity_app.init(argparse.Namespace(log_level='WARNING'), cfg, os.path.join(cfg['paths']['db'], JUKEBOX_FILE))
+        info('Loading indexes')
+        while app.similarity_app.generation.loading():
+            time.sleep(0.1)
+        self.client = app.similarity_app.test_client()
+
+
+    def send(self, entry):
+        if entry['method']=='GET':
+            resp = self.client.get(entry['path'], query_string=entry['params'] or {})
+        else:
+            resp = self.client.open(entry['path'], method=entry['method'], json=entry['params'])
+        return resp.status_code
+
+
+def percentile(vals, pc):
+    vals = sorted(vals)
+    return vals[min(len(vals)-1, int(len(vals)*pc/100.0))]
+
+
+def replay(client, entries, repeat):
+    results = []
+    for num, entry in enumerate(entries):
+        times = []
+        status = None
+        for _ in range(repeat):
+            start = time.perf_counter()
+            status = client.send(entry)
+            times.append((time.perf_counter()-start)*1000.0)
+        result = {'request':num+1, 'path':entry['path'], 'status':status, 'recorded_ms':entry.get('ms'),
+                  'ms':round(min(times), 1), 'max_ms':round(max(times), 1)}
+        results.append(result)
+        print('%4d %-16s %3d  recorded:%8s ms  replay:%8.1f ms (max %.1f ms)' % (result['request'], result['path'], status,
+              '?' if result['recorded_ms'] is None else '%.1f' % result['recorded_ms'], result['ms'], result['max_ms']))
+    if len(results)>0:
+        times = [result['ms'] for result in results]
+        info('%d request(s), p50:%.1f ms p95:%.1f ms max:%.1f ms' % (len(times), percentile(times, 50), percentile(times, 95), max(times)))
+    return results
+
+
+if __name__=='__main__':
+    parser = argparse.ArgumentParser(description='Replay requests recorded in Music Similarity slow request log(s)')
+    parser.add_argument('files', metavar='FILE', nargs='+', help='Slow request log file(s)')
+    parser.add_argument('-u', '--url', type=str, help='URL of running server, e.g. http://localhost:11000', default=None)
+    parser.add_argument('-c', '--config', type=str, help='Config file, to replay against an in-process server instead', default=None)
+    parser.add_argument('-r', '--repeat', type=int, help='Number of times to send each request, the quickest is reported', default=1)
+    parser.add_argument('-o', '--output', type=str, help='Write results, as JSON, to this file', default=None)
+    args = parser.parse_args()
+
+    if (args.url is None)==(args.config is None):
+        error('Either --url or --config is required')
+    entries = read_entries(args.files)
+    info('Read %d request(s)' % len(entries))
+    client = ServerClient(args.url) if args.url is not None else EngineClient(args.config)
+    results = replay(client, entries, max(1, args.repeat))
+    if args.output is not None:
+        with open(args.output, 'w') as ofile:
+            json.dump(results, ofile, indent=1)